@@ -27,24 +27,164 @@ import webbrowser
 
 from functools import partial
 
-from .util import MyTreeWidget, MONOSPACE_FONT, SortableTreeWidgetItem
+from .util import MyTreeModel, MyTreeView, AddressChanges, MONOSPACE_FONT
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QFont, QColor, QKeySequence
-from PyQt5.QtWidgets import QTreeWidgetItem, QAbstractItemView, QMenu
+from PyQt5.QtWidgets import QAbstractItemView, QComboBox, QLabel, QMenu
 from electroncash.i18n import _
 from electroncash.address import Address
 from electroncash.plugins import run_hook
 import electroncash.web as web
 
 
-class AddressList(MyTreeWidget):
+class AddressModel(MyTreeModel):
+    '''The wallet's addresses.  Only the rows of addresses the wallet
+    reports as changed are computed again on refresh().'''
+
+    def __init__(self, main_window):
+        MyTreeModel.__init__(self)
+        self.main_window = main_window
+        self.changes = AddressChanges()
+        self.addresses = []
+        self.rows = {}  # address -> (is_change, index, balance, num_tx, is_used)
+        self.show_change = 0  # all, receiving, change
+        self.show_used = 0  # all, unused, funded, used
+        self.fx = None
+        self.font = QFont(MONOSPACE_FONT)
+
+    def all_keys(self):
+        return self.addresses
+
+    def refresh(self, wallet, fx):
+        self.changes.watch(wallet)
+        changed = self.changes.take()
+        self.fx = fx
+        receiving = wallet.get_receiving_addresses()
+        change = wallet.get_change_addresses()
+        old_rows = self.rows
+        rows = {}
+        for is_change, addr_list in ((False, receiving), (True, change)):
+            for n, address in enumerate(addr_list):
+                row = old_rows.get(address)
+                if (row is None or changed is None or address in changed
+                        or row[:2] != (is_change, n)):
+                    balance = sum(wallet.get_addr_balance(address))
+                    num = len(wallet.get_address_history(address))
+                    is_used = bool(wallet.is_used(address))
+                    row = (is_change, n, balance, num, is_used)
+                rows[address] = row
+        self.rows = rows
+        addresses = receiving + change
+        # Sorting by index and the change filter only depend
+        # on the list of addresses; anything else may depend on the data
+        if (addresses != self.addresses or changed is None
+                or self.show_used or self.filter_text
+                or self.sort_column not in (None, 1)):
+            self.addresses = addresses
+            keys = self.arrange(addresses)
+        else:
+            keys = self.keys
+        self.set_keys(keys)
+
+    def arrange(self, keys):
+        if self.show_change or self.show_used:
+            keys = [addr for addr in keys if self.is_shown(addr)]
+        return MyTreeModel.arrange(self, keys)
+
+    def is_shown(self, address):
+        is_change, n, balance, num, is_used = self.rows[address]
+        if self.show_change == 1 and is_change:
+            return False
+        if self.show_change == 2 and not is_change:
+            return False
+        if self.show_used == 1 and (balance or is_used):
+            return False
+        if self.show_used == 2 and balance == 0:
+            return False
+        if self.show_used == 3 and not is_used:
+            return False
+        return True
+
+    def sort_key(self, address, column):
+        is_change, n, balance, num, is_used = self.rows[address]
+        if column == 0:
+            return address.to_ui_string()
+        if column == 1:
+            return (is_change, n)
+        if column == 2:
+            wallet = self.main_window.wallet
+            return wallet.labels.get(address.to_storage_string(), '')
+        if column == len(self.headers) - 1:
+            return num
+        return balance
+
+    def format_row(self, address):
+        is_change, n, balance, num, is_used = self.rows[address]
+        window = self.main_window
+        wallet = window.wallet
+        fx = self.fx
+        address_text = address.to_ui_string()
+        label = wallet.labels.get(address.to_storage_string(), '')
+        balance_text = window.format_amount(balance, whitespaces=True)
+        columns = [address_text, str(n), label, balance_text, str(num)]
+        money_columns = [3]
+        if fx:
+            rate = fx.exchange_rate()
+            fiat_balance = fx.value_str(balance, rate)
+            columns.insert(4, fiat_balance)
+            money_columns.append(4)
+        indices = range(len(columns))
+        background = [None] * len(columns)
+        if wallet.is_frozen(address):
+            background[0] = QColor('lightblue')
+        if wallet.is_beyond_limit(address, is_change):
+            background[0] = QColor('red')
+        tooltips = [None] * len(columns)
+        tooltips[1] = _("Change") if is_change else _("Receiving")
+        return {
+            Qt.DisplayRole: columns,
+            Qt.ToolTipRole: tooltips,
+            Qt.BackgroundRole: background,
+            Qt.FontRole: [self.font if i == 0 or i in money_columns else None
+                          for i in indices],
+            Qt.TextAlignmentRole: [Qt.AlignRight | Qt.AlignVCenter
+                                   if i in money_columns else None
+                                   for i in indices],
+        }
+
+    def set_cell(self, address, column, text):
+        window = self.main_window
+        window.wallet.set_label(address.to_storage_string(), text)
+        window.history_list.update_labels()
+        window.update_completions()
+
+
+class AddressList(MyTreeView):
     filter_columns = [0, 1, 2]  # Address, Label, Balance
 
     def __init__(self, parent=None):
-        super().__init__(parent, self.create_menu, [], 2)
+        super().__init__(parent, self.create_menu, AddressModel(parent), 2)
         self.refresh_headers()
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setSortingEnabled(True)
+        self.sortByColumn(1, Qt.AscendingOrder)
+        self.change_button = QComboBox(self)
+        self.change_button.addItems([_('All'), _('Receiving'), _('Change')])
+        self.change_button.currentIndexChanged.connect(self.toggle_change)
+        self.used_button = QComboBox(self)
+        self.used_button.addItems([_('All'), _('Unused'), _('Funded'), _('Used')])
+        self.used_button.currentIndexChanged.connect(self.toggle_used)
+
+    def get_list_header(self):
+        return QLabel(_("Filter:")), self.change_button, self.used_button
+
+    def toggle_change(self, state):
+        self.model().show_change = state
+        self.model().rearrange()
+
+    def toggle_used(self, state):
+        self.model().show_used = state
+        self.model().rearrange()
 
     def refresh_headers(self):
         headers = [ ('Address'), _('Index'),_('Label'), _('Balance'), _('Tx')]
@@ -55,98 +195,47 @@ class AddressList(MyTreeWidget):
 
     def on_update(self):
         self.wallet = self.parent.wallet
-        item = self.currentItem()
-        current_address = item.data(0, Qt.UserRole) if item else None
-        self.clear()
-        receiving_addresses = self.wallet.get_receiving_addresses()
-        change_addresses = self.wallet.get_change_addresses()
-
         if self.parent.fx and self.parent.fx.get_fiat_address_config():
             fx = self.parent.fx
         else:
             fx = None
-        account_item = self
-        sequences = [0,1] if change_addresses else [0]
-        for is_change in sequences:
-            if len(sequences) > 1:
-                name = _("Receiving") if not is_change else _("Change")
-                seq_item = QTreeWidgetItem( [ name, '', '', '', '', ''] )
-                account_item.addChild(seq_item)
-                if not is_change:
-                    seq_item.setExpanded(True)
-            else:
-                seq_item = account_item
-            used_item = QTreeWidgetItem( [ _("Used"), '', '', '', '', ''] )
-            used_flag = False
-            addr_list = change_addresses if is_change else receiving_addresses
-            for n, address in enumerate(addr_list):
-                num = len(self.wallet.get_address_history(address))
-                is_used = self.wallet.is_used(address)
-                balance = sum(self.wallet.get_addr_balance(address))
-                address_text = address.to_ui_string()
-                label = self.wallet.labels.get(address.to_storage_string(), '')
-                balance_text = self.parent.format_amount(balance, whitespaces=True)
-                columns = [address_text, str(n), label, balance_text, str(num)]
-                if fx:
-                    rate = fx.exchange_rate()
-                    fiat_balance = fx.value_str(balance, rate)
-                    columns.insert(4, fiat_balance)
-                address_item = SortableTreeWidgetItem(columns)
-                address_item.setTextAlignment(3, Qt.AlignRight)
-                address_item.setFont(3, QFont(MONOSPACE_FONT))
-                if fx:
-                    address_item.setTextAlignment(4, Qt.AlignRight)
-                    address_item.setFont(4, QFont(MONOSPACE_FONT))
-
-                address_item.setFont(0, QFont(MONOSPACE_FONT))
-                address_item.setData(0, Qt.UserRole, address)
-                address_item.setData(0, Qt.UserRole+1, True) # label can be edited
-                if self.wallet.is_frozen(address):
-                    address_item.setBackground(0, QColor('lightblue'))
-                if self.wallet.is_beyond_limit(address, is_change):
-                    address_item.setBackground(0, QColor('red'))
-                if is_used:
-                    if not used_flag:
-                        seq_item.insertChild(0, used_item)
-                        used_flag = True
-                    used_item.addChild(address_item)
-                else:
-                    seq_item.addChild(address_item)
-                if address == current_address:
-                    self.setCurrentItem(address_item)
+        self.change_button.setVisible(bool(self.wallet.get_change_addresses()))
+        self.model().refresh(self.wallet, fx)
+
+    def selected_addresses(self):
+        model = self.model()
+        return [model.key_at(index.row())
+                for index in self.selectionModel().selectedRows()]
 
     def create_menu(self, position):
         from electroncash.wallet import Multisig_Wallet
         is_multisig = isinstance(self.wallet, Multisig_Wallet)
         can_delete = self.wallet.can_delete_address()
-        selected = self.selectedItems()
-        multi_select = len(selected) > 1
-        addrs = [item.data(0, Qt.UserRole) for item in selected]
+        addrs = [addr for addr in self.selected_addresses()
+                 if isinstance(addr, Address)]
         if not addrs:
             return
-        addrs = [addr for addr in addrs if isinstance(addr, Address)]
+        multi_select = len(addrs) > 1
 
         menu = QMenu()
 
         if not multi_select:
-            item = self.itemAt(position)
-            col = self.currentColumn()
-            if not item:
-                return
-            if not addrs:
-                item.setExpanded(not item.isExpanded())
+            index = self.indexAt(position)
+            col = self.currentIndex().column()
+            if not index.isValid():
                 return
             addr = addrs[0]
 
-            column_title = self.headerItem().text(col)
+            column_title = self.model().headers[col]
             if col == 0:
                 copy_text = addr.to_full_ui_string()
             else:
-                copy_text = item.text(col)
+                copy_text = self.model().cell(addr, col)
             menu.addAction(_("Copy {}").format(column_title), lambda: self.parent.app.clipboard().setText(copy_text))
             menu.addAction(_('Details'), lambda: self.parent.show_address(addr))
             if col in self.editable_columns:
-                menu.addAction(_("Edit {}").format(column_title), lambda: self.editItem(item, col))
+                menu.addAction(_("Edit {}").format(column_title),
+                    lambda: self.edit(self.model().index_of(addr, col)))
             menu.addAction(_("Request payment"), lambda: self.parent.receive_at(addr))
             if self.wallet.can_export():
                 menu.addAction(_("Private key"), lambda: self.parent.show_private_key(addr))
@@ -174,10 +263,10 @@ class AddressList(MyTreeWidget):
         menu.exec_(self.viewport().mapToGlobal(position))
 
     def keyPressEvent(self, event):
-        if event.matches(QKeySequence.Copy) and self.currentColumn() == 0:
-            addrs = [i.data(0, Qt.UserRole) for i in self.selectedItems()]
-            if addrs and isinstance(addrs[0], Address):
-                text = addrs[0].to_full_ui_string()
+        if event.matches(QKeySequence.Copy) and self.currentIndex().column() == 0:
+            addr = self.current_key()
+            if isinstance(addr, Address):
+                text = addr.to_full_ui_string()
                 self.parent.app.clipboard().setText(text)
         else:
             super().keyPressEvent(event)
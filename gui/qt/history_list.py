@@ -23,6 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import time
 import webbrowser
 
 from .util import *
@@ -45,13 +46,110 @@ TX_ICONS = [
 ]
 
 
-class HistoryList(MyTreeWidget):
+_icons = {}
+
+def get_icon(name):
+    icon = _icons.get(name)
+    if icon is None:
+        icon = _icons[name] = QIcon(":icons/" + name)
+    return icon
+
+
+class HistoryModel(MyTreeModel):
+    '''The rows of wallet.get_history(), keyed by tx hash.'''
+
+    def __init__(self, main_window):
+        MyTreeModel.__init__(self)
+        self.main_window = main_window
+        self.rows = {}   # tx_hash -> (pos, height, conf, timestamp, value, balance)
+        self.order = []  # tx hashes, oldest first
+        self.font = QFont(MONOSPACE_FONT)
+        self.red = QBrush(QColor("#BC1E1E"))
+
+    def all_keys(self):
+        return self.order
+
+    def refresh(self, history):
+        self.rows = {h[0]: (pos,) + tuple(h[1:]) for pos, h in enumerate(history)}
+        self.order = [h[0] for h in history]
+        if self.sort_column == 0 and not self.filter_text:
+            # the default order needs no sorting
+            if self.sort_order == Qt.AscendingOrder:
+                keys = self.order[::-1]
+            else:
+                keys = list(self.order)
+        else:
+            keys = self.arrange(self.order)
+        # Labels and exchange rates may have changed as well, so all rows
+        # are formatted again as they are shown
+        self.set_keys(keys)
+
+    def update_tx(self, tx_hash, height, conf, timestamp):
+        row = self.rows.get(tx_hash)
+        if row is not None:
+            self.rows[tx_hash] = (row[0], height, conf, timestamp) + row[4:]
+            self.update_key(tx_hash)
+
+    def sort_key(self, tx_hash, column):
+        row = self.rows[tx_hash]
+        if column == 0:
+            return -row[0]
+        if column == 2:
+            return row[0]
+        if column in (4, 5):
+            value = row[column]
+            return value if value is not None else 0
+        return MyTreeModel.sort_key(self, tx_hash, column)
+
+    def format_row(self, tx_hash):
+        pos, height, conf, timestamp, value, balance = self.rows[tx_hash]
+        window = self.main_window
+        wallet = window.wallet
+        fx = window.fx
+        status, status_str = wallet.get_tx_status(tx_hash, height, conf, timestamp)
+        v_str = window.format_amount(value, True, whitespaces=True)
+        balance_str = window.format_amount(balance, whitespaces=True)
+        label = wallet.get_label(tx_hash)
+        entry = ['', tx_hash, status_str, label, v_str, balance_str]
+        if fx and fx.show_history():
+            date = timestamp_to_datetime(time.time() if conf <= 0 else timestamp)
+            for amount in [value, balance]:
+                text = fx.historical_value_str(amount, date)
+                entry.append(text)
+        columns = range(len(entry))
+        icons = [None] * len(entry)
+        icons[0] = get_icon(TX_ICONS[status])
+        if wallet.invoices.paid.get(tx_hash):
+            icons[3] = get_icon("seal")
+        tooltips = [None] * len(entry)
+        tooltips[0] = str(conf) + " confirmation" + ("s" if conf != 1 else "")
+        row = {
+            Qt.DisplayRole: entry,
+            Qt.DecorationRole: icons,
+            Qt.ToolTipRole: tooltips,
+            Qt.FontRole: [None if i == 2 else self.font for i in columns],
+            Qt.TextAlignmentRole: [Qt.AlignRight | Qt.AlignVCenter if i > 3 else None
+                                   for i in columns],
+        }
+        if value and value < 0:
+            row[Qt.ForegroundRole] = [self.red if i in (3, 4) else None
+                                      for i in columns]
+        return row
+
+    def set_cell(self, tx_hash, column, text):
+        window = self.main_window
+        window.wallet.set_label(tx_hash, text)
+        window.history_list.update_labels()
+        window.update_completions()
+
+
+class HistoryList(MyTreeView):
     filter_columns = [2, 3, 4]  # Date, Description, Amount
 
     def __init__(self, parent=None):
-        MyTreeWidget.__init__(self, parent, self.create_menu, [], 3)
+        MyTreeView.__init__(self, parent, self.create_menu,
+                            HistoryModel(parent), 3)
         self.refresh_headers()
-        self.setColumnHidden(1, True)
         self.setSortingEnabled(True)
         self.sortByColumn(0, Qt.AscendingOrder)
 
@@ -61,96 +159,45 @@ class HistoryList(MyTreeWidget):
         if fx and fx.show_history():
             headers.extend(['%s '%fx.ccy + _('Amount'), '%s '%fx.ccy + _('Balance')])
         self.update_headers(headers)
+        self.setColumnHidden(1, True)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
-        return self.wallet.get_addresses()
+        '''Replaced in address_dialog.py.  None is the whole wallet.'''
+        return None
 
     @profiler
     def on_update(self):
         self.wallet = self.parent.wallet
-        h = self.wallet.get_history(self.get_domain())
-        item = self.currentItem()
-        current_tx = item.data(0, Qt.UserRole) if item else None
-        self.clear()
         fx = self.parent.fx
         if fx: fx.history_used_spot = False
-        for h_item in h:
-            tx_hash, height, conf, timestamp, value, balance = h_item
-            status, status_str = self.wallet.get_tx_status(tx_hash, height, conf, timestamp)
-            has_invoice = self.wallet.invoices.paid.get(tx_hash)
-            icon = QIcon(":icons/" + TX_ICONS[status])
-            v_str = self.parent.format_amount(value, True, whitespaces=True)
-            balance_str = self.parent.format_amount(balance, whitespaces=True)
-            label = self.wallet.get_label(tx_hash)
-            entry = ['', tx_hash, status_str, label, v_str, balance_str]
-            if fx and fx.show_history():
-                date = timestamp_to_datetime(time.time() if conf <= 0 else timestamp)
-                for amount in [value, balance]:
-                    text = fx.historical_value_str(amount, date)
-                    entry.append(text)
-            item = SortableTreeWidgetItem(entry)
-            item.setIcon(0, icon)
-            item.setToolTip(0, str(conf) + " confirmation" + ("s" if conf != 1 else ""))
-            item.setData(0, SortableTreeWidgetItem.DataRole, (status, conf))
-            if has_invoice:
-                item.setIcon(3, QIcon(":icons/seal"))
-            for i in range(len(entry)):
-                if i>3:
-                    item.setTextAlignment(i, Qt.AlignRight)
-                if i!=2:
-                    item.setFont(i, QFont(MONOSPACE_FONT))
-            if value and value < 0:
-                item.setForeground(3, QBrush(QColor("#BC1E1E")))
-                item.setForeground(4, QBrush(QColor("#BC1E1E")))
-            if tx_hash:
-                item.setData(0, Qt.UserRole, tx_hash)
-            self.insertTopLevelItem(0, item)
-            if current_tx == tx_hash:
-                self.setCurrentItem(item)
-
-    def on_doubleclick(self, item, column):
-        if self.permit_edit(item, column):
-            super(HistoryList, self).on_doubleclick(item, column)
+        self.model().refresh(self.wallet.get_history(self.get_domain()))
+
+    def on_doubleclick(self, index):
+        if self.permit_edit(index):
+            super(HistoryList, self).on_doubleclick(index)
         else:
-            tx_hash = item.data(0, Qt.UserRole)
+            tx_hash = self.model().key_at(index.row())
             tx = self.wallet.transactions.get(tx_hash)
             self.parent.show_transaction(tx)
 
     def update_labels(self):
-        root = self.invisibleRootItem()
-        child_count = root.childCount()
-        for i in range(child_count):
-            item = root.child(i)
-            txid = item.data(0, Qt.UserRole)
-            label = self.wallet.get_label(txid)
-            item.setText(3, label)
+        self.model().update_column(3)
 
     def update_item(self, tx_hash, height, conf, timestamp):
-        status, status_str = self.wallet.get_tx_status(tx_hash, height, conf, timestamp)
-        icon = QIcon(":icons/" +  TX_ICONS[status])
-        items = self.findItems(tx_hash, Qt.UserRole|Qt.MatchContains|Qt.MatchRecursive, column=1)
-        if items:
-            item = items[0]
-            item.setIcon(0, icon)
-            item.setData(0, SortableTreeWidgetItem.DataRole, (status, conf))
-            item.setText(2, status_str)
+        self.model().update_tx(tx_hash, height, conf, timestamp)
 
     def create_menu(self, position):
-        self.selectedIndexes()
-        item = self.currentItem()
-        if not item:
-            return
-        column = self.currentColumn()
-        tx_hash = item.data(0, Qt.UserRole)
+        index = self.currentIndex()
+        tx_hash = self.model().key_at(index.row())
         if not tx_hash:
             return
+        column = index.column()
         if column is 0:
             column_title = "ID"
             column_data = tx_hash
         else:
-            column_title = self.headerItem().text(column)
-            column_data = item.text(column)
+            column_title = self.model().headers[column]
+            column_data = self.model().cell(tx_hash, column)
 
         tx_URL = web.BE_URL(self.config, 'tx', tx_hash)
         height, conf, timestamp = self.wallet.get_tx_height(tx_hash)
@@ -163,9 +210,9 @@ class HistoryList(MyTreeWidget):
 
         menu.addAction(_("Copy {}").format(column_title), lambda: self.parent.app.clipboard().setText(column_data))
         if column in self.editable_columns:
-            # We grab a fresh reference to the current item, as it has been deleted in a reported issue.
+            # The row may have moved by the time the action is chosen
             menu.addAction(_("Edit {}").format(column_title),
-                lambda: self.currentItem() and self.editItem(self.currentItem(), column))
+                lambda: self.edit(self.model().index_of(tx_hash, column)))
 
         menu.addAction(_("Details"), lambda: self.parent.show_transaction(tx))
         if is_unconfirmed and tx:
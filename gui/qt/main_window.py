@@ -432,6 +432,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
+                # Fold recent changes into the wallet file
+                self.wallet.storage.compact()
                 # Copy file contents
                 shutil.copyfile(path, new_path)
 
@@ -1696,7 +1698,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         from .address_list import AddressList
         self.address_list = l = AddressList(self)
         self.cashaddr_toggled_signal.connect(l.update)
-        return self.create_list_tab(l)
+        return self.create_list_tab(l, l.get_list_header())
 
     def create_utxo_tab(self):
         from .utxo_list import UTXOList
@@ -1994,7 +1996,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         basename = os.path.basename(wallet_path)
         self.gui_object.daemon.stop_wallet(wallet_path)
         self.close()
-        os.unlink(wallet_path)
+        self.wallet.storage.delete()
         self.show_error("Wallet removed:" + basename)
 
     @protected
@@ -3,6 +3,7 @@ import time
 import sys
 import platform
 import queue
+import threading
 from collections import namedtuple
 from functools import partial
 
@@ -492,6 +493,352 @@ class MyTreeWidget(QTreeWidget):
                                 for column in columns]))
 
 
+class MyTreeModel(QAbstractItemModel):
+    '''A flat list model for MyTreeView.  Each row has a key, the rows
+    are handed to the view FETCH_SIZE at a time as it scrolls, and a
+    row is formatted by format_row() only once the view asks for it.
+    Subclasses keep the data of the keys and call set_keys() when it
+    changes.'''
+
+    FETCH_SIZE = 500
+
+    def __init__(self, parent=None, editable_columns=()):
+        QAbstractItemModel.__init__(self, parent)
+        self.editable_columns = editable_columns
+        self.headers = []
+        self.keys = []       # keys of the rows, filtered and sorted
+        self.row_of = {}     # key -> row
+        self.fetched = 0     # rows the view knows about
+        self.formatted = {}  # key -> {role: [value of each column]}
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+        self.filter_text = ''
+        self.filter_columns = ()
+
+    # Implemented by subclasses
+
+    def all_keys(self):
+        '''The keys of every row in their natural order.'''
+        return []
+
+    def format_row(self, key):
+        '''Returns {role: [value of each column]} for the row of key.'''
+        return {}
+
+    def sort_key(self, key, column):
+        '''Like SortableTreeWidgetItem, numbers sort as numbers.'''
+        text = self.cell(key, column)
+        try:
+            return (0, float(text.replace(',', '')), '')
+        except ValueError:
+            return (1, 0, text)
+
+    def set_cell(self, key, column, value):
+        '''Called when an editable cell is edited.'''
+        pass
+
+    # Row management
+
+    def cell(self, key, column, role=Qt.DisplayRole):
+        row = self.formatted.get(key)
+        if row is None:
+            row = self.formatted[key] = self.format_row(key)
+        values = row.get(role)
+        return values[column] if values else None
+
+    def key_at(self, row):
+        return self.keys[row] if 0 <= row < self.fetched else None
+
+    def index_of(self, key, column=0):
+        row = self.row_of.get(key)
+        if row is None or row >= self.fetched:
+            return QModelIndex()
+        return self.index(row, column)
+
+    def arrange(self, keys):
+        '''Apply the current filter and sort order to keys.'''
+        p = self.filter_text
+        if p:
+            keys = [key for key in keys
+                    if any(p in (self.cell(key, column) or '').lower()
+                           for column in self.filter_columns)]
+        if self.sort_column is not None:
+            column = self.sort_column
+            keys = sorted(keys, key=lambda k: self.sort_key(k, column),
+                          reverse=self.sort_order == Qt.DescendingOrder)
+        return keys
+
+    def set_keys(self, keys, changed=None):
+        '''Show the rows of keys, which are already arranged.  Rows of
+        keys in changed, or of all keys if it is None, are formatted
+        again.  Rows added at either end are inserted; other changes
+        reset the model.'''
+        if changed is None:
+            self.formatted.clear()
+        else:
+            for key in changed:
+                self.formatted.pop(key, None)
+        old = self.keys
+        added = len(keys) - len(old)
+        if keys == old:
+            if self.fetched and (changed is None or changed):
+                self.dataChanged.emit(self.index(0, 0),
+                    self.index(self.fetched - 1, self.columnCount() - 1))
+            return
+        if old and added > 0 and keys[added:] == old:
+            self.beginInsertRows(QModelIndex(), 0, added - 1)
+            self._set_keys(keys)
+            self.fetched += added
+            self.endInsertRows()
+        elif old and added > 0 and keys[:len(old)] == old and self.fetched == len(old):
+            count = min(added, self.FETCH_SIZE)
+            self.beginInsertRows(QModelIndex(), self.fetched,
+                                 self.fetched + count - 1)
+            self._set_keys(keys)
+            self.fetched += count
+            self.endInsertRows()
+        else:
+            self.beginResetModel()
+            self._set_keys(keys)
+            self.fetched = min(len(keys), max(self.fetched, self.FETCH_SIZE))
+            self.endResetModel()
+            return
+        if changed is None or changed:
+            self.dataChanged.emit(self.index(0, 0),
+                self.index(self.fetched - 1, self.columnCount() - 1))
+
+    def _set_keys(self, keys):
+        self.keys = keys
+        self.row_of = {key: row for row, key in enumerate(keys)}
+
+    def update_key(self, key):
+        '''Format the row of key again.'''
+        self.formatted.pop(key, None)
+        index = self.index_of(key)
+        if index.isValid():
+            self.dataChanged.emit(index,
+                self.index(index.row(), self.columnCount() - 1))
+
+    def update_column(self, column):
+        '''Format all rows again; only column changed.'''
+        self.formatted.clear()
+        if self.fetched:
+            self.dataChanged.emit(self.index(0, column),
+                                  self.index(self.fetched - 1, column))
+
+    def set_headers(self, headers):
+        self.beginResetModel()
+        self.headers = headers
+        self.formatted.clear()
+        self.endResetModel()
+
+    def set_filter(self, text, columns):
+        self.filter_text = text
+        self.filter_columns = columns
+        self.rearrange()
+
+    def rearrange(self):
+        '''Filter and sort again, after the criteria changed.'''
+        self.set_keys(self.arrange(self.all_keys()), changed=())
+
+    # QAbstractItemModel
+
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index):
+        return QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.fetched
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.fetched < len(self.keys)
+
+    def fetchMore(self, parent):
+        count = min(self.FETCH_SIZE, len(self.keys) - self.fetched)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.fetched,
+                             self.fetched + count - 1)
+        self.fetched += count
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        key = self.keys[index.row()]
+        if role == Qt.UserRole:
+            return key
+        if role == Qt.EditRole:
+            role = Qt.DisplayRole
+        return self.cell(key, index.column(), role)
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() in self.editable_columns:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        key = self.keys[index.row()]
+        if value != self.cell(key, index.column()):
+            self.set_cell(key, index.column(), value)
+            self.update_key(key)
+        return True
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        moved = [(self.keys[i.row()], i.column()) for i in persistent]
+        self._set_keys(self.arrange(self.keys))
+        self.changePersistentIndexList(
+            persistent, [self.index_of(key, column) for key, column in moved])
+        self.layoutChanged.emit()
+
+
+class AddressChanges(object):
+    '''Collects the addresses a wallet reports as changed, from any
+    thread, for a model to take when it updates.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wallet = None
+        self.addresses = set()
+        self.everything = True
+
+    def watch(self, wallet):
+        if wallet is self.wallet:
+            return
+        if self.wallet:
+            self.wallet.remove_addr_listener(self.note)
+        self.wallet = wallet
+        with self.lock:
+            self.addresses = set()
+            self.everything = True
+        wallet.add_addr_listener(self.note)
+
+    def note(self, addresses):
+        with self.lock:
+            if addresses is None:
+                self.everything = True
+            elif not self.everything:
+                self.addresses.update(addresses)
+
+    def take(self):
+        '''Returns the addresses changed since the last call, or None if
+        they all may have.'''
+        with self.lock:
+            addresses = None if self.everything else self.addresses
+            self.addresses = set()
+            self.everything = False
+        return addresses
+
+
+class MyTreeView(QTreeView):
+    '''The counterpart of MyTreeWidget for a MyTreeModel.  Only the rows
+    on screen are formatted, so long lists stay cheap to update.'''
+
+    def __init__(self, parent, create_menu, model, stretch_column=None,
+                 editable_columns=None):
+        QTreeView.__init__(self, parent)
+        self.parent = parent
+        self.config = self.parent.config
+        self.stretch_column = stretch_column
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(create_menu)
+        self.setUniformRowHeights(True)
+        self.setRootIsDecorated(False)
+        if editable_columns is None:
+            editable_columns = [stretch_column]
+        self.editable_columns = editable_columns
+        model.editable_columns = editable_columns
+        # the view owns the model
+        model.setParent(self)
+        self.setModel(model)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.doubleClicked.connect(self.on_doubleclick)
+        self.pending_update = False
+        self.current_filter = ""
+
+    def update_headers(self, headers):
+        self.model().set_headers(headers)
+        self.header().setStretchLastSection(False)
+        for col in range(len(headers)):
+            sm = QHeaderView.Stretch if col == self.stretch_column else QHeaderView.ResizeToContents
+            self.header().setSectionResizeMode(col, sm)
+
+    def current_key(self):
+        return self.model().key_at(self.currentIndex().row())
+
+    def keyPressEvent(self, event):
+        if (event.key() in [ Qt.Key_F2, Qt.Key_Return ]
+                and self.state() != QAbstractItemView.EditingState):
+            self.on_activated(self.currentIndex())
+        else:
+            QTreeView.keyPressEvent(self, event)
+
+    def permit_edit(self, index):
+        return (index.column() in self.editable_columns
+                and self.on_permit_edit(index))
+
+    def on_permit_edit(self, index):
+        return True
+
+    def on_doubleclick(self, index):
+        if self.permit_edit(index):
+            self.edit(index)
+
+    def on_activated(self, index):
+        # on 'enter' we show the menu
+        pt = self.visualRect(index).bottomLeft()
+        pt.setX(50)
+        self.customContextMenuRequested.emit(pt)
+
+    def closeEditor(self, editor, hint):
+        QTreeView.closeEditor(self, editor, hint)
+        # Now do any pending updates
+        if self.pending_update:
+            self.pending_update = False
+            self.update()
+
+    def update(self):
+        # Defer updates if editing
+        if self.state() == QAbstractItemView.EditingState:
+            self.pending_update = True
+            return
+        key = self.current_key()
+        self.setUpdatesEnabled(False)
+        self.on_update()
+        self.setUpdatesEnabled(True)
+        if key is not None:
+            index = self.model().index_of(key, max(self.currentIndex().column(), 0))
+            if index.isValid():
+                self.setCurrentIndex(index)
+
+    def on_update(self):
+        pass
+
+    def filter(self, p):
+        self.current_filter = p.lower()
+        self.model().set_filter(self.current_filter,
+                                self.__class__.filter_columns)
+
+
 class ButtonsWidget(QWidget):
 
     def __init__(self):
@@ -26,44 +26,97 @@ from .util import *
 from electroncash.i18n import _
 
 
-class UTXOList(MyTreeWidget):
+class UTXOModel(MyTreeModel):
+    '''The wallet's coins, keyed by output point.  Only the coins of
+    addresses the wallet reports as changed are fetched again.'''
+
+    def __init__(self, main_window):
+        MyTreeModel.__init__(self)
+        self.main_window = main_window
+        self.changes = AddressChanges()
+        self.coins = {}    # output point -> coin
+        self.by_addr = {}  # address -> output points of its coins
+        self.order = []
+        self.font = QFont(MONOSPACE_FONT)
+
+    def all_keys(self):
+        return self.order
+
+    def refresh(self, wallet):
+        self.changes.watch(wallet)
+        changed = self.changes.take()
+        addresses = wallet.get_addresses()
+        by_addr = {}
+        for address in addresses:
+            names = self.by_addr.get(address)
+            if names is None or changed is None or address in changed:
+                coins = wallet.get_addr_utxo(address)
+                for name in names or ():
+                    self.coins.pop(name, None)
+                self.coins.update(coins)
+                names = list(coins)
+            by_addr[address] = names
+        for address in set(self.by_addr) - set(by_addr):
+            for name in self.by_addr[address]:
+                self.coins.pop(name, None)
+        self.by_addr = by_addr
+        self.order = [name for address in addresses for name in by_addr[address]]
+        self.set_keys(self.arrange(self.order))
+
+    def sort_key(self, name, column):
+        coin = self.coins[name]
+        if column == 0:
+            return coin['address'].to_ui_string()
+        if column == 2:
+            return coin['value']
+        if column == 3:
+            return coin['height']
+        if column == 4:
+            return name
+        return MyTreeModel.sort_key(self, name, column)
+
+    def format_row(self, name):
+        coin = self.coins[name]
+        window = self.main_window
+        wallet = window.wallet
+        address = coin['address']
+        label = wallet.get_label(coin['prevout_hash'])
+        amount = window.format_amount(coin['value'])
+        columns = [address.to_ui_string(), label, amount, str(coin['height']),
+                   name[0:10] + '...' + name[-2:]]
+        background = [None] * len(columns)
+        if wallet.is_frozen(address):
+            background[0] = ColorScheme.BLUE.as_color(True)
+        return {
+            Qt.DisplayRole: columns,
+            Qt.BackgroundRole: background,
+            Qt.FontRole: [self.font if i in (0, 4) else None
+                          for i in range(len(columns))],
+        }
+
+
+class UTXOList(MyTreeView):
     filter_columns = [0, 2]  # Address, Label
 
     def __init__(self, parent=None):
-        MyTreeWidget.__init__(self, parent, self.create_menu, [ _('Address'), _('Label'), _('Amount'), _('Height'), _('Output point')], 1)
+        MyTreeView.__init__(self, parent, self.create_menu, UTXOModel(parent), 1)
+        self.update_headers([ _('Address'), _('Label'), _('Amount'), _('Height'), _('Output point')])
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setSortingEnabled(True)
 
-    def get_name(self, x):
-        return x.get('prevout_hash') + ":%d"%x.get('prevout_n')
-
     def on_update(self):
         self.wallet = self.parent.wallet
-        self.clear()
-        self.utxos = self.wallet.get_utxos()
-        for x in self.utxos:
-            address = x['address']
-            address_text = address.to_ui_string()
-            height = x['height']
-            name = self.get_name(x)
-            label = self.wallet.get_label(x['prevout_hash'])
-            amount = self.parent.format_amount(x['value'])
-            utxo_item = SortableTreeWidgetItem([address_text, label, amount,
-                                         str(height),
-                                         name[0:10] + '...' + name[-2:]])
-            utxo_item.setFont(0, QFont(MONOSPACE_FONT))
-            utxo_item.setFont(4, QFont(MONOSPACE_FONT))
-            utxo_item.setData(0, Qt.UserRole, name)
-            if self.wallet.is_frozen(address):
-                utxo_item.setBackground(0, ColorScheme.BLUE.as_color(True))
-            self.addChild(utxo_item)
+        self.model().refresh(self.wallet)
 
     def create_menu(self, position):
-        selected = [x.data(0, Qt.UserRole) for x in self.selectedItems()]
+        model = self.model()
+        selected = [model.key_at(index.row())
+                    for index in self.selectionModel().selectedRows()]
         if not selected:
             return
         menu = QMenu()
-        coins = filter(lambda x: self.get_name(x) in selected, self.utxos)
+        # spend_coins() adds signing information to the coins
+        coins = [dict(model.coins[name]) for name in selected]
 
         menu.addAction(_("Spend"), lambda: self.parent.spend_coins(coins))
         if len(selected) == 1:
@@ -73,6 +126,6 @@ class UTXOList(MyTreeWidget):
 
         menu.exec_(self.viewport().mapToGlobal(position))
 
-    def on_permit_edit(self, item, column):
+    def on_permit_edit(self, index):
         # disable editing fields in this tab (labels)
         return False
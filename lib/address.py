@@ -30,7 +30,7 @@ import struct
 from . import cashaddr
 from .enum import Enumeration
 from .bitcoin import EC_KEY, is_minikey, minikey_to_private_key
-from .util import cachedproperty
+from .util import cachedproperty, LRUCache
 from .networks import NetworkConstants
 
 _sha256 = hashlib.sha256
@@ -254,8 +254,18 @@ class ScriptOutput(namedtuple("ScriptAddressTuple", "script")):
         return '<ScriptOutput {}>'.format(self.__str__())
 
 
-# A namedtuple for easy comparison and unique hashing
-class Address(namedtuple("AddressTuple", "hash160 kind")):
+# Addresses parsed by Address.from_string(), keyed by network prefix and
+# string.  Strings an Address was encoded to are entered too.
+INTERN_TABLE_SIZE = 1 << 17
+_interned = LRUCache(INTERN_TABLE_SIZE)
+
+
+class Address(object):
+    '''Immutable and hashable; compares like the (hash160, kind) tuple.
+    Encodings are computed once per object and network.'''
+
+    __slots__ = ('hash160', 'kind', '_hash', '_cashaddr', '_legacy',
+                 '_scripthash_hex')
 
     # Address kinds
     ADDR_P2PKH = 0
@@ -273,7 +283,61 @@ class Address(namedtuple("AddressTuple", "hash160 kind")):
         assert kind in (cls.ADDR_P2PKH, cls.ADDR_P2SH)
         hash160 = to_bytes(hash160)
         assert len(hash160) == 20
-        return super().__new__(cls, hash160, kind)
+        self = super().__new__(cls)
+        setattr_ = object.__setattr__
+        setattr_(self, 'hash160', hash160)
+        setattr_(self, 'kind', kind)
+        setattr_(self, '_hash', hash((hash160, kind)))
+        # (network prefix or version byte, string) once computed
+        setattr_(self, '_cashaddr', None)
+        setattr_(self, '_legacy', None)
+        setattr_(self, '_scripthash_hex', None)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("can't set attribute")
+
+    def __reduce__(self):
+        return (self.__class__, (self.hash160, self.kind))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return self.hash160 == other.hash160 and self.kind == other.kind
+
+    def __ne__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return self.hash160 != other.hash160 or self.kind != other.kind
+
+    def __lt__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return (self.hash160, self.kind) < (other.hash160, other.kind)
+
+    def __le__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return (self.hash160, self.kind) <= (other.hash160, other.kind)
+
+    def __gt__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return (self.hash160, self.kind) > (other.hash160, other.kind)
+
+    def __ge__(self, other):
+        if not isinstance(other, Address):
+            return NotImplemented
+        return (self.hash160, self.kind) >= (other.hash160, other.kind)
 
     @classmethod
     def show_cashaddr(cls, on):
@@ -299,7 +363,17 @@ class Address(namedtuple("AddressTuple", "hash160 kind")):
 
     @classmethod
     def from_string(cls, string):
-        '''Construct from an address string.'''
+        '''Construct from an address string.  Strings seen before return
+        the same object.'''
+        key = (NetworkConstants.CASHADDR_PREFIX, string)
+        addr = _interned.get(key)
+        if addr is None:
+            addr = cls._from_string(string)
+            _interned.put(key, addr)
+        return addr
+
+    @classmethod
+    def _from_string(cls, string):
         if len(string) > 35:
             return cls.from_cashaddr_string(string)
 
@@ -363,12 +437,18 @@ class Address(namedtuple("AddressTuple", "hash160 kind")):
         return [addr.to_string(fmt) for addr in addrs]
 
     def to_cashaddr(self):
+        prefix = NetworkConstants.CASHADDR_PREFIX
+        cached = self._cashaddr
+        if cached is not None and cached[0] == prefix:
+            return cached[1]
         if self.kind == self.ADDR_P2PKH:
             kind  = cashaddr.PUBKEY_TYPE
         else:
             kind  = cashaddr.SCRIPT_TYPE
-        return cashaddr.encode(NetworkConstants.CASHADDR_PREFIX, kind,
-                               self.hash160)
+        text = cashaddr.encode(prefix, kind, self.hash160)
+        object.__setattr__(self, '_cashaddr', (prefix, text))
+        _interned.put((prefix, text), self)
+        return text
 
     def to_string(self, fmt):
         '''Converts to a string of the given format.'''
@@ -376,10 +456,7 @@ class Address(namedtuple("AddressTuple", "hash160 kind")):
             return self.to_cashaddr()
 
         if fmt == self.FMT_LEGACY:
-            if self.kind == self.ADDR_P2PKH:
-                verbyte = NetworkConstants.ADDRTYPE_P2PKH
-            else:
-                verbyte = NetworkConstants.ADDRTYPE_P2SH
+            return self.to_legacy()
         elif fmt == self.FMT_BITPAY:
             if self.kind == self.ADDR_P2PKH:
                 verbyte = NetworkConstants.ADDRTYPE_P2PKH_BITPAY
@@ -390,6 +467,19 @@ class Address(namedtuple("AddressTuple", "hash160 kind")):
 
         return Base58.encode_check(bytes([verbyte]) + self.hash160)
 
+    def to_legacy(self):
+        if self.kind == self.ADDR_P2PKH:
+            verbyte = NetworkConstants.ADDRTYPE_P2PKH
+        else:
+            verbyte = NetworkConstants.ADDRTYPE_P2SH
+        cached = self._legacy
+        if cached is not None and cached[0] == verbyte:
+            return cached[1]
+        text = Base58.encode_check(bytes([verbyte]) + self.hash160)
+        object.__setattr__(self, '_legacy', (verbyte, text))
+        _interned.put((NetworkConstants.CASHADDR_PREFIX, text), self)
+        return text
+
     def to_full_string(self, fmt):
         '''Convert to text, with a URI prefix for cashaddr format.'''
         text = self.to_string(fmt)
@@ -436,7 +526,10 @@ class Address(namedtuple("AddressTuple", "hash160 kind")):
 
     def to_scripthash_hex(self):
         '''Like other bitcoin hashes this is reversed when written in hex.'''
-        return hash_to_hex_str(self.to_scripthash())
+        if self._scripthash_hex is None:
+            object.__setattr__(self, '_scripthash_hex',
+                               hash_to_hex_str(self.to_scripthash()))
+        return self._scripthash_hex
 
     def __str__(self):
         return self.to_ui_string()
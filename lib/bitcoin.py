@@ -28,6 +28,7 @@ import base64
 import hmac
 import os
 import json
+import struct
 
 import ecdsa
 import pyaes
@@ -146,21 +147,29 @@ def rev_hex(s):
 
 def int_to_hex(i, length=1):
     assert isinstance(i, int)
-    s = hex(i)[2:].rstrip('L')
-    s = "0"*(2*length - len(s)) + s
-    return rev_hex(s)
+    try:
+        return i.to_bytes(length, 'little').hex()
+    except OverflowError:
+        # does not fit; keep the historical output
+        s = hex(i)[2:].rstrip('L')
+        s = "0"*(2*length - len(s)) + s
+        return rev_hex(s)
 
 
 def var_int(i):
+    return var_int_bytes(i).hex()
+
+
+def var_int_bytes(i):
     # https://en.bitcoin.it/wiki/Protocol_specification#Variable_length_integer
     if i<0xfd:
-        return int_to_hex(i)
+        return bytes((i,))
     elif i<=0xffff:
-        return "fd"+int_to_hex(i,2)
+        return b'\xfd' + struct.pack('<H', i)
     elif i<=0xffffffff:
-        return "fe"+int_to_hex(i,4)
+        return b'\xfe' + struct.pack('<I', i)
     else:
-        return "ff"+int_to_hex(i,8)
+        return b'\xff' + struct.pack('<Q', i)
 
 
 def op_push(i):
@@ -425,9 +434,7 @@ def is_compressed(sec):
 
 
 def public_key_from_private_key(pk, compressed):
-    pkey = regenerate_key(pk)
-    public_key = GetPubKey(pkey.pubkey, compressed)
-    return bh2u(public_key)
+    return bh2u(ec_backend.pubkey_from_secret(pk, compressed))
 
 def address_from_private_key(sec):
     txin_type, privkey, compressed = deserialize_privkey(sec)
@@ -476,19 +483,13 @@ def verify_message(address, sig, message):
         address = Address.from_string(address)
 
     h = Hash(msg_magic(message))
-    public_key, compressed = pubkey_from_signature(sig, h)
+    pubkey = recover_pubkey_from_signature(sig, h)
     # check public key using the right address
-    pubkey = point_to_ser(public_key.pubkey.point, compressed)
     addr = Address.from_pubkey(pubkey)
     if address != addr:
         return False
     # check message
-    try:
-        public_key.verify_digest(sig[1:], h,
-                                 sigdecode=ecdsa.util.sigdecode_string)
-    except:
-        return False
-    return True
+    return ec_backend.verify(pubkey, sig[1:], h)
 
 def encrypt_message(message, pubkey):
     return EC_KEY.encrypt_message(message, bfh(pubkey))
@@ -563,7 +564,9 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         return klass.from_public_point( Q, curve )
 
 
-def pubkey_from_signature(sig, h):
+def decode_message_signature(sig):
+    '''Returns the recovery id and compressed flag of a 65 byte message
+    signature.'''
     if len(sig) != 65:
         raise Exception("Wrong encoding")
     nV = sig[0]
@@ -574,10 +577,20 @@ def pubkey_from_signature(sig, h):
         nV -= 4
     else:
         compressed = False
-    recid = nV - 27
+    return nV - 27, compressed
+
+
+def pubkey_from_signature(sig, h):
+    recid, compressed = decode_message_signature(sig)
     return MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1), compressed
 
 
+def recover_pubkey_from_signature(sig, h):
+    '''Like pubkey_from_signature, but returns the serialized public key.'''
+    recid, compressed = decode_message_signature(sig)
+    return ec_backend.recover(sig[1:], recid, h, compressed)
+
+
 class MySigningKey(ecdsa.SigningKey):
     """Enforce low S values in signatures"""
 
@@ -591,49 +604,129 @@ class MySigningKey(ecdsa.SigningKey):
         return r, s
 
 
+class ECBackendPython(object):
+    '''The EC operations of this module, on the pure Python ecdsa
+    package.  Public keys are serialized, secrets, digests and tweaks
+    are 32 bytes and compact signatures are 64 bytes r || s.  The
+    faster ECBackendSecp256k1 in ecc_fast.py has the same interface and
+    is used instead if libsecp256k1 is available.'''
+
+    name = 'python-ecdsa'
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        assert len(secret) == 32
+        point = generator_secp256k1 * string_to_number(secret)
+        return point_to_ser(point, compressed)
+
+    def pubkey_is_valid(self, pubkey):
+        try:
+            point = ser_to_point(pubkey)
+        except Exception:
+            return False
+        return ecdsa.ecdsa.point_is_valid(generator_secp256k1, point.x(), point.y())
+
+    def pubkey_add_tweak(self, pubkey, tweak, compressed=True):
+        point = string_to_number(tweak) * generator_secp256k1 + ser_to_point(pubkey)
+        return point_to_ser(point, compressed)
+
+    def pubkey_multiply(self, pubkey, secret, compressed=True):
+        point = ser_to_point(pubkey) * string_to_number(secret)
+        return point_to_ser(point, compressed)
+
+    def _signing_key(self, secret):
+        return MySigningKey.from_secret_exponent(string_to_number(secret),
+                                                 curve=SECP256k1)
+
+    def sign(self, secret, digest):
+        return self._signing_key(secret).sign_digest_deterministic(
+            digest, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_string)
+
+    def sign_der(self, secret, digests):
+        '''Returns the DER encoded signatures of a list of digests.'''
+        private_key = self._signing_key(secret)
+        return [private_key.sign_digest_deterministic(
+                    digest, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_der)
+                for digest in digests]
+
+    def sign_recoverable(self, secret, digest):
+        '''Returns the recovery id and the compact signature.'''
+        sig = self.sign(secret, digest)
+        pubkey = self.pubkey_from_secret(secret)
+        for recid in range(4):
+            try:
+                if self.recover(sig, recid, digest) == pubkey:
+                    return recid, sig
+            except Exception:
+                continue
+        raise Exception("error: cannot sign message")
+
+    def verify(self, pubkey, sig, digest):
+        try:
+            point = ser_to_point(pubkey)
+            key = ecdsa.VerifyingKey.from_public_point(point, curve=SECP256k1)
+            return key.verify_digest(sig, digest, sigdecode=ecdsa.util.sigdecode_string)
+        except Exception:
+            return False
+
+    def recover(self, sig, recid, digest, compressed=True):
+        key = MyVerifyingKey.from_signature(sig, recid, digest, curve=SECP256k1)
+        return point_to_ser(key.pubkey.point, compressed)
+
+
+from . import ecc_fast
+ec_backend = ecc_fast.ec_backend or ECBackendPython()
+
+
 class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
-        self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
+        # the secret as 32 bytes, for the EC backend
+        self.secret_bytes = number_to_string(secret % generator_secp256k1.order(),
+                                             generator_secp256k1.order())
+        self._pubkey = None
+
+    # The ecdsa key objects are only made for callers using them
+    @property
+    def pubkey(self):
+        if self._pubkey is None:
+            point = ser_to_point(self.GetPubKey(False))
+            self._pubkey = ecdsa.ecdsa.Public_key(generator_secp256k1, point)
+        return self._pubkey
+
+    @property
+    def privkey(self):
+        return ecdsa.ecdsa.Private_key(self.pubkey, self.secret)
 
     def GetPubKey(self, compressed):
-        return GetPubKey(self.pubkey, compressed)
+        return ec_backend.pubkey_from_secret(self.secret_bytes, compressed)
 
     def get_public_key(self, compressed=True):
-        return bh2u(point_to_ser(self.pubkey.point, compressed))
+        return bh2u(self.GetPubKey(compressed))
 
     def sign(self, msg_hash):
-        private_key = MySigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
-        return signature
+        return ec_backend.sign(self.secret_bytes, msg_hash)
 
     def sign_message(self, message, is_compressed):
         message = to_bytes(message, 'utf8')
-        signature = self.sign(Hash(msg_magic(message)))
-        for i in range(4):
-            sig = bytes([27 + i + (4 if is_compressed else 0)]) + signature
-            try:
-                self.verify_message(sig, message)
-                return sig
-            except Exception as e:
-                continue
-        else:
-            raise Exception("error: cannot sign message")
+        recid, signature = ec_backend.sign_recoverable(self.secret_bytes,
+                                                       Hash(msg_magic(message)))
+        sig = bytes([27 + recid + (4 if is_compressed else 0)]) + signature
+        self.verify_message(sig, message)
+        return sig
 
     def verify_message(self, sig, message):
         assert_bytes(message)
         h = Hash(msg_magic(message))
-        public_key, compressed = pubkey_from_signature(sig, h)
+        recid, compressed = decode_message_signature(sig)
+        pubkey = ec_backend.recover(sig[1:], recid, h, compressed)
         # check public key
-        if point_to_ser(public_key.pubkey.point, compressed) != point_to_ser(self.pubkey.point, compressed):
+        if pubkey != self.GetPubKey(compressed):
             raise Exception("Bad signature")
         # check message
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if not ec_backend.verify(pubkey, sig[1:], h):
+            raise Exception("Bad signature")
 
 
     # ECIES encryption/decryption methods; AES-128-CBC with PKCS7 is used as the cipher; hmac-sha256 is used as the mac
@@ -642,17 +735,16 @@ class EC_KEY(object):
     def encrypt_message(self, message, pubkey):
         assert_bytes(message)
 
-        pk = ser_to_point(pubkey)
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, pk.x(), pk.y()):
+        if not ec_backend.pubkey_is_valid(pubkey):
             raise Exception('invalid pubkey')
 
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        ecdh_key = ec_backend.pubkey_multiply(pubkey, ephemeral.secret_bytes)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
-        ephemeral_pubkey = bfh(ephemeral.get_public_key(compressed=True))
+        ephemeral_pubkey = ephemeral.GetPubKey(True)
         encrypted = b'BIE1' + ephemeral_pubkey + ciphertext
         mac = hmac.new(key_m, encrypted, hashlib.sha256).digest()
 
@@ -668,13 +760,9 @@ class EC_KEY(object):
         mac = encrypted[-32:]
         if magic != b'BIE1':
             raise Exception('invalid ciphertext: invalid magic bytes')
-        try:
-            ephemeral_pubkey = ser_to_point(ephemeral_pubkey)
-        except AssertionError as e:
+        if not ec_backend.pubkey_is_valid(ephemeral_pubkey):
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
-            raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
+        ecdh_key = ec_backend.pubkey_multiply(ephemeral_pubkey, self.secret_bytes)
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -690,10 +778,8 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    K = ec_backend.pubkey_from_secret(secret, False)[1:]
+    K_compressed = ec_backend.pubkey_from_secret(secret, True)
     return K, K_compressed
 
 
@@ -712,8 +798,7 @@ def CKD_priv(k, c, n):
 
 def _CKD_priv(k, c, s, is_prime):
     order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
+    cK = ec_backend.pubkey_from_secret(k, True)
     data = bytes([0]) + k + s if is_prime else cK + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
@@ -732,13 +817,9 @@ def CKD_pub(cK, c, n):
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    cK_n = ec_backend.pubkey_add_tweak(cK, I[0:32], True)
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
 
@@ -21,6 +21,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import mmap
 import os
 import sys
 import threading
@@ -71,6 +72,10 @@ def target_to_bits(target):
 MAX_BITS = 0x1d00ffff
 MAX_TARGET = bits_to_target(MAX_BITS)
 
+# Deserialized headers kept in memory per branch; two chunks covers the
+# look-back of every difficulty algorithm.
+HEADER_CACHE_SIZE = 2 * 2016
+
 def serialize_header(res):
     s = int_to_hex(res.get('version'), 4) \
         + rev_hex(res.get('prev_block_hash')) \
@@ -81,14 +86,13 @@ def serialize_header(res):
     return s
 
 def deserialize_header(s, height):
-    hex_to_int = lambda s: int('0x' + bh2u(s[::-1]), 16)
     h = {}
-    h['version'] = hex_to_int(s[0:4])
+    h['version'] = int.from_bytes(s[0:4], 'little')
     h['prev_block_hash'] = hash_encode(s[4:36])
     h['merkle_root'] = hash_encode(s[36:68])
-    h['timestamp'] = hex_to_int(s[68:72])
-    h['bits'] = hex_to_int(s[72:76])
-    h['nonce'] = hex_to_int(s[76:80])
+    h['timestamp'] = int.from_bytes(s[68:72], 'little')
+    h['bits'] = int.from_bytes(s[72:76], 'little')
+    h['nonce'] = int.from_bytes(s[76:80], 'little')
     h['block_height'] = height
     return h
 
@@ -100,6 +104,95 @@ def hash_header(header):
     return hash_encode(Hash(bfh(serialize_header(header))))
 
 
+class HeaderStore(object):
+    '''A file of 80-byte serialized headers, read through a memory map.
+
+    Reads slice the map and so cost no system calls.  The map covers the
+    file as it was when last mapped; after the file grows it is remapped
+    lazily by the first read that needs the new data.  The map is
+    released before the file is truncated or renamed as neither is
+    possible on every platform while it is mapped.
+
+    Writes go through the file and are only fsync'ed when sync is
+    requested, so a caller storing a batch of headers pays for a single
+    fsync.  Headers can always be downloaded again, so losing unsynced
+    ones in a crash is harmless.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.map_size = 0
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.path, 'rb+')
+
+    def _unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.map_size = 0
+
+    def _remap(self):
+        self._unmap()
+        self._open()
+        size = os.fstat(self.file.fileno()).st_size
+        if size:
+            self.map = mmap.mmap(self.file.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+            self.map_size = size
+
+    def close(self):
+        '''Sync and close the file.  It is reopened by the next access.'''
+        with self.lock:
+            self._unmap()
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def size(self):
+        '''Size of the file in bytes.'''
+        with self.lock:
+            if self.file is not None:
+                return os.fstat(self.file.fileno()).st_size
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def read(self, offset, length):
+        '''Return up to length bytes at offset as a bytes object.'''
+        with self.lock:
+            if offset + length > self.map_size:
+                if self.file is None and not os.path.exists(self.path):
+                    return b''
+                self._remap()
+            if self.map is None:
+                return b''
+            return self.map[offset:offset + length]
+
+    def write(self, data, offset, sync=True):
+        '''Write data at offset.  If offset is not the end of the file the
+        file is truncated there first.'''
+        with self.lock:
+            self._open()
+            f = self.file
+            if offset != os.fstat(f.fileno()).st_size:
+                self._unmap()
+                f.seek(offset)
+                f.truncate()
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+
+
 blockchains = {}
 
 def read_blockchains(config):
@@ -143,9 +236,25 @@ class Blockchain(util.PrintError):
         self.checkpoint = checkpoint
         self.parent_id = parent_id
         self.lock = threading.Lock()
+        self.store = HeaderStore(self.path())
+        self.clear_caches()
         with self.lock:
             self.update_size()
 
+    def clear_caches(self):
+        '''Forget all cached headers and values derived from them.'''
+        self.header_cache = util.LRUCache(HEADER_CACHE_SIZE)
+        self.chunk_headers = {}
+        self.clear_derived_caches()
+
+    def clear_derived_caches(self):
+        '''Forget median time past and cumulative work values.  These may
+        depend on headers of parent branches or of the chunk being
+        verified, so are dropped whenever any of those change.'''
+        self.mtp_cache = util.LRUCache(HEADER_CACHE_SIZE)
+        # (start_height, end_height, work of blocks start+1 .. end)
+        self.work_window = None
+
     def parent(self):
         return blockchains[self.parent_id]
 
@@ -183,8 +292,7 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
-        p = self.path()
-        self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        self._size = self.store.size() // 80
 
     def verify_header(self, header, prev_header, bits):
         prev_hash = hash_header(prev_header)
@@ -202,19 +310,51 @@ class Blockchain(util.PrintError):
             raise VerifyError("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
 
     def verify_chunk(self, index, data):
+        self.set_cur_chunk(index, data)
+        try:
+            prev_hash = bytes(32)
+            if index != 0:
+                prev_hash = hash_decode(self.get_hash(index*2016 - 1))
+            self.verify_headers(index*2016, data, prev_hash)
+        finally:
+            self.set_cur_chunk(None, None)
+
+    def verify_headers(self, height, data, prev_hash):
+        '''Verify the serialized headers in data, the first of which is
+        at height and follows the block hashing to prev_hash, in internal
+        byte order.  read_header() must serve them.  Like verify_header()
+        but hashes the serialized headers directly.'''
+        fork_height = NetworkConstants.BITCOIN_CASH_FORK_BLOCK_HEIGHT
+        for n in range(len(data) // 80):
+            raw = data[n*80:(n+1)*80]
+            if raw[4:36] != prev_hash:
+                raise VerifyError("prev hash mismatch: %s vs %s"
+                                  % (hash_encode(prev_hash), hash_encode(raw[4:36])))
+            _hash = Hash(raw)
+            # checkpoint BitcoinCash fork block
+            if height + n == fork_height and hash_encode(_hash) != NetworkConstants.BITCOIN_CASH_FORK_BLOCK_HASH:
+                raise VerifyError("block at height %i is not cash chain fork block. hash %s"
+                                  % (height + n, hash_encode(_hash)))
+            header = self.read_header(height + n)
+            bits = self.get_bits(header)
+            if bits != header['bits']:
+                raise VerifyError("bits mismatch: %s vs %s" % (bits, header['bits']))
+            try:
+                target = bits_to_target(bits)
+            except AssertionError:
+                raise VerifyError("invalid bits: %s" % bits)
+            if int.from_bytes(_hash, 'little') > target:
+                raise VerifyError("insufficient proof of work: %s vs target %s"
+                                  % (int.from_bytes(_hash, 'little'), target))
+            prev_hash = _hash
+
+    def set_cur_chunk(self, index, data):
+        '''Make read_header() serve the headers of chunk index from data
+        instead of the headers file, or stop doing so if data is None.'''
         self.cur_chunk = data
         self.cur_chunk_index = index
-        num = len(data) // 80
-        prev_header = None
-        if index != 0:
-            prev_header = self.read_header(index*2016 - 1)
-        for i in range(num):
-            raw_header = data[i*80:(i+1) * 80]
-            header = deserialize_header(raw_header, index*2016 + i)
-            bits = self.get_bits(header)
-            self.verify_header(header, prev_header, bits)
-            prev_header = header
-        self.cur_chunk = None
+        self.chunk_headers = {}
+        self.clear_derived_caches()
 
     def path(self):
         d = util.get_headers_dir(self.config)
@@ -240,16 +380,15 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
-        with open(parent.path(), 'rb') as f:
-            f.seek((checkpoint - parent.checkpoint)*80)
-            parent_data = f.read(parent_branch_size*80)
+        my_data = self.store.read(0, self.size()*80)
+        parent_data = parent.store.read((checkpoint - parent.checkpoint)*80,
+                                        parent_branch_size*80)
         self.write(parent_data, 0)
         parent.write(my_data, (checkpoint - parent.checkpoint)*80)
         # store file path
         for b in blockchains.values():
             b.old_path = b.path()
+            b.store.close()
         # swap parameters
         self.parent_id = parent.parent_id; parent.parent_id = parent_id
         self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
@@ -263,33 +402,41 @@ class Blockchain(util.PrintError):
         # update pointers
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
+        # headers below the fork point of any branch may have moved
+        for b in blockchains.values():
+            b.store = HeaderStore(b.path())
+            b.clear_caches()
 
-    def write(self, data, offset):
-        filename = self.path()
+    def write(self, data, offset, sync=True):
         with self.lock:
-            with open(filename, 'rb+') as f:
-                if offset != self._size*80:
-                    f.seek(offset)
-                    f.truncate()
-                f.seek(offset)
-                f.write(data)
-                f.flush()
-                os.fsync(f.fileno())
+            self.store.write(data, offset, sync)
             self.update_size()
+        first_height = self.checkpoint + offset // 80
+        self.header_cache.discard_if(lambda height: height >= first_height)
+        for b in blockchains.values():
+            b.clear_derived_caches()
 
     def save_header(self, header):
         delta = header.get('block_height') - self.checkpoint
         data = bfh(serialize_header(header))
         assert delta == self.size()
         assert len(data) == 80
-        self.write(data, delta*80)
+        # New tips arrive one at a time; they are synced with the next
+        # chunk or when the store is closed.
+        self.write(data, delta*80, sync=False)
         self.swap_with_parent()
 
     def read_header(self, height):
+        '''Return the deserialized header at height, or None.  The result
+        is shared with the cache and must not be modified.'''
         if self.cur_chunk and (height // 2016) == self.cur_chunk_index:
-            n = height % 2016
-            h = self.cur_chunk[n * 80: (n + 1) * 80]
-            return deserialize_header(h, height)
+            header = self.chunk_headers.get(height)
+            if header is None:
+                n = height % 2016
+                h = self.cur_chunk[n * 80: (n + 1) * 80]
+                header = deserialize_header(h, height)
+                self.chunk_headers[height] = header
+            return header
         assert self.parent_id != self.checkpoint
         if height < 0:
             return
@@ -297,13 +444,29 @@ class Blockchain(util.PrintError):
             return self.parent().read_header(height)
         if height > self.height():
             return
+        header = self.header_cache.get(height)
+        if header is not None:
+            return header
         delta = height - self.checkpoint
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * 80)
-                h = f.read(80)
-            return deserialize_header(h, height)
+        h = self.store.read(delta * 80, 80)
+        if len(h) == 80:
+            header = deserialize_header(h, height)
+            self.header_cache.put(height, header)
+            return header
+
+    def read_raw_headers(self, start, end):
+        '''Return the serialized headers from start up to but excluding
+        end, those below the checkpoint being read from the parents.  It
+        stops short at the first missing header.'''
+        data = b''
+        if start < self.checkpoint:
+            data = self.parent().read_raw_headers(start, min(end, self.checkpoint))
+            if len(data) < (min(end, self.checkpoint) - start) * 80:
+                return data
+            start = self.checkpoint
+        if start < end:
+            data += self.store.read((start - self.checkpoint) * 80, (end - start) * 80)
+        return data
 
     def get_hash(self, height):
         return hash_header(self.read_header(height))
@@ -315,9 +478,41 @@ class Blockchain(util.PrintError):
     def get_median_time_past(self, height):
         if height < 0:
             return 0
-        times = [self.read_header(h)['timestamp']
-                 for h in range(max(0, height - 10), height + 1)]
-        return sorted(times)[len(times) // 2]
+        mtp = self.mtp_cache.get(height)
+        if mtp is None:
+            times = [self.read_header(h)['timestamp']
+                     for h in range(max(0, height - 10), height + 1)]
+            mtp = sorted(times)[len(times) // 2]
+            self.mtp_cache.put(height, mtp)
+        return mtp
+
+    def get_work(self, start_height, end_height):
+        '''Return the sum of the work of blocks start_height+1 up to and
+        including end_height.  Successive calls for nearby ranges, as
+        made by the DAA, only add and remove the work at the edges.'''
+        def work(lo, hi):
+            return sum(bits_to_work(self.read_header(h)['bits'])
+                       for h in range(lo + 1, hi + 1))
+
+        window = self.work_window
+        if window is None:
+            total = work(start_height, end_height)
+        else:
+            start, end, total = window
+            edges = abs(start_height - start) + abs(end_height - end)
+            if edges >= end_height - start_height:
+                total = work(start_height, end_height)
+            else:
+                if end_height >= end:
+                    total += work(end, end_height)
+                else:
+                    total -= work(end_height, end)
+                if start_height >= start:
+                    total -= work(start, start_height)
+                else:
+                    total += work(start_height, start)
+        self.work_window = (start_height, end_height, total)
+        return total
 
     def get_suitable_block_height(self, suitableheight):
 
@@ -366,12 +561,7 @@ class Blockchain(util.PrintError):
             daa_ending_height=self.get_suitable_block_height(prevheight)
 
             # calculate cumulative work (EXcluding work from block daa_starting_height, INcluding work from block daa_ending_height)
-            daa_cumulative_work=0
-            for daa_i in range (daa_starting_height+1,daa_ending_height+1):
-                daa_prior = self.read_header(daa_i)
-                daa_bits_for_a_block=daa_prior['bits']
-                daa_work_for_a_block=bits_to_work(daa_bits_for_a_block)
-                daa_cumulative_work += daa_work_for_a_block
+            daa_cumulative_work = self.get_work(daa_starting_height, daa_ending_height)
 
             # calculate and sanitize elapsed time
             daa_starting_timestamp = self.read_header(daa_starting_height)['timestamp']
@@ -460,3 +650,61 @@ class Blockchain(util.PrintError):
         except VerifyError as e:
             self.print_error('verify_chunk failed: {}'.format(e))
             return False
+
+    def connect_verified_chunk(self, idx, data, prior):
+        '''Save chunk idx, verified by verify_detached_chunk() against
+        the headers prior.  It is refused, returning False, if the header
+        before it is no longer the last of prior.'''
+        height = idx * 2016
+        if idx and self.read_raw_headers(height - 1, height) != prior[-80:]:
+            self.print_error('chunk {:d} no longer connects'.format(idx))
+            return False
+        self.save_chunk(idx, data)
+        return True
+
+
+class DetachedChain(Blockchain):
+    '''Headers held in memory, for verifying a chunk away from the
+    headers files: in a background thread or in another process.
+    read_header() serves the headers of data, the first being at
+    first_height, and nothing else.'''
+
+    def __init__(self, first_height, data):
+        self.first_height = first_height
+        self.data = data
+        self.cur_chunk = None
+        self.clear_caches()
+        # all of data is at hand, so its headers are kept without bound
+        self.headers = {}
+
+    def height(self):
+        return self.first_height + len(self.data) // 80 - 1
+
+    def read_header(self, height):
+        header = self.headers.get(height)
+        if header is None:
+            n = height - self.first_height
+            if n < 0 or height > self.height():
+                return None
+            header = deserialize_header(self.data[n*80:(n+1)*80], height)
+            self.headers[height] = header
+        return header
+
+
+def verify_detached_chunk(index, data, prior, testnet):
+    '''Verify chunk index given prior, the serialized headers before it,
+    which must include the previous chunk as the difficulty adjustment
+    looks back up to 2016 blocks.  The linkage of the chunk's first
+    header to the last of prior is checked here; that prior is still in
+    the chain is up to the caller.  Raises VerifyError.
+
+    Runs in the worker processes, so the network is passed explicitly.'''
+    if NetworkConstants.TESTNET != testnet:
+        if testnet:
+            NetworkConstants.set_testnet()
+        else:
+            NetworkConstants.set_mainnet()
+    height = index * 2016
+    chain = DetachedChain(height - len(prior) // 80, prior + data)
+    prev_hash = Hash(prior[-80:]) if prior else bytes(32)
+    chain.verify_headers(height, data, prev_hash)
@@ -22,6 +22,7 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import time
 from collections import defaultdict, namedtuple
 from math import floor, log10
 
@@ -90,9 +91,22 @@ class CoinChooserBase(PrintError):
         for key, coin in zip(keys, coins):
             buckets[key].append(coin)
 
+        # The estimated size of an input only depends on its shape, so
+        # a dummy script is serialized once per shape, not per coin
+        sizes = {}
+        def input_size(coin):
+            if coin['type'] == 'coinbase':
+                return Transaction.estimated_input_size(coin)
+            shape = (coin['type'], coin.get('num_sig', 1),
+                     len(coin.get('x_pubkeys', [None])),
+                     Transaction.estimate_pubkey_size_for_txin(coin))
+            size = sizes.get(shape)
+            if size is None:
+                size = sizes[shape] = Transaction.estimated_input_size(coin)
+            return size
+
         def make_Bucket(desc, coins):
-            size = sum(Transaction.estimated_input_size(coin)
-                       for coin in coins)
+            size = sum(input_size(coin) for coin in coins)
             value = sum(coin['value'] for coin in coins)
             return Bucket(desc, size, value, coins)
 
@@ -283,8 +297,167 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+class CoinChooserBnB(CoinChooserPrivacy):
+    '''Like CoinChooserPrivacy all coins of an address are spent
+    together, but the buckets are chosen by a depth-first branch and
+    bound search, as in Bitcoin Core, for the set paying the outputs
+    without change at the lowest cost: the fees of its inputs plus what
+    is left over.  The fee and value of each bucket are computed once
+    and the search gives up after MAX_TRIES steps or TIME_BUDGET
+    seconds.  Unless it does better, the fewest largest buckets are
+    spent and the change is kept.'''
+
+    MAX_TRIES = 100000
+    TIME_BUDGET = 0.5  # seconds
+    # the estimated size of an input spending P2PKH change
+    CHANGE_INPUT_SIZE = 148
+
+    def make_tx(self, coins, outputs, change_addrs, fee_estimator,
+                dust_threshold):
+        tx = Transaction.from_io([], outputs)
+        self.spend = (tx.estimated_size(), tx.output_value(), fee_estimator,
+                      dust_threshold)
+        return super().make_tx(coins, outputs, change_addrs, fee_estimator,
+                               dust_threshold)
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        base_size, spent_amount, fee_estimator, dust_threshold = self.spend
+        base_fee = fee_estimator(base_size)
+        target = spent_amount + base_fee
+        # The change is dropped as dust if the excess over the target
+        # does not pay for a change output and dust_threshold more
+        change_fee = fee_estimator(base_size + 34) - base_fee
+        upper = target + change_fee + dust_threshold - 1
+
+        # The fee of each bucket and what it contributes once that is
+        # paid.  Buckets that cost more than they are worth are left out.
+        fees = {}
+        for n, bucket in enumerate(buckets):
+            fee = fee_estimator(base_size + bucket.size) - base_fee
+            if bucket.value > fee:
+                fees[n] = fee
+        order = sorted(fees, key=lambda n: fees[n] - buckets[n].value)
+        values = [buckets[n].value - fees[n] for n in order]
+        fees = [fees[n] for n in order]
+        if sum(values) < target:
+            raise NotEnoughFunds()
+
+        # Change costs its output now and an input when it is spent
+        selected = self.largest_first(values, upper + 1)
+        cost = (sum(fees[i] for i in selected) + change_fee
+                + fee_estimator(base_size + self.CHANGE_INPUT_SIZE) - base_fee)
+        changeless = self.branch_and_bound(values, fees, target, upper, cost)
+        if changeless is not None:
+            selected = changeless
+        else:
+            self.print_error("no cheaper changeless solution")
+        winner = [buckets[order[i]] for i in selected]
+        if not sufficient_funds(winner):
+            # The fees of the buckets do not quite add up; spend the
+            # next largest ones too
+            chosen = set(selected)
+            for i in range(len(order)):
+                if sufficient_funds(winner):
+                    break
+                if i not in chosen:
+                    winner.append(buckets[order[i]])
+            else:
+                if not sufficient_funds(winner):
+                    raise NotEnoughFunds()
+        self.print_error("Bucket sets:", len(buckets))
+        return winner
+
+    def branch_and_bound(self, values, fees, target, upper, max_cost):
+        '''Returns the indices of the subset of values, which are in
+        descending order, with a sum in [target, upper] and the lowest
+        cost found, if that is at most max_cost, or None.  The cost of a
+        subset is the sum of its fees and the excess of its sum over
+        target.'''
+        n = len(values)
+        # remaining[i] is the sum of values[i:]
+        remaining = [0] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + values[i]
+        deadline = time.time() + self.TIME_BUDGET
+        best, best_cost = None, max_cost + 1
+        selected = []
+        total = fee = 0
+        i = 0
+        for tries in range(self.MAX_TRIES):
+            if tries & 1023 == 1023 and time.time() > deadline:
+                break
+            if (total > upper or total + remaining[i] < target
+                    or fee >= best_cost):
+                backtrack = True
+            elif total >= target:
+                backtrack = True
+                if fee + total - target < best_cost:
+                    best, best_cost = list(selected), fee + total - target
+            else:
+                backtrack = False
+            if backtrack:
+                if not selected:
+                    break
+                # Leave out the last value included.  Leaving out an
+                # equal bucket next would only repeat the same sums.
+                j = selected.pop()
+                total -= values[j]
+                fee -= fees[j]
+                i = j + 1
+                while i < n and values[i] == values[j] and fees[i] == fees[j]:
+                    i += 1
+            else:
+                selected.append(i)
+                total += values[i]
+                fee += fees[i]
+                i += 1
+        self.print_error("branch and bound: %d steps" % (tries + 1))
+        return best
+
+    def largest_first(self, values, target):
+        '''Returns the indices of the fewest of values, which are in
+        descending order, reaching target, or all of them.  A single
+        value is preferred to larger ones and smaller values replace the
+        last one when they still suffice.'''
+        # The smallest single value reaching target
+        if values and values[0] >= target:
+            lo, hi = 0, len(values) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if values[mid] >= target:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            return [lo]
+        selected = []
+        total = 0
+        for i, value in enumerate(values):
+            selected.append(i)
+            total += value
+            if total >= target:
+                break
+        else:
+            return selected
+        # Swap the last value for the smallest that still reaches target
+        rest = total - values[selected[-1]]
+        for k in range(len(values) - 1, selected[-1], -1):
+            if rest + values[k] >= target:
+                selected[-1] = k
+                break
+        return selected
+
+
+COIN_CHOOSERS = {
+    'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBnB,
+}
+
 def get_name(config):
     kind = config.get('coin_chooser')
     if not kind in COIN_CHOOSERS:
-        kind = 'Priority'
+        kind = 'Privacy'
     return kind
+
+def get_coin_chooser(config):
+    klass = COIN_CHOOSERS[get_name(config)]
+    return klass()
@@ -41,6 +41,7 @@ from .i18n import _
 from .transaction import Transaction, multisig_script
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .plugins import run_hook
+from .webhooks import check_url
 
 known_commands = {}
 
@@ -628,17 +629,10 @@ class Commands:
     @command('n')
     def notify(self, address, URL):
         """Watch an address. Everytime the address changes, a http POST is sent to the URL."""
+        check_url(URL)
+        webhooks = self.network.get_webhook_queue()
         def callback(x):
-            import urllib.request
-            headers = {'content-type':'application/json'}
-            data = {'address':address, 'status':x.get('result')}
-            serialized_data = util.to_bytes(json.dumps(data))
-            try:
-                req = urllib.request.Request(URL, serialized_data, headers)
-                response_stream = urllib.request.urlopen(req, timeout=5)
-                util.print_error('Got Response for %s' % address)
-            except BaseException as e:
-                util.print_error(str(e))
+            webhooks.post(URL, {'address': address, 'status': x.get('result')})
         h = self.network.addr_to_scripthash(address)
         self.network.send([('blockchain.scripthash.subscribe', [h])], callback)
         return True
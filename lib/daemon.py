@@ -24,11 +24,12 @@
 # SOFTWARE.
 import ast
 import os
+import threading
 import time
 
 # from jsonrpc import JSONRPCResponseManager
 import jsonrpclib
-from .jsonrpc import VerifyingJSONRPCServer
+from .jsonrpc import ThreadedJSONRPCServer
 
 from .version import PACKAGE_VERSION
 from .network import Network
@@ -129,6 +130,11 @@ class Daemon(DaemonThread):
             self.network.add_jobs([self.fx])
         self.gui = None
         self.wallets = {}
+        # serializes loading and closing wallets
+        self.wallets_lock = threading.RLock()
+        # wallet path -> lock held while a command runs on the wallet
+        self.wallet_locks = {}
+        self.wallet_locks_lock = threading.Lock()
         # Setup JSONRPC server
         self.init_server(config, fd, is_gui)
 
@@ -138,8 +144,9 @@ class Daemon(DaemonThread):
 
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
-            server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+            server = ThreadedJSONRPCServer((host, port), logRequests=False,
+                                           rpc_user=rpc_user, rpc_password=rpc_password,
+                                           workers=config.get('rpcworkers', 8))
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             self.server = None
@@ -148,7 +155,6 @@ class Daemon(DaemonThread):
         os.write(fd, bytes(repr((server.socket.getsockname(), time.time())), 'utf8'))
         os.close(fd)
         self.server = server
-        server.timeout = 0.1
         server.register_function(self.ping, 'ping')
         if is_gui:
             server.register_function(self.run_gui, 'gui')
@@ -156,12 +162,34 @@ class Daemon(DaemonThread):
             server.register_function(self.run_daemon, 'daemon')
             self.cmd_runner = Commands(self.config, None, self.network)
             for cmdname in known_commands:
-                server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+                server.register_function(self.locked_command(cmdname), cmdname)
             server.register_function(self.run_cmdline, 'run_cmdline')
 
     def ping(self):
         return True
 
+    def wallet_lock(self, wallet):
+        '''Commands on the same wallet are run one at a time; commands on
+        different wallets, or needing none, run concurrently.'''
+        with self.wallet_locks_lock:
+            path = wallet.storage.path
+            lock = self.wallet_locks.get(path)
+            if lock is None:
+                lock = self.wallet_locks[path] = threading.RLock()
+            return lock
+
+    def locked_command(self, cmdname):
+        func = getattr(self.cmd_runner, cmdname)
+        if not known_commands[cmdname].requires_wallet:
+            return func
+        def locked(*args, **kwargs):
+            wallet = self.cmd_runner.wallet
+            if wallet is None:
+                return func(*args, **kwargs)
+            with self.wallet_lock(wallet):
+                return func(*args, **kwargs)
+        return locked
+
     def run_daemon(self, config_options):
         config = SimpleConfig(config_options)
         sub = config.get('subcommand')
@@ -196,6 +224,8 @@ class Daemon(DaemonThread):
                                 for k, w in self.wallets.items()},
                     'fee_per_kb': self.config.fee_per_kb(),
                 }
+                if self.network.webhooks:
+                    response['webhooks'] = self.network.webhooks.stats()
             else:
                 response = "Daemon offline"
         elif sub == 'stop':
@@ -219,6 +249,10 @@ class Daemon(DaemonThread):
 
     def load_wallet(self, path, password):
         # wizard will be launched if we return
+        with self.wallets_lock:
+            return self._load_wallet(path, password)
+
+    def _load_wallet(self, path, password):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
@@ -249,9 +283,14 @@ class Daemon(DaemonThread):
 
     def stop_wallet(self, path):
         # Issue #659 wallet may already be stopped.
-        if path in self.wallets:
-            wallet = self.wallets.pop(path)
-            wallet.stop_threads()
+        with self.wallets_lock:
+            wallet = self.wallets.pop(path, None)
+        if wallet is not None:
+            # let a command running on the wallet finish first
+            with self.wallet_lock(wallet):
+                wallet.stop_threads()
+            with self.wallet_locks_lock:
+                self.wallet_locks.pop(path, None)
 
     def run_cmdline(self, config_options):
         password = config_options.get('password')
@@ -277,12 +316,22 @@ class Daemon(DaemonThread):
             kwargs[x] = (config_options.get(x) if x in ['password', 'new_password'] else config.get(x))
         cmd_runner = Commands(config, wallet, self.network)
         func = getattr(cmd_runner, cmd.name)
-        result = func(*args, **kwargs)
-        return result
+        if wallet is None:
+            return func(*args, **kwargs)
+        with self.wallet_lock(wallet):
+            return func(*args, **kwargs)
 
     def run(self):
+        if self.server:
+            server_thread = threading.Thread(target=self.server.serve_forever,
+                                             kwargs={'poll_interval': 0.1})
+            server_thread.daemon = True
+            server_thread.start()
         while self.is_running():
-            self.server.handle_request() if self.server else time.sleep(0.1)
+            time.sleep(0.1)
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
@@ -0,0 +1,195 @@
+# Electron Cash - lightweight Bitcoin client
+# Copyright (C) 2018 The Electron Cash Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''The public keys of the addresses of a deterministic wallet, kept in
+a binary file next to the wallet file.
+
+The file is a header followed by fixed size records, which are only
+ever appended; a later record of an address replaces the earlier ones.
+It is memory mapped when opened, and records are decoded when looked
+up.'''
+
+import mmap
+import os
+import stat
+import struct
+
+from .util import PrintError
+
+MAGIC = b'ECDC'
+VERSION = 1
+
+# magic, version, fingerprint, public keys per address, public key size
+HEADER = struct.Struct('<4sB32sBB')
+# for_change, index, hash160 of the address; the public keys follow
+RECORD = struct.Struct('<BI20s')
+
+
+class DerivationCache(PrintError):
+    '''Maps (for_change, index) to the hash160 of the address and the
+    public keys of each keystore, in hex.  With a path of None nothing
+    is read or written.  The file gets the mode of the wallet file at
+    wallet_path.
+
+    The fingerprint identifies the master public keys; a file made for
+    other keys is discarded.'''
+
+    def __init__(self, path, fingerprint, num_pubkeys, pubkey_size,
+                 wallet_path=None):
+        assert len(fingerprint) == 32
+        self.path = path
+        self.wallet_path = wallet_path
+        self.header = HEADER.pack(MAGIC, VERSION, fingerprint, num_pubkeys, pubkey_size)
+        self.num_pubkeys = num_pubkeys
+        self.pubkey_size = pubkey_size
+        self.record_size = RECORD.size + num_pubkeys * pubkey_size
+        self.mm = None
+        # (for_change, index) -> offset of the record in self.mm
+        self.offsets = {}
+        # records in self.mm replaced by later ones
+        self.dead = 0
+        # (for_change, index) -> (hash160, pubkeys) to write
+        self.pending = {}
+        if path and os.path.exists(path):
+            try:
+                self.load()
+            except Exception as e:
+                self.print_error("discarding", path, e)
+                self.clear()
+
+    def load(self):
+        self.load_mm()
+        if self.mm[:HEADER.size] != self.header:
+            raise ValueError('made for other keys')
+        # A record torn by a crash is ignored, and overwritten by the
+        # next write()
+        count = (len(self.mm) - HEADER.size) // self.record_size
+        offsets = self.offsets
+        for offset in range(HEADER.size, HEADER.size + count * self.record_size,
+                            self.record_size):
+            for_change, index, _ = RECORD.unpack_from(self.mm, offset)
+            key = (bool(for_change), index)
+            if key in offsets:
+                self.dead += 1
+            offsets[key] = offset
+
+    def load_mm(self):
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+
+    def clear(self):
+        '''Forget everything and delete the file.'''
+        self.close()
+        self.offsets = {}
+        self.pending = {}
+        self.dead = 0
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def mode(self):
+        if self.wallet_path and os.path.exists(self.wallet_path):
+            return os.stat(self.wallet_path).st_mode
+        return stat.S_IREAD | stat.S_IWRITE
+
+    def keys(self):
+        return set(self.offsets) | set(self.pending)
+
+    def get(self, for_change, index):
+        '''Returns (hash160, pubkeys) or None.'''
+        key = (for_change, index)
+        record = self.pending.get(key)
+        if record is not None:
+            return record
+        offset = self.offsets.get(key)
+        if offset is None:
+            return None
+        hash160 = RECORD.unpack_from(self.mm, offset)[2]
+        size = self.pubkey_size
+        start = offset + RECORD.size
+        pubkeys = [self.mm[i:i + size].hex()
+                   for i in range(start, start + self.num_pubkeys * size, size)]
+        return hash160, pubkeys
+
+    def put(self, for_change, index, hash160, pubkeys):
+        assert len(pubkeys) == self.num_pubkeys
+        self.pending[(for_change, index)] = (hash160, pubkeys)
+
+    def write(self):
+        '''Appends the new records to the file.  It is rewritten instead
+        once half of its records have been replaced.'''
+        if not self.path or not self.pending:
+            return
+        replaced = sum(key in self.offsets for key in self.pending)
+        if self.mm and self.dead + replaced >= max(len(self.offsets), 100):
+            self.rewrite()
+            return
+        start = HEADER.size
+        if self.mm:
+            start += (len(self.offsets) + self.dead) * self.record_size
+        self.close()
+        with open(self.path, 'r+b' if start > HEADER.size else 'wb') as f:
+            os.chmod(self.path, self.mode())
+            if start == HEADER.size:
+                f.write(self.header)
+            f.seek(start)
+            offset = start
+            for key, (hash160, pubkeys) in sorted(self.pending.items()):
+                f.write(self.pack(key, hash160, pubkeys))
+                if key in self.offsets:
+                    self.dead += 1
+                self.offsets[key] = offset
+                offset += self.record_size
+            f.truncate()
+        self.pending = {}
+        self.load_mm()
+
+    def rewrite(self):
+        records = {key: self.get(*key) for key in self.keys()}
+        self.close()
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        offsets = {}
+        with open(temp_path, 'wb') as f:
+            os.chmod(temp_path, self.mode())
+            f.write(self.header)
+            offset = HEADER.size
+            for key, (hash160, pubkeys) in sorted(records.items()):
+                f.write(self.pack(key, hash160, pubkeys))
+                offsets[key] = offset
+                offset += self.record_size
+        os.replace(temp_path, self.path)
+        self.offsets = offsets
+        self.dead = 0
+        self.pending = {}
+        self.load_mm()
+        self.print_error("rewrote", self.path, len(offsets), "records")
+
+    def pack(self, key, hash160, pubkeys):
+        for_change, index = key
+        data = b''.join(bytes.fromhex(pubkey) for pubkey in pubkeys)
+        assert len(data) == self.num_pubkeys * self.pubkey_size
+        return RECORD.pack(for_change, index, hash160) + data
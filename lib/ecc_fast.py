@@ -0,0 +1,216 @@
+# Electron Cash - lightweight Bitcoin client
+# Copyright (C) 2018 The Electron Cash Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''The EC backend of bitcoin.py on libsecp256k1, loaded through ctypes.
+The library must have been built with the recovery module.'''
+
+import ctypes
+import os
+import sys
+
+from .util import print_error
+
+SECP256K1_FLAGS_TYPE_CONTEXT = 1 << 0
+SECP256K1_FLAGS_TYPE_COMPRESSION = 1 << 1
+SECP256K1_FLAGS_BIT_CONTEXT_VERIFY = 1 << 8
+SECP256K1_FLAGS_BIT_CONTEXT_SIGN = 1 << 9
+SECP256K1_FLAGS_BIT_COMPRESSION = 1 << 8
+
+SECP256K1_CONTEXT_VERIFY = SECP256K1_FLAGS_TYPE_CONTEXT | SECP256K1_FLAGS_BIT_CONTEXT_VERIFY
+SECP256K1_CONTEXT_SIGN = SECP256K1_FLAGS_TYPE_CONTEXT | SECP256K1_FLAGS_BIT_CONTEXT_SIGN
+SECP256K1_EC_COMPRESSED = SECP256K1_FLAGS_TYPE_COMPRESSION | SECP256K1_FLAGS_BIT_COMPRESSION
+SECP256K1_EC_UNCOMPRESSED = SECP256K1_FLAGS_TYPE_COMPRESSION
+
+# The sizes of the opaque structures of the library
+PUBKEY_SIZE = 64
+SIGNATURE_SIZE = 64
+RECOVERABLE_SIGNATURE_SIZE = 65
+
+
+def _library_names():
+    if sys.platform == 'darwin':
+        names = ['libsecp256k1.0.dylib', 'libsecp256k1.dylib']
+    elif sys.platform in ('windows', 'win32'):
+        names = ['libsecp256k1-0.dll', 'libsecp256k1.dll']
+    else:
+        names = ['libsecp256k1.so.0', 'libsecp256k1.so']
+    # A library shipped with the application is preferred
+    here = os.path.dirname(os.path.realpath(__file__))
+    return [os.path.join(here, name) for name in names] + names
+
+
+def load_library():
+    for name in _library_names():
+        try:
+            lib = ctypes.cdll.LoadLibrary(name)
+            break
+        except OSError:
+            continue
+    else:
+        return None
+
+    p, c_int, c_size_t = ctypes.c_char_p, ctypes.c_int, ctypes.c_size_t
+    functions = {
+        'secp256k1_context_create': ([ctypes.c_uint], ctypes.c_void_p),
+        'secp256k1_context_randomize': ([ctypes.c_void_p, p], c_int),
+        'secp256k1_ec_pubkey_create': ([ctypes.c_void_p, p, p], c_int),
+        'secp256k1_ec_pubkey_parse': ([ctypes.c_void_p, p, p, c_size_t], c_int),
+        'secp256k1_ec_pubkey_serialize': ([ctypes.c_void_p, p, ctypes.POINTER(c_size_t), p, ctypes.c_uint], c_int),
+        'secp256k1_ec_pubkey_tweak_add': ([ctypes.c_void_p, p, p], c_int),
+        'secp256k1_ec_pubkey_tweak_mul': ([ctypes.c_void_p, p, p], c_int),
+        'secp256k1_ecdsa_sign': ([ctypes.c_void_p, p, p, p, ctypes.c_void_p, ctypes.c_void_p], c_int),
+        'secp256k1_ecdsa_verify': ([ctypes.c_void_p, p, p, p], c_int),
+        'secp256k1_ecdsa_signature_normalize': ([ctypes.c_void_p, p, p], c_int),
+        'secp256k1_ecdsa_signature_parse_compact': ([ctypes.c_void_p, p, p], c_int),
+        'secp256k1_ecdsa_signature_serialize_compact': ([ctypes.c_void_p, p, p], c_int),
+        'secp256k1_ecdsa_signature_serialize_der': ([ctypes.c_void_p, p, ctypes.POINTER(c_size_t), p], c_int),
+        'secp256k1_ecdsa_sign_recoverable': ([ctypes.c_void_p, p, p, p, ctypes.c_void_p, ctypes.c_void_p], c_int),
+        'secp256k1_ecdsa_recoverable_signature_parse_compact': ([ctypes.c_void_p, p, p, c_int], c_int),
+        'secp256k1_ecdsa_recoverable_signature_serialize_compact': ([ctypes.c_void_p, p, ctypes.POINTER(c_int), p], c_int),
+        'secp256k1_ecdsa_recover': ([ctypes.c_void_p, p, p, p], c_int),
+    }
+    try:
+        for name, (argtypes, restype) in functions.items():
+            function = getattr(lib, name)
+            function.argtypes = argtypes
+            function.restype = restype
+    except AttributeError as e:
+        print_error("[ecc] libsecp256k1 unusable:", e)
+        return None
+
+    lib.ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
+    if not lib.ctx or not lib.secp256k1_context_randomize(lib.ctx, os.urandom(32)):
+        return None
+    return lib
+
+
+class ECBackendSecp256k1(object):
+    '''See ECBackendPython in bitcoin.py for the interface.  Secrets,
+    digests and tweaks are 32 bytes.'''
+
+    name = 'libsecp256k1'
+
+    def __init__(self, lib):
+        self.lib = lib
+        self.ctx = lib.ctx
+
+    def _parse_pubkey(self, pubkey):
+        point = ctypes.create_string_buffer(PUBKEY_SIZE)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, point, pubkey, len(pubkey)):
+            raise ValueError('invalid public key')
+        return point
+
+    def _serialize_pubkey(self, point, compressed):
+        size = ctypes.c_size_t(33 if compressed else 65)
+        out = ctypes.create_string_buffer(size.value)
+        flags = SECP256K1_EC_COMPRESSED if compressed else SECP256K1_EC_UNCOMPRESSED
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, ctypes.byref(size), point, flags)
+        return out.raw[:size.value]
+
+    def _signature(self, secret, digest):
+        assert len(secret) == 32 and len(digest) == 32
+        sig = ctypes.create_string_buffer(SIGNATURE_SIZE)
+        # The default nonce is RFC 6979 and the signature has a low S
+        if not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, digest, secret, None, None):
+            raise ValueError('invalid private key')
+        return sig
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        assert len(secret) == 32
+        point = ctypes.create_string_buffer(PUBKEY_SIZE)
+        if not self.lib.secp256k1_ec_pubkey_create(self.ctx, point, secret):
+            raise ValueError('invalid private key')
+        return self._serialize_pubkey(point, compressed)
+
+    def pubkey_is_valid(self, pubkey):
+        try:
+            self._parse_pubkey(pubkey)
+        except ValueError:
+            return False
+        return True
+
+    def pubkey_add_tweak(self, pubkey, tweak, compressed=True):
+        point = self._parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, point, tweak):
+            raise ValueError('invalid tweak')
+        return self._serialize_pubkey(point, compressed)
+
+    def pubkey_multiply(self, pubkey, secret, compressed=True):
+        point = self._parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_mul(self.ctx, point, secret):
+            raise ValueError('invalid private key')
+        return self._serialize_pubkey(point, compressed)
+
+    def sign(self, secret, digest):
+        sig = self._signature(secret, digest)
+        out = ctypes.create_string_buffer(64)
+        self.lib.secp256k1_ecdsa_signature_serialize_compact(self.ctx, out, sig)
+        return out.raw
+
+    def sign_der(self, secret, digests):
+        result = []
+        for digest in digests:
+            sig = self._signature(secret, digest)
+            size = ctypes.c_size_t(72)
+            out = ctypes.create_string_buffer(size.value)
+            self.lib.secp256k1_ecdsa_signature_serialize_der(self.ctx, out, ctypes.byref(size), sig)
+            result.append(out.raw[:size.value])
+        return result
+
+    def sign_recoverable(self, secret, digest):
+        assert len(secret) == 32 and len(digest) == 32
+        sig = ctypes.create_string_buffer(RECOVERABLE_SIGNATURE_SIZE)
+        if not self.lib.secp256k1_ecdsa_sign_recoverable(self.ctx, sig, digest, secret, None, None):
+            raise ValueError('invalid private key')
+        recid = ctypes.c_int()
+        out = ctypes.create_string_buffer(64)
+        self.lib.secp256k1_ecdsa_recoverable_signature_serialize_compact(
+            self.ctx, out, ctypes.byref(recid), sig)
+        return recid.value, out.raw
+
+    def verify(self, pubkey, sig, digest):
+        try:
+            point = self._parse_pubkey(pubkey)
+        except ValueError:
+            return False
+        parsed = ctypes.create_string_buffer(SIGNATURE_SIZE)
+        if len(sig) != 64 or not self.lib.secp256k1_ecdsa_signature_parse_compact(self.ctx, parsed, sig):
+            return False
+        # Like ecdsa, accept a high S
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, parsed, parsed)
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, parsed, digest, point) == 1
+
+    def recover(self, sig, recid, digest, compressed=True):
+        parsed = ctypes.create_string_buffer(RECOVERABLE_SIGNATURE_SIZE)
+        if (len(sig) != 64 or not 0 <= recid <= 3 or
+                not self.lib.secp256k1_ecdsa_recoverable_signature_parse_compact(
+                    self.ctx, parsed, sig, recid)):
+            raise ValueError('invalid signature')
+        point = ctypes.create_string_buffer(PUBKEY_SIZE)
+        if not self.lib.secp256k1_ecdsa_recover(self.ctx, point, parsed, digest):
+            raise ValueError('cannot recover public key')
+        return self._serialize_pubkey(point, compressed)
+
+
+_libsecp256k1 = load_library()
+ec_backend = ECBackendSecp256k1(_libsecp256k1) if _libsecp256k1 else None
@@ -22,6 +22,8 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import asyncio
+import json
 import os
 import re
 import socket
@@ -248,10 +250,27 @@ class Interface(util.PrintError):
     electrum server.  It's exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+      ping_required(), queue_request(), send_requests(), start()
     - Member variable server.
+
+    Queued requests are sent as JSON-RPC batches of up to BATCH_SIZE.
+    The number of unanswered requests is limited by a window that grows
+    while responses arrive within LATENCY_TARGET seconds, and is halved
+    when they take longer.
+
+    Once start() is called the socket is served by an asyncio event
+    loop: responses are handed over as they arrive and queued requests
+    are sent on the next iteration of the loop.  Before that, or without
+    a loop, get_responses() and send_requests() are polled.
     """
 
+    BATCH_SIZE = 100
+    MIN_WINDOW = 10
+    MAX_WINDOW = 2000
+    LATENCY_TARGET = 2.0
+    # Longer lines are taken for a misbehaving server
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
     def __init__(self, server, socket):
         self.server = server
         self.host, _, _ = server.rsplit(':', 2)
@@ -263,8 +282,19 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        # wire id -> time sent, for the latency estimate
+        self.send_times = {}
+        self.window = 100
+        self.latency = None
+        self.last_window_decrease = 0
         self.last_send = time.time()
         self.closed_remotely = False
+        # set by start()
+        self.loop = None
+        self.loop_thread = None
+        self.reader_task = None
+        self.send_scheduled = False
+        self.out = bytearray()
 
     def diagnostic_name(self):
         return self.host
@@ -273,7 +303,38 @@ class Interface(util.PrintError):
         # Needed for select
         return self.socket.fileno()
 
+    def start(self, loop, on_responses):
+        '''Serve the socket from loop, which must be running in the
+        calling thread.  on_responses(interface, responses) is called from
+        the loop with the (request, response) pairs of each message, as
+        get_responses() returns them.'''
+        self.loop = loop
+        self.loop_thread = threading.current_thread()
+        self.on_responses = on_responses
+        self.socket.setblocking(False)
+        self.reader = asyncio.StreamReader(limit=self.MAX_MESSAGE_SIZE, loop=loop)
+        loop.add_reader(self.socket.fileno(), self.on_readable)
+        self.reader_task = loop.create_task(self.read_messages())
+        if self.unsent_requests:
+            self.schedule_send()
+
     def close(self):
+        if self.loop and threading.current_thread() is not self.loop_thread:
+            # the loop's callbacks are only changed from its thread
+            try:
+                self.loop.call_soon_threadsafe(self.close)
+                return
+            except RuntimeError:
+                pass    # the loop is closed
+        if self.loop:
+            if self.reader_task:
+                self.reader_task.cancel()
+            if not self.loop.is_closed():
+                self.loop.remove_reader(self.socket.fileno())
+                self.loop.remove_writer(self.socket.fileno())
+            self.loop = None
+        if self.socket.fileno() == -1:
+            return
         if not self.closed_remotely:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -287,11 +348,26 @@ class Interface(util.PrintError):
         '''
         self.request_time = time.time()
         self.unsent_requests.append(args)
+        if self.loop:
+            self.schedule_send()
+
+    def schedule_send(self):
+        if not self.send_scheduled:
+            self.send_scheduled = True
+            try:
+                self.loop.call_soon_threadsafe(self.send_queued)
+            except RuntimeError:
+                pass    # the loop is closed
+
+    def send_queued(self):
+        self.send_scheduled = False
+        if self.loop and self.num_requests():
+            self.send_requests()
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the window'''
+        n = self.window - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
@@ -299,18 +375,110 @@ class Interface(util.PrintError):
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
-        try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
-        except socket.error as e:
-            self.print_error("socket error:", e)
-            return False
+        messages = []
+        for i in range(0, n, self.BATCH_SIZE):
+            batch = [make_dict(*r) for r in wire_requests[i:i+self.BATCH_SIZE]]
+            messages.append(batch[0] if len(batch) == 1 else batch)
+        if self.loop:
+            self.write(b''.join((json.dumps(m) + '\n').encode('utf8')
+                                for m in messages))
+        else:
+            try:
+                self.pipe.send_all(messages)
+            except socket.error as e:
+                self.print_error("socket error:", e)
+                return False
         self.unsent_requests = self.unsent_requests[n:]
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = self.last_send
         return True
 
+    def write(self, data):
+        '''Send data from the loop, buffering what the socket does not
+        take at once until it is writable.'''
+        self.out += data
+        self.on_writable()
+
+    def on_writable(self):
+        try:
+            sent = self.socket.send(self.out)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            sent = 0
+        except OSError as e:
+            # the reader sees the connection go down
+            self.print_error("socket error:", e)
+            self.out = bytearray()
+            sent = 0
+        del self.out[:sent]
+        if self.out:
+            self.loop.add_writer(self.socket.fileno(), self.on_writable)
+        else:
+            self.loop.remove_writer(self.socket.fileno())
+
+    def on_readable(self):
+        '''Feed all the data available to the reader; an SSL socket may
+        have more decrypted than the next recv returns.'''
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return
+            except OSError as e:
+                self.print_error("socket error:", e)
+                data = b''
+            if not data:
+                self.loop.remove_reader(self.socket.fileno())
+                self.reader.feed_eof()
+                return
+            self.pipe.recv_time = time.time()
+            self.reader.feed_data(data)
+
+    async def read_messages(self):
+        '''Split the data of the server into messages, one per line, and
+        pass on their responses until the connection goes down.'''
+        while True:
+            try:
+                line = await self.reader.readline()
+            except ValueError:
+                self.print_error("message too long")
+                message = False
+            else:
+                if not line.endswith(b'\n'):
+                    self.closed_remotely = True
+                    message = None
+                else:
+                    try:
+                        message = json.loads(line.decode('utf8'))
+                    except ValueError:
+                        continue    # skipped, as by SocketPipe
+            responses = []
+            alive = self.match_message(message, responses)
+            try:
+                self.on_responses(self, responses)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            if not alive:
+                return
+            if self.loop and self.num_requests():
+                self.send_requests()
+
+    def update_window(self, latency):
+        '''Adjust the request window to the latency of a response.'''
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        now = time.time()
+        if self.latency <= self.LATENCY_TARGET:
+            self.window = min(self.MAX_WINDOW, self.window + 1)
+        elif now - self.last_window_decrease > self.latency:
+            # at most once per round trip
+            self.window = max(self.MIN_WINDOW, self.window // 2)
+            self.last_window_decrease = now
+
     def ping_required(self):
         '''Returns True if a ping should be sent.'''
         return time.time() - self.last_send > 300
@@ -339,27 +507,47 @@ class Interface(util.PrintError):
                 response = self.pipe.get()
             except util.timeout:
                 break
-            if not type(response) is dict:
-                responses.append((None, None))
-                if response is None:
-                    self.closed_remotely = True
-                    self.print_error("connection closed remotely")
+            if response is None:
+                self.closed_remotely = True
+            if not self.match_message(response, responses):
                 break
+        return responses
+
+    def match_message(self, message, responses):
+        '''Append the (request, response) pairs of a message of the server
+        to responses.  A message of None means the connection was closed.
+        Returns False, having appended (None, None), if the connection is
+        to be abandoned.'''
+        # the response to a batch is a list of responses
+        batch = message if type(message) is list else [message]
+        if not all(type(r) is dict for r in batch):
+            responses.append((None, None))
+            if message is None:
+                self.print_error("connection closed remotely")
+            return False
+        now = time.time()
+        for response in batch:
             if self.debug:
                 self.print_error("<--", response)
             wire_id = response.get('id', None)
+            if wire_id is None and 'error' in response:
+                # The server couldn't tell which request failed, as when it
+                # rejects a whole batch: none of them will be answered
+                self.print_error("error without an ID", response['error'])
+                responses.append((None, None))
+                return False
             if wire_id is None:  # Notification
                 responses.append((None, response))
+                continue
+            request = self.unanswered_requests.pop(wire_id, None)
+            if request:
+                responses.append((request, response))
+                self.update_window(now - self.send_times.pop(wire_id, now))
             else:
-                request = self.unanswered_requests.pop(wire_id, None)
-                if request:
-                    responses.append((request, response))
-                else:
-                    self.print_error("unknown wire ID", wire_id)
-                    responses.append((None, None)) # Signal
-                    break
-
-        return responses
+                self.print_error("unknown wire ID", wire_id)
+                responses.append((None, None)) # Signal
+                return False
+        return True
 
 
 def check_cert(host, cert):
@@ -25,6 +25,8 @@
 
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 from base64 import b64decode
+from concurrent import futures
+import socketserver
 import time
 
 from . import util
@@ -45,6 +47,9 @@ class RPCAuthUnsupportedType(Exception):
         return 'Authentication failed (only basic auth is supported)'
 
 
+KEEPALIVE_TIMEOUT = 60
+
+
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
 
@@ -54,6 +59,11 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
         self.rpc_password = rpc_password
 
         class VerifyingRequestHandler(SimpleJSONRPCRequestHandler):
+            # HTTP/1.1 keeps the connection open between requests
+            protocol_version = 'HTTP/1.1'
+            # close idle connections
+            timeout = KEEPALIVE_TIMEOUT
+
             def parse_request(myself):
                 # first, call the original implementation which returns
                 # True if all OK so far
@@ -93,3 +103,23 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
                 and util.constant_time_compare(password, self.rpc_password)):
             time.sleep(0.050)
             raise RPCAuthCredentialsInvalid()
+
+
+class ThreadedJSONRPCServer(socketserver.ThreadingMixIn, VerifyingJSONRPCServer):
+    '''Serves each connection in a thread of its own, and runs the
+    calls in a pool of `workers` threads.  The calls of a batch are run
+    one after the other, in order.'''
+
+    daemon_threads = True
+
+    def __init__(self, *args, workers, **kargs):
+        self.executor = futures.ThreadPoolExecutor(workers)
+        VerifyingJSONRPCServer.__init__(self, *args, **kargs)
+
+    def _dispatch(self, method, params, config=None):
+        return self.executor.submit(VerifyingJSONRPCServer._dispatch, self,
+                                    method, params, config).result()
+
+    def server_close(self):
+        VerifyingJSONRPCServer.server_close(self)
+        self.executor.shutdown(wait=False)
@@ -33,8 +33,13 @@ from .address import Address, PublicKey
 from .networks import NetworkConstants
 from .mnemonic import Mnemonic, load_wordlist
 from .plugins import run_hook
+from . import util
 from .util import PrintError, InvalidPassword, hfu
 
+# Ranges of at least this many public keys are derived by the worker
+# processes, if util.set_worker_processes() enabled them
+PARALLEL_DERIVATION_MIN = 1000
+
 
 class KeyStore(PrintError):
 
@@ -255,21 +260,28 @@ class Xpub:
 
     def __init__(self):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
+        # for_change -> (c, cK) of the receiving and change branches
+        self.branches = {}
 
     def get_master_public_key(self):
         return self.xpub
 
+    def get_branch(self, for_change):
+        branch = self.branches.get(for_change)
+        if branch is None:
+            _, _, _, _, c, cK = deserialize_xpub(self.xpub)
+            cK, c = CKD_pub(cK, c, int(for_change))
+            branch = self.branches[for_change] = (c, cK)
+        return branch
+
     def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        c, cK = self.get_branch(for_change)
+        return derive_child_pubkeys(c, cK, n, 1)[0]
+
+    def derive_pubkeys_range(self, for_change, start, count):
+        '''The public keys start to start + count - 1 of a branch, in hex.'''
+        c, cK = self.get_branch(for_change)
+        return derive_in_batches(derive_child_pubkeys, (c, cK), start, count)
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -319,6 +331,25 @@ class Xpub:
         return derivation
 
 
+def derive_child_pubkeys(c, cK, start, count):
+    '''The public keys of the children start to start + count - 1 of the
+    extended public key (c, cK), in hex.'''
+    return [bh2u(CKD_pub(cK, c, i)[0]) for i in range(start, start + count)]
+
+
+def derive_in_batches(f, args, start, count):
+    '''Calls f(*args, start, count), which returns a list of count public
+    keys.  Large ranges are split between the worker processes.'''
+    pool = util.get_worker_pool() if count >= PARALLEL_DERIVATION_MIN else None
+    if pool is None:
+        return f(*args, start, count)
+    size = -(-count // (4 * util.worker_processes))
+    end = start + count
+    futures = [pool.submit(f, *args, i, min(size, end - i))
+               for i in range(start, end, size)]
+    return [pubkey for future in futures for pubkey in future.result()]
+
+
 class BIP32_KeyStore(Deterministic_KeyStore, Xpub):
 
     def __init__(self, d):
@@ -428,9 +459,13 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def mpk_from_seed(klass, seed):
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        master_public_key = master_private_key.get_verifying_key().to_string()
-        return bh2u(master_public_key)
+        return bh2u(klass.master_public_key(secexp))
+
+    @classmethod
+    def master_public_key(klass, secexp):
+        order = generator_secp256k1.order()
+        secret = number_to_string(secexp % order, order)
+        return ec_backend.pubkey_from_secret(secret, False)[1:]
 
     @classmethod
     def stretch_key(self, seed):
@@ -445,15 +480,17 @@ class Old_KeyStore(Deterministic_KeyStore):
 
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
+        order = generator_secp256k1.order()
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string(bfh(mpk), curve = SECP256k1)
-        pubkey_point = master_public_key.pubkey.point + z*SECP256k1.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point(pubkey_point, curve = SECP256k1)
-        return '04' + bh2u(public_key2.to_string())
+        tweak = number_to_string(z % order, order)
+        return bh2u(ec_backend.pubkey_add_tweak(bfh('04' + mpk), tweak, False))
 
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys_range(self, for_change, start, count):
+        return derive_in_batches(derive_old_pubkeys, (self.mpk, for_change), start, count)
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
@@ -470,8 +507,7 @@ class Old_KeyStore(Deterministic_KeyStore):
 
     def check_seed(self, seed):
         secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = self.master_public_key(secexp)
         if master_public_key != bfh(self.mpk):
             print_error('invalid password (mpk)', self.mpk, bh2u(master_public_key))
             raise InvalidPassword()
@@ -707,6 +743,11 @@ def is_old_mpk(mpk):
     return len(mpk) == 128
 
 
+def derive_old_pubkeys(mpk, for_change, start, count):
+    return [Old_KeyStore.get_pubkey_from_mpk(mpk, for_change, i)
+            for i in range(start, start + count)]
+
+
 def is_address_list(text):
     parts = text.split()
     return parts and all(Address.is_valid(x) for x in parts)
@@ -21,18 +21,18 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import asyncio
 import time
 import queue
 import os
 import stat
-import errno
 import random
 import re
-import select
 from collections import defaultdict
 import threading
 import socket
 import json
+from concurrent import futures
 
 import socks
 from . import util
@@ -41,6 +41,7 @@ from .bitcoin import *
 from .networks import NetworkConstants
 from .interface import Connection, Interface
 from . import blockchain
+from .webhooks import WebhookQueue
 from .version import PACKAGE_VERSION, PROTOCOL_VERSION
 
 
@@ -101,6 +102,12 @@ def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
 
 from .simple_config import SimpleConfig
 
+# Chunks of headers requested ahead of the first one not connected;
+# config key 'chunk_window'
+CHUNK_WINDOW = 16
+# Seconds between runs of the connection maintenance and of the jobs
+MAINTENANCE_INTERVAL = 0.1
+
 proxy_modes = ['socks4', 'socks5', 'http']
 
 
@@ -149,11 +156,50 @@ def serialize_server(host, port, protocol):
     return str(':'.join([host, port, protocol]))
 
 
+class ChunkDownload(object):
+    '''The chunks of headers of the catch up of interface.  They are
+    requested from any interface following the same chain, verified once
+    the chunk before them has arrived, and connected in order.'''
+
+    def __init__(self, interface, first):
+        self.interface = interface
+        self.blockchain = interface.blockchain
+        # first chunk not connected yet, and first not requested yet
+        self.connected = first
+        self.next = first
+        # index -> (interface, least number of headers it must return)
+        self.requested = {}
+        # index -> (data, interface), waiting for the chunk before it
+        self.received = {}
+        # (index, data, prior, future, interface) of the chunks from
+        # self.connected on, being verified
+        self.verifying = []
+
+    def busy(self):
+        '''The indices of the chunks requested and not connected yet.'''
+        busy = set(self.requested) | set(self.received)
+        busy.update(chunk[0] for chunk in self.verifying)
+        return busy
+
+    def requeue(self):
+        '''Verify the chunks being verified again.'''
+        for index, data, prior, future, interface in self.verifying:
+            future.cancel()
+            self.received[index] = data, interface
+        self.verifying = []
+
+    def cancel(self):
+        for chunk in self.verifying:
+            chunk[3].cancel()
+        self.verifying = []
+
+
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
     Connections are initiated by a Connection() thread which stops once
-    the connection succeeds or fails.
+    the connection succeeds or fails.  Connected sockets are served by an
+    asyncio event loop running in the network thread.
 
     Our external API:
 
@@ -220,6 +266,14 @@ class Network(util.DaemonThread):
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
         self.socket_queue = queue.Queue()
+        # verifies chunks of headers when there are no worker processes
+        self.chunk_executor = None
+        self.chunk_downloads = []
+        self.banned_servers = set()
+        # delivers the notifications of the notify command
+        self.webhooks = None
+        # the event loop of the network thread, while it runs
+        self.loop = None
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
@@ -262,6 +316,21 @@ class Network(util.DaemonThread):
         except:
             pass
 
+    def webhooks_file(self):
+        return os.path.join(self.config.path, "webhooks")
+
+    def get_webhook_queue(self):
+        with self.lock:
+            if self.webhooks is None:
+                config = self.config
+                self.webhooks = WebhookQueue(
+                    self.webhooks_file() if config.path else None,
+                    workers=config.get('webhook_workers', 4),
+                    max_pending=config.get('webhook_queue_size', 1000),
+                    per_url=config.get('webhook_connections', 2),
+                    retries=config.get('webhook_retries', 5))
+            return self.webhooks
+
     def get_server_height(self):
         return self.interface.tip if self.interface else 0
 
@@ -379,7 +448,7 @@ class Network(util.DaemonThread):
             c = Connection(server, self.socket_queue, self.config.path)
 
     def start_random_interface(self):
-        exclude_set = self.disconnected_servers.union(set(self.interfaces))
+        exclude_set = self.disconnected_servers.union(set(self.interfaces), self.banned_servers)
         server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
         if server:
             self.start_interface(server)
@@ -564,8 +633,7 @@ class Network(util.DaemonThread):
         """ hashable index for subscriptions and cache"""
         return str(method) + (':' + str(params[0]) if params else '')
 
-    def process_responses(self, interface):
-        responses = interface.get_responses()
+    def process_responses(self, interface, responses):
         for request, response in responses:
             if request:
                 method, params, message_id = request
@@ -624,6 +692,17 @@ class Network(util.DaemonThread):
         messages = list(messages)
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.call_soon(self.process_pending_sends)
+
+    def call_soon(self, callback):
+        '''Have the network thread call callback without waiting for the
+        next maintenance.  May be called from any thread.'''
+        loop = self.loop
+        if loop:
+            try:
+                loop.call_soon_threadsafe(callback)
+            except RuntimeError:
+                pass    # the loop is closed
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -686,6 +765,7 @@ class Network(util.DaemonThread):
         interface.tip = 0
         interface.mode = 'default'
         interface.request = None
+        interface.start(self.loop, self.process_responses)
         self.interfaces[server] = interface
         # server.version should be the first message
         params = [PACKAGE_VERSION, PROTOCOL_VERSION]
@@ -748,8 +828,54 @@ class Network(util.DaemonThread):
         interface.request = idx
         interface.req_time = time.time()
 
+    def get_chunk_executor(self):
+        pool = util.get_worker_pool()
+        if pool:
+            return pool
+        if self.chunk_executor is None:
+            self.chunk_executor = futures.ThreadPoolExecutor(1)
+        return self.chunk_executor
+
+    def start_chunk_download(self, interface, index):
+        '''Catch up interface's chain from chunk index on, in chunks
+        requested from every interface following that chain.'''
+        interface.request = None
+        download = ChunkDownload(interface, index)
+        self.chunk_downloads.append(download)
+        self.schedule_chunks(download)
+
+    def schedule_chunks(self, download):
+        '''Request the missing chunks of download, and the next ones up
+        to the chunk window, from the idle interfaces that have them.'''
+        leader = download.interface
+        window = self.config.get('chunk_window', CHUNK_WINDOW)
+        last = leader.tip // 2016
+        # an interface doing something else answers with something else
+        for index, (interface, count) in list(download.requested.items()):
+            if (interface.request != index
+                    or self.interfaces.get(interface.server) is not interface):
+                del download.requested[index]
+        busy = download.busy()
+        indices = [i for i in range(download.connected, download.next) if i not in busy]
+        indices += range(download.next, min(last + 1, download.connected + window))
+        idle = [i for i in self.interfaces.values()
+                if i.request is None and i.blockchain is download.blockchain
+                and (i is leader or i.mode == 'default')]
+        for index in indices:
+            height = min((index + 1) * 2016 - 1, leader.tip)
+            candidates = [i for i in idle if i.tip >= height]
+            if not candidates:
+                break
+            interface = leader if leader in candidates else random.choice(candidates)
+            idle.remove(interface)
+            self.request_chunk(interface, index)
+            download.requested[index] = interface, height - index * 2016 + 1
+            download.next = max(download.next, index + 1)
+
     def on_block_headers(self, interface, response):
-        '''Handle receiving a chunk of block headers'''
+        '''Handle receiving a chunk of block headers.  It is verified in
+        the background once the chunk before it has arrived, and meanwhile
+        more are requested.  process_chunks() connects them in order.'''
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
@@ -758,22 +884,96 @@ class Network(util.DaemonThread):
             return
         # Ignore unsolicited chunks
         index = interface.request
-        if index * 2016 != params[0]:
+        if index is None or index * 2016 != params[0]:
             return
-        hexdata = result['hex']
-        connect = interface.blockchain.connect_chunk(index, hexdata)
-        # If not finished, get the next chunk
-        if not connect:
-            self.connection_down(interface.server)
+        interface.request = None
+        for download in self.chunk_downloads:
+            if download.requested.get(index, (None,))[0] is interface:
+                break
+        else:
             return
-        if interface.blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
+        count = download.requested.pop(index)[1]
+        data = bfh(result['hex'])
+        if len(data) % 80 or len(data) // 80 < count:
+            interface.print_error('chunk {:d} is {:d} bytes'.format(index, len(data)))
+            self.ban_server(interface.server)
         else:
-            interface.request = None
-            interface.mode = 'default'
-            interface.print_error('catch up done', interface.blockchain.height())
-            interface.blockchain.catch_up = None
-        self.notify('updated')
+            download.received[index] = data, interface
+            self.verify_chunks(download)
+        self.schedule_chunks(download)
+
+    def verify_chunks(self, download):
+        '''Submit the received chunks that follow the connected or
+        verifying ones for verification.'''
+        while True:
+            index = download.connected + len(download.verifying)
+            if index not in download.received:
+                return
+            if download.verifying:
+                # the previous chunk is still being verified
+                prior = download.verifying[-1][1]
+                if len(prior) < 2016 * 80:
+                    return    # it is requested again in full
+            else:
+                prior = download.blockchain.read_raw_headers(max(0, index - 1) * 2016, index * 2016)
+            data, interface = download.received.pop(index)
+            future = self.get_chunk_executor().submit(
+                blockchain.verify_detached_chunk, index, data, prior,
+                NetworkConstants.TESTNET)
+            future.add_done_callback(lambda f: self.call_soon(self.process_chunks))
+            download.verifying.append((index, data, prior, future, interface))
+
+    def process_chunks(self):
+        '''Connect the chunks of headers verified in the background, in
+        order.  A server whose chunk fails verification is banned and
+        the chunk requested from another.'''
+        for download in list(self.chunk_downloads):
+            leader = download.interface
+            if self.interfaces.get(leader.server) is not leader:
+                download.cancel()
+                self.chunk_downloads.remove(download)
+                continue
+            connected = False
+            while download.verifying and download.verifying[0][3].done():
+                index, data, prior, future, interface = download.verifying[0]
+                error = future.exception()
+                if error is None:
+                    if not download.blockchain.connect_verified_chunk(index, data, prior):
+                        # the chain changed; verify again against it
+                        download.requeue()
+                        break
+                    download.verifying.pop(0)
+                    # a short chunk is requested again once the tip has moved
+                    download.connected = index + (len(data) == 2016 * 80)
+                    connected = True
+                    continue
+                interface.print_error('verify_chunk {:d} failed: {}'.format(index, error))
+                download.verifying.pop(0)
+                # the chunks after it were verified against it
+                download.requeue()
+                self.ban_server(interface.server)
+                break
+            if connected:
+                self.notify('updated')
+            if self.interfaces.get(leader.server) is not leader:
+                continue
+            if not download.busy() and (download.blockchain.height() >= leader.tip
+                                        or download.connected > leader.tip // 2016):
+                self.chunk_downloads.remove(download)
+                leader.mode = 'default'
+                leader.print_error('catch up done', download.blockchain.height())
+                download.blockchain.catch_up = None
+                self.notify('updated')
+                continue
+            self.verify_chunks(download)
+            self.schedule_chunks(download)
+
+    def ban_server(self, server):
+        '''Disconnect a misbehaving server and do not connect to it again
+        in this session.'''
+        self.print_error('banning', server)
+        self.banned_servers.add(server)
+        self.connection_down(server)
 
     def request_header(self, interface, height):
         #interface.print_error("requesting header %d" % height)
@@ -889,7 +1089,7 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height:
             if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // 2016)
+                self.start_chunk_download(interface, next_height // 2016)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -906,27 +1106,20 @@ class Network(util.DaemonThread):
                 self.connection_down(interface.server)
                 continue
 
-    def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
+    def maintain(self):
+        '''Run from the event loop every MAINTENANCE_INTERVAL seconds.
+        Responses and sends are handled as they come by the loop.'''
+        if not self.is_running():
+            self.loop.stop()
             return
-        rin = [i for i in self.interfaces.values()]
-        win = [i for i in self.interfaces.values() if i.num_requests()]
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
-        except socket.error as e:
-            # TODO: py3, get code from e
-            code = None
-            if code == errno.EINTR:
-                return
-            raise
-        assert not xout
-        for interface in wout:
-            interface.send_requests()
-        for interface in rout:
-            self.process_responses(interface)
+            self.maintain_sockets()
+            self.maintain_requests()
+            self.process_chunks()
+            self.run_jobs()    # Synchronizer and Verifier
+            self.process_pending_sends()
+        finally:
+            self.loop.call_later(MAINTENANCE_INTERVAL, self.maintain)
 
     def init_headers_file(self):
         b = self.blockchains[0]
@@ -934,6 +1127,8 @@ class Network(util.DaemonThread):
             self.downloading_headers = False
             return
         filename = b.path()
+        # the file is replaced below
+        b.store.close()
         def download_thread():
             try:
                 import urllib.request, socket
@@ -946,6 +1141,8 @@ class Network(util.DaemonThread):
                 self.print_error("download failed. creating file", filename)
                 open(filename, 'wb+').close()
             b = self.blockchains[0]
+            b.store.close()
+            b.clear_caches()
             with b.lock: b.update_size()
             self.downloading_headers = False
         self.downloading_headers = True
@@ -954,16 +1151,29 @@ class Network(util.DaemonThread):
         t.start()
 
     def run(self):
+        if self.config.path and os.path.exists(self.webhooks_file()):
+            # deliver the notifications left from the last run
+            self.get_webhook_queue()
         self.init_headers_file()
         while self.is_running() and self.downloading_headers:
             time.sleep(1)
-        while self.is_running():
-            self.maintain_sockets()
-            self.wait_on_sockets()
-            self.maintain_requests()
-            self.run_jobs()    # Synchronizer and Verifier
-            self.process_pending_sends()
+        # the interfaces need add_reader() and add_writer(), which the
+        # default loop on Windows doesn't have
+        loop = asyncio.SelectorEventLoop()
+        self.loop = loop
+        loop.call_soon(self.maintain)
+        loop.run_forever()
         self.stop_network()
+        # let the readers of the closed interfaces finish
+        loop.run_until_complete(asyncio.sleep(0))
+        self.loop = None
+        loop.close()
+        if self.chunk_executor:
+            self.chunk_executor.shutdown(wait=False)
+        if self.webhooks:
+            self.webhooks.stop()
+        for b in self.blockchains.values():
+            b.store.close()
         self.on_stop()
 
     def on_notify_header(self, interface, header_dict):
@@ -1037,11 +1247,12 @@ class Network(util.DaemonThread):
         return self.blockchain().height()
 
     def synchronous_get(self, request, timeout=30):
-        q = queue.Queue()
-        self.send([request], q.put)
+        future = futures.Future()
+        # a subscription calls back again on each notification
+        self.send([request], lambda r: future.done() or future.set_result(r))
         try:
-            r = q.get(True, timeout)
-        except queue.Empty:
+            r = future.result(timeout)
+        except futures.TimeoutError:
             raise BaseException('Server did not answer')
         if r.get('error'):
             raise BaseException(r.get('error'))
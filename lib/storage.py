@@ -61,6 +61,11 @@ def multisig_type(wallet_type):
 
 
 class WalletStorage(PrintError):
+    '''The wallet file is a snapshot of the data dict.  Changes made
+    after it was written are appended to a journal next to it, one line
+    per write(), and the two are merged into a new snapshot once the
+    journal outgrows the snapshot.  Files written by older versions are
+    snapshots without a journal.'''
 
     def __init__(self, path, manual_upgrades=False):
         self.print_error("wallet path", path)
@@ -70,19 +75,27 @@ class WalletStorage(PrintError):
         self.path = path
         self.modified = False
         self.pubkey = None
+        # key -> set of the changed items of a dict value, or None if
+        # the whole value is to be journaled
+        self.journal_changes = {}
+        self.journal_size = 0
+        # the snapshot the journal applies to
+        self.snapshot_hash = None
+        self.snapshot_pubkey = None
         if self.file_exists():
             try:
                 with open(self.path, "r") as f:
                     self.raw = f.read()
             except UnicodeDecodeError as e:
                 raise IOError("Error reading file: "+ str(e))
+            self.snapshot_hash = self.hash_snapshot(self.raw)
             if not self.is_encrypted():
                 self.load_data(self.raw)
         else:
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
-    def load_data(self, s):
+    def load_data(self, s, ec_key=None):
         try:
             self.data = json.loads(s)
         except:
@@ -100,6 +113,8 @@ class WalletStorage(PrintError):
                     self.print_error('Failed to convert label to json format', key)
                     continue
                 self.data[key] = value
+        self.snapshot_pubkey = self.pubkey
+        self.replay_journal(ec_key)
 
         # check here if I need to load a plugin
         t = self.get('wallet_type')
@@ -121,6 +136,22 @@ class WalletStorage(PrintError):
     def file_exists(self):
         return self.path and os.path.exists(self.path)
 
+    def journal_path(self):
+        return self.path + '.journal'
+
+    def derivations_path(self):
+        return self.path + '.derivations'
+
+    def delete(self):
+        '''Deletes the wallet file and the files kept next to it.'''
+        for path in (self.path, self.journal_path(), self.derivations_path()):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def hash_snapshot(s):
+        return hashlib.sha256(s.encode('utf8')).hexdigest()
+
     def get_key(self, password):
         secret = pbkdf2.PBKDF2(password, '', iterations = 1024, macmodule = hmac, digestmodule = hashlib.sha512).read(64)
         ec_key = bitcoin.EC_KEY(secret)
@@ -131,7 +162,7 @@ class WalletStorage(PrintError):
         s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
         self.pubkey = ec_key.get_public_key()
         s = s.decode('utf8')
-        self.load_data(s)
+        self.load_data(s, ec_key)
 
     def set_password(self, password, encrypt):
         self.put('use_encryption', bool(password))
@@ -150,33 +181,80 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
-    def put(self, key, value):
-        try:
-            json.dumps(key)
-            json.dumps(value)
-        except:
-            self.print_error("json error: cannot save", key)
-            return
+    def peek(self, key, default=None):
+        '''Like get, but returns the stored value itself rather than a
+        copy.  The caller must not modify it.'''
+        with self.lock:
+            v = self.data.get(key)
+        return default if v is None else v
+
+    def put(self, key, value, owned=False):
+        '''Store a copy of value under key.  With owned=True value is
+        stored as it is, without a copy or a check that it can be saved
+        as JSON; the caller must not modify it afterwards.'''
+        if not owned:
+            try:
+                json.dumps(key)
+                json.dumps(value)
+            except:
+                self.print_error("json error: cannot save", key)
+                return
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old = self.data.get(key)
+                if old != value:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    self.note_change(key, old, value)
+                    self.data[key] = value if owned else copy.deepcopy(value)
             elif key in self.data:
                 self.modified = True
+                self.journal_changes[key] = None
                 self.data.pop(key)
 
+    def note_change(self, key, old, new):
+        '''Record what changed for the next journal entry.  Of values
+        that stay dicts only the changed items are journaled.'''
+        if (isinstance(old, dict) and isinstance(new, dict)
+                and self.journal_changes.get(key, ()) is not None):
+            items = self.journal_changes.setdefault(key, set())
+            items.update(k for k, v in new.items()
+                         if k not in old or old[k] != v)
+            items.update(k for k in old if k not in new)
+        else:
+            self.journal_changes[key] = None
+
     @profiler
     def write(self):
         with self.lock:
             self._write()
 
-    def _write(self):
+    def _write(self, compact=False):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write wallet')
             return
         if not self.modified:
             return
+        if compact or self.requires_compaction():
+            self.write_snapshot()
+        else:
+            self.append_journal()
+        self.modified = False
+
+    def compact(self):
+        '''Fold the journal into the wallet file, leaving a single file
+        that can be copied or opened by older versions.'''
+        with self.lock:
+            if self.modified or self.journal_size:
+                self.modified = True
+                self._write(compact=True)
+
+    def requires_compaction(self):
+        return (not self.file_exists()
+                or self.snapshot_hash is None
+                or self.pubkey != self.snapshot_pubkey
+                or self.journal_size > len(self.raw))
+
+    def write_snapshot(self):
         s = json.dumps(self.data, indent=4, sort_keys=True)
         if self.pubkey:
             s = bytes(s, 'utf8')
@@ -199,8 +277,99 @@ class WalletStorage(PrintError):
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
         self.raw = s
+        self.snapshot_hash = self.hash_snapshot(s)
+        self.snapshot_pubkey = self.pubkey
+        # Should we crash before this, the old journal will not match the
+        # new snapshot and is discarded on the next load
+        if os.path.exists(self.journal_path()):
+            os.remove(self.journal_path())
+        self.journal_size = 0
+        self.journal_changes = {}
         self.print_error("saved", self.path)
-        self.modified = False
+
+    def append_journal(self):
+        entry = {'put': {}, 'set': {}, 'del': {}}
+        for key, items in self.journal_changes.items():
+            value = self.data.get(key)
+            if items is None:
+                entry['put'][key] = value
+            else:
+                entry['set'][key] = {k: value[k] for k in items if k in value}
+                entry['del'][key] = {k: None for k in items if k not in value}
+        line = json.dumps(entry, sort_keys=True).encode('utf8')
+        if self.pubkey:
+            line = bitcoin.encrypt_message(zlib.compress(line), self.pubkey)
+        line += b'\n'
+        path = self.journal_path()
+        if self.journal_size == 0 or not os.path.exists(path):
+            header = json.dumps({'snapshot': self.snapshot_hash})
+            line = header.encode('utf8') + b'\n' + line
+            mode = 'wb'
+        else:
+            mode = 'ab'
+        with open(path, mode) as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            self.journal_size = f.tell()
+        os.chmod(path, os.stat(self.path).st_mode)
+        self.journal_changes = {}
+        self.print_error("journaled", path)
+
+    def replay_journal(self, ec_key=None):
+        '''Apply the journal of the snapshot just loaded.  An entry torn by
+        a crash during write() is dropped, together with anything after
+        it.'''
+        self.journal_size = 0
+        if not self.path or not os.path.exists(self.journal_path()):
+            return
+        path = self.journal_path()
+        with open(path, 'rb') as f:
+            lines = f.read().split(b'\n')
+        try:
+            header = json.loads(lines[0].decode('utf8'))
+            if header.get('snapshot') != self.snapshot_hash:
+                raise ValueError('journal of another snapshot')
+        except Exception as e:
+            self.print_error("discarding journal", path, e)
+            os.remove(path)
+            return
+        size = len(lines[0]) + 1
+        count = 0
+        # a complete journal ends with a newline, so the last item is empty
+        for line in lines[1:-1]:
+            try:
+                s = line
+                if ec_key:
+                    s = zlib.decompress(ec_key.decrypt_message(s))
+                entry = json.loads(s.decode('utf8'))
+            except Exception as e:
+                self.print_error("ignoring damaged journal entry", e)
+                break
+            self.apply_journal_entry(entry)
+            size += len(line) + 1
+            count += 1
+        if size < os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        self.journal_size = size
+        self.print_error("replayed %d journal entries" % count)
+
+    def apply_journal_entry(self, entry):
+        for key, value in entry.get('put', {}).items():
+            if value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = value
+        for key, items in entry.get('set', {}).items():
+            d = self.data.get(key)
+            if not isinstance(d, dict):
+                d = self.data[key] = {}
+            d.update(items)
+        for key, items in entry.get('del', {}).items():
+            d = self.data.get(key, {})
+            for k in items:
+                d.pop(k, None)
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -39,6 +39,9 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
+    History requests are collected while responses are processed and
+    sent together from run(), most recently active addresses first.
+
     External interface: __init__() and add() member functions.
     '''
 
@@ -49,6 +52,8 @@ class Synchronizer(ThreadJob):
         # Entries are (tx_hash, tx_height) tuples
         self.requested_tx = {}
         self.requested_histories = {}
+        # scripthash -> sort key of history requests not yet sent
+        self.pending_histories = {}
         self.requested_hashes = set()
         self.h2addr = {}
         self.lock = Lock()
@@ -99,11 +104,35 @@ class Synchronizer(ThreadJob):
         if self.get_status(history) != result:
             if self.requested_histories.get(scripthash) is None:
                 self.requested_histories[scripthash] = result
-                self.network.request_scripthash_history(scripthash,
-                                                        self.on_address_history)
+                self.pending_histories[scripthash] = \
+                    self.history_priority(scripthash, history)
         # remove addr from list only after it is added to requested_histories
         self.requested_hashes.discard(scripthash)  # Notifications won't be in
 
+    def history_priority(self, scripthash, history):
+        '''Sort key of a history request.  Changes notified after the
+        initial subscription come first, then addresses by the height
+        they were last active at, unconfirmed activity being the most
+        recent.'''
+        notified = scripthash not in self.requested_hashes
+        heights = [height for tx_hash, height in history]
+        if not heights:
+            recency = -1
+        elif min(heights) <= 0:
+            recency = float('inf')
+        else:
+            recency = max(heights)
+        return not notified, -recency
+
+    def send_pending_histories(self):
+        if not self.pending_histories:
+            return
+        pending = sorted(self.pending_histories,
+                         key=self.pending_histories.get)
+        self.pending_histories = {}
+        self.network.send([('blockchain.scripthash.get_history', [sh])
+                           for sh in pending], self.on_address_history)
+
     def on_address_history(self, response):
         params, result = self.parse_response(response)
         if not params:
@@ -196,7 +225,10 @@ class Synchronizer(ThreadJob):
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
 
-        # 3. Detect if situation has changed
+        # 3. Request histories of the addresses that changed
+        self.send_pending_histories()
+
+        # 4. Detect if situation has changed
         up_to_date = self.is_up_to_date()
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
@@ -1,4 +1,6 @@
 import base64
+import copy
+import pickle
 import unittest
 import sys
 from ecdsa.util import number_to_string
@@ -9,10 +11,11 @@ from lib.bitcoin import (
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
-    var_int, op_push, regenerate_key,
+    var_int, var_int_bytes, int_to_hex, op_push, regenerate_key,
     verify_message, deserialize_privkey, serialize_privkey,
     is_minikey, is_compressed, is_xpub,
-    xpub_type, is_xprv, is_bip32_derivation, seed_type)
+    xpub_type, is_xprv, is_bip32_derivation, seed_type, ECBackendPython)
+from lib import ecc_fast
 from lib.networks import NetworkConstants
 from lib.util import bfh
 
@@ -133,6 +136,13 @@ class Test_bitcoin(unittest.TestCase):
         self.assertEqual(var_int(0xffffffff), "feffffffff")
         self.assertEqual(var_int(0x100000000), "ff0000000001000000")
         self.assertEqual(var_int(0x0123456789abcdef), "ffefcdab8967452301")
+        for i in (0, 0xfd, 0x10000, 0x100000000):
+            self.assertEqual(var_int_bytes(i).hex(), var_int(i))
+
+    def test_int_to_hex(self):
+        self.assertEqual(int_to_hex(1), '01')
+        self.assertEqual(int_to_hex(0x1234, 4), '34120000')
+        self.assertEqual(int_to_hex(0xffffffff, 4), 'ffffffff')
 
     def test_op_push(self):
         self.assertEqual(op_push(0x00), '00')
@@ -308,6 +318,129 @@ class Test_keyImport(unittest.TestCase):
                              is_compressed(priv_details['priv']))
 
 
+class Test_Address(unittest.TestCase):
+
+    legacy = '1BpEi6DfDAUFd7GtittLSdBeYJvcoaVggu'
+    cashaddr = 'qpm2qsznhks23z7629mms6s4cwef74vcwvy22gdx6a'
+
+    def test_value_semantics(self):
+        addr = Address.from_string(self.legacy)
+        other = Address(bytes(addr.hash160), addr.kind)
+        self.assertIsNot(addr, other)
+        self.assertEqual(addr, other)
+        self.assertEqual(hash(addr), hash(other))
+        self.assertEqual(len({addr, other}), 1)
+        self.assertNotEqual(addr, Address(addr.hash160, Address.ADDR_P2SH))
+        self.assertLess(Address.from_P2PKH_hash(bytes(20)), addr)
+        self.assertIs(copy.deepcopy(addr), addr)
+        self.assertEqual(pickle.loads(pickle.dumps(addr)), addr)
+        with self.assertRaises(AttributeError):
+            addr.kind = Address.ADDR_P2SH
+        with self.assertRaises(AttributeError):
+            addr.label = 'x'
+
+    def test_encodings(self):
+        addr = Address.from_P2PKH_hash(bfh('76a04053bda0a88bda5177b86a15c3b29f559873'))
+        self.assertEqual(addr.to_storage_string(), self.legacy)
+        self.assertEqual(addr.to_cashaddr(), self.cashaddr)
+        self.assertEqual(addr.to_string(Address.FMT_BITPAY),
+                         'CTH8H8Zj6DSnXFBKQeDG28ogAS92iS16Bp')
+        # cached encodings follow the network
+        NetworkConstants.set_testnet()
+        try:
+            self.assertEqual(addr.to_storage_string(),
+                             'mrLC19Je2BuWQDkWSTriGYPyQJXKkkBmCx')
+            self.assertEqual(addr.to_cashaddr(),
+                             'qpm2qsznhks23z7629mms6s4cwef74vcwvqcw003ap')
+        finally:
+            NetworkConstants.set_mainnet()
+        self.assertEqual(addr.to_storage_string(), self.legacy)
+        self.assertEqual(addr.to_cashaddr(), self.cashaddr)
+
+    def test_from_string_interned(self):
+        addr = Address.from_P2PKH_hash(bytes(range(20)))
+        self.assertIs(Address.from_string(addr.to_storage_string()), addr)
+        self.assertIs(Address.from_string(addr.to_cashaddr()), addr)
+        full = addr.to_full_string(Address.FMT_CASHADDR)
+        parsed = Address.from_string(full)
+        self.assertEqual(parsed, addr)
+        self.assertIs(Address.from_string(full), parsed)
+        # a mainnet string parsed before is not valid on testnet
+        Address.from_string(self.cashaddr)
+        NetworkConstants.set_testnet()
+        try:
+            self.assertRaises(Exception, Address.from_string, self.cashaddr)
+        finally:
+            NetworkConstants.set_mainnet()
+
+
+class Test_ECBackends(unittest.TestCase):
+    '''The same vectors for every available EC backend.'''
+
+    secret = bfh('2bb80d537b1da3e38bd30361aa855686bde0eacd7162fef6a25fe97bf527a25b')  # sha256(b'secret')
+    digest = bfh('ab530a13e45914982b79f9b7e3fba994cfd1f3fb22f71cea1afbf02b460c6d1d')  # sha256(b'message')
+    pubkey = bfh('03a02b9d5fdd1307c2ee4652ba54d492d1fd11a7d1bb3f3a44c4a05e79f19de933')
+    sig = bfh('2f43daad19f64dd114d55c1488e4ecaee1ce79183008e21e663e24dc882c9b9d'
+              '23d0f4e9f63ac43404625b43dbd8df77a774b9e9f33e0d8ff569f6b6b5014e38')
+    G = bfh('0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
+    G2 = bfh('02c6047f9441ed7d6d3045406e95c07cd85c778e4b8cef3ca7abac09b95c709ee5')
+
+    def backends(self):
+        backends = [ECBackendPython()]
+        if ecc_fast.ec_backend:
+            backends.append(ecc_fast.ec_backend)
+        return backends
+
+    def test_pubkeys(self):
+        one, two = (1).to_bytes(32, 'big'), (2).to_bytes(32, 'big')
+        for b in self.backends():
+            self.assertEqual(b.pubkey_from_secret(self.secret), self.pubkey)
+            self.assertEqual(b.pubkey_from_secret(one), self.G)
+            uncompressed = b.pubkey_from_secret(self.secret, False)
+            self.assertEqual(uncompressed[:33], b'\x04' + self.pubkey[1:])
+            self.assertEqual(b.pubkey_add_tweak(self.G, one), self.G2)
+            self.assertEqual(b.pubkey_add_tweak(uncompressed, one),
+                             b.pubkey_from_secret(
+                                 (int.from_bytes(self.secret, 'big') + 1).to_bytes(32, 'big')))
+            self.assertEqual(b.pubkey_multiply(self.G, two), self.G2)
+            self.assertEqual(b.pubkey_multiply(self.pubkey, two),
+                             b.pubkey_add_tweak(self.pubkey, self.secret))
+            self.assertTrue(b.pubkey_is_valid(self.pubkey))
+            self.assertTrue(b.pubkey_is_valid(uncompressed))
+            self.assertFalse(b.pubkey_is_valid(b'\x05' + self.pubkey[1:]))
+            self.assertFalse(b.pubkey_is_valid(b'\x02' + bytes(32)))
+
+    def test_signatures(self):
+        for b in self.backends():
+            self.assertEqual(b.sign(self.secret, self.digest), self.sig)
+            der = '3044' + '0220' + self.sig[:32].hex() + '0220' + self.sig[32:].hex()
+            self.assertEqual(b.sign_der(self.secret, [self.digest, self.digest]),
+                             [bfh(der)] * 2)
+            self.assertEqual(b.sign_recoverable(self.secret, self.digest), (1, self.sig))
+            self.assertEqual(b.recover(self.sig, 1, self.digest), self.pubkey)
+            self.assertEqual(b.recover(self.sig, 1, self.digest, False),
+                             b.pubkey_from_secret(self.secret, False))
+            self.assertNotEqual(b.recover(self.sig, 0, self.digest), self.pubkey)
+            self.assertTrue(b.verify(self.pubkey, self.sig, self.digest))
+            self.assertFalse(b.verify(self.pubkey, self.sig, self.secret))
+            self.assertFalse(b.verify(self.G, self.sig, self.digest))
+
+    @unittest.skipUnless(ecc_fast.ec_backend, "libsecp256k1 not available")
+    def test_same_results(self):
+        python, fast = self.backends()
+        for n in range(20):
+            secret = Hash(bytes([n]))
+            digest = Hash(secret)
+            pubkey = python.pubkey_from_secret(secret, n % 2 == 0)
+            self.assertEqual(pubkey, fast.pubkey_from_secret(secret, n % 2 == 0))
+            self.assertEqual(python.sign_recoverable(secret, digest),
+                             fast.sign_recoverable(secret, digest))
+            self.assertEqual(python.pubkey_add_tweak(pubkey, digest),
+                             fast.pubkey_add_tweak(pubkey, digest))
+            self.assertEqual(python.pubkey_multiply(pubkey, digest),
+                             fast.pubkey_multiply(pubkey, digest))
+
+
 class Test_seeds(unittest.TestCase):
     """ Test old and new seeds. """
 
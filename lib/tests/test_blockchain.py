@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 import lib.blockchain as bc
 
@@ -12,6 +15,7 @@ class MyBlockchain(bc.Blockchain):
         self.is_saved = True
         self.checkpoint = 0
         self.headers = []
+        self.clear_caches()
 
     def set_local_height(self):
         self.local_height = 0
@@ -78,3 +82,201 @@ class TestBlockchain(unittest.TestCase):
         hdr = {'block_height': block['block_height'] + 1}
         self.assertEqual(chain.get_bits(hdr),
                          0x1801b553)
+
+
+def daa_chain(count):
+    z = '00' * 32
+    first = {
+        'version': 4,
+        'prev_block_hash': z,
+        'merkle_root': z,
+        'timestamp': 1510600000,
+        'bits': 0x18015ddc,
+        'nonce': 0,
+        'block_height': 0
+    }
+    blocks = [first]
+    for n in range(1, count):
+        interval = (n * 7919) % 1400
+        bits = first['bits'] - (n % 5)
+        blocks.append(get_block(blocks[-1], interval, bits))
+    return blocks
+
+
+class FakeConfig(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class TestHeaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.headers_dir = tempfile.mkdtemp()
+        self.saved_blockchains = dict(bc.blockchains)
+        bc.blockchains.clear()
+
+    def tearDown(self):
+        bc.blockchains.clear()
+        bc.blockchains.update(self.saved_blockchains)
+        shutil.rmtree(self.headers_dir)
+
+    def _daa_chain(self, count):
+        return daa_chain(count)
+
+    def test_daa_rolling_work_matches_full_recomputation(self):
+        blocks = self._daa_chain(400)
+        chunk = b''.join(bytes.fromhex(bc.serialize_header(b))
+                         for b in blocks)
+        chain = MyBlockchain()
+        chain.set_cur_chunk(0, chunk)
+        fresh = MyBlockchain()
+        fresh.set_cur_chunk(0, chunk)
+        for block in blocks[160:]:
+            fresh.clear_derived_caches()
+            self.assertEqual(chain.get_bits(block), fresh.get_bits(block))
+        self.assertIsNotNone(chain.work_window)
+
+    def test_write_invalidates_cached_headers(self):
+        blocks = self._daa_chain(20)
+        chain = bc.Blockchain(FakeConfig(self.headers_dir), 0, None)
+        bc.blockchains[0] = chain
+        open(chain.path(), 'w+').close()
+        data = b''.join(bytes.fromhex(bc.serialize_header(b))
+                        for b in blocks)
+        chain.write(data, 0)
+        self.assertEqual(chain.read_header(15), blocks[15])
+        self.assertEqual(chain.read_header(5), blocks[5])
+        self.assertEqual(len(chain.header_cache), 2)
+
+        # Rewrite the tip with different headers
+        replaced = [dict(b, nonce=1) for b in blocks[10:]]
+        chain.write(b''.join(bytes.fromhex(bc.serialize_header(b))
+                             for b in replaced), 10 * 80)
+        self.assertEqual(chain.read_header(5), blocks[5])
+        self.assertEqual(chain.read_header(15), replaced[5])
+
+        # Truncation
+        chain.write(b'', 12 * 80)
+        self.assertIsNone(chain.read_header(15))
+
+    def _serialize(self, headers):
+        return b''.join(bytes.fromhex(bc.serialize_header(h))
+                        for h in headers)
+
+    def test_header_store_remaps_on_growth_and_truncation(self):
+        blocks = self._daa_chain(30)
+        path = self.headers_dir + '/headers'
+        open(path, 'wb').close()
+        store = bc.HeaderStore(path)
+        self.assertEqual(store.read(0, 80), b'')
+        store.write(self._serialize(blocks[:10]), 0)
+        self.assertEqual(store.read(9 * 80, 80), self._serialize(blocks[9:10]))
+        store.write(self._serialize(blocks[10:]), 10 * 80, sync=False)
+        self.assertEqual(store.size(), 30 * 80)
+        self.assertEqual(store.read(29 * 80, 80), self._serialize(blocks[29:]))
+        store.write(b'', 5 * 80)
+        self.assertEqual(store.size(), 5 * 80)
+        self.assertEqual(store.read(4 * 80, 80), self._serialize(blocks[4:5]))
+        self.assertEqual(store.read(5 * 80, 80), b'')
+        store.close()
+        self.assertEqual(store.read(0, 80), self._serialize(blocks[:1]))
+        store.close()
+
+    def test_swap_with_parent(self):
+        config = FakeConfig(self.headers_dir)
+        os.mkdir(os.path.join(self.headers_dir, 'forks'))
+        main_blocks = self._daa_chain(10)
+        fork_blocks = main_blocks[:5]
+        for n in range(6):
+            fork_blocks.append(get_block(fork_blocks[-1], 300, 0x18015ddc))
+
+        main = bc.Blockchain(config, 0, None)
+        bc.blockchains[0] = main
+        open(main.path(), 'w+').close()
+        main.write(self._serialize(main_blocks), 0)
+        self.assertEqual(main.read_header(7), main_blocks[7])
+
+        fork = main.fork(fork_blocks[5])
+        bc.blockchains[fork.checkpoint] = fork
+        for header in fork_blocks[6:]:
+            fork.save_header(header)
+
+        # the longer fork has become the main chain
+        self.assertIs(bc.blockchains[0], fork)
+        self.assertEqual(fork.height(), 10)
+        for height in range(11):
+            self.assertEqual(fork.read_header(height), fork_blocks[height])
+        self.assertEqual(main.checkpoint, 5)
+        self.assertEqual(main.read_header(3), main_blocks[3])
+        self.assertEqual(main.read_header(9), main_blocks[9])
+        for b in bc.blockchains.values():
+            b.store.close()
+
+
+# The first three mainnet blocks
+MAINNET_HEADERS = bytes.fromhex(
+    '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c'
+    '010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba744bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e36299'
+    '010000004860eb18bf1b1620e37e9490fc8a427514416fd75159ab86688e9a8300000000d5fdcc541e25de1c7a5addedf24858b8bb665c9f36ef744ee42c316022c90f9bb0bc6649ffff001d08d2bd61')
+
+
+class TestDetachedVerification(unittest.TestCase):
+
+    def setUp(self):
+        self.headers_dir = tempfile.mkdtemp()
+        self.saved_blockchains = dict(bc.blockchains)
+        bc.blockchains.clear()
+        self.chain = bc.Blockchain(FakeConfig(self.headers_dir), 0, None)
+        bc.blockchains[0] = self.chain
+        open(self.chain.path(), 'w+').close()
+
+    def tearDown(self):
+        self.chain.store.close()
+        bc.blockchains.clear()
+        bc.blockchains.update(self.saved_blockchains)
+        shutil.rmtree(self.headers_dir)
+
+    def test_deserialize_header(self):
+        header = bc.deserialize_header(MAINNET_HEADERS[80:160], 1)
+        self.assertEqual(bc.serialize_header(header), MAINNET_HEADERS[80:160].hex())
+        self.assertEqual(header['bits'], 0x1d00ffff)
+        self.assertEqual(header['nonce'], 0x9962e301)
+        self.assertEqual(bc.hash_header(header),
+                         '00000000839a8e6886ab5951d76f411475428afc90947ee320161bbf18eb6048')
+
+    def test_verify_and_connect(self):
+        bc.verify_detached_chunk(0, MAINNET_HEADERS, b'', False)
+        self.assertTrue(self.chain.connect_verified_chunk(0, MAINNET_HEADERS, b''))
+        self.assertEqual(self.chain.height(), 2)
+        self.assertEqual(self.chain.read_raw_headers(1, 3), MAINNET_HEADERS[80:])
+        # the attached verification agrees
+        self.chain.verify_chunk(0, MAINNET_HEADERS)
+
+    def test_rejects_tampered_headers(self):
+        tampered = bytearray(MAINNET_HEADERS)
+        tampered[80 + 76] ^= 1   # nonce of block 1
+        with self.assertRaises(bc.VerifyError):
+            bc.verify_detached_chunk(0, bytes(tampered), b'', False)
+        # block 2 no longer follows block 1
+        with self.assertRaises(bc.VerifyError):
+            bc.verify_detached_chunk(0, MAINNET_HEADERS[:80] + MAINNET_HEADERS[160:], b'', False)
+
+    def test_detached_bits_match_attached(self):
+        blocks = daa_chain(2100)
+        data = b''.join(bytes.fromhex(bc.serialize_header(b)) for b in blocks)
+        self.chain.write(data[:2016 * 80], 0)
+        self.assertEqual(self.chain.read_raw_headers(0, 2016), data[:2016 * 80])
+        self.assertEqual(self.chain.read_raw_headers(2000, 2100), data[2000 * 80:2016 * 80])
+        detached = bc.DetachedChain(0, data)
+        self.chain.set_cur_chunk(1, data[2016 * 80:])
+        for block in blocks[2016:]:
+            self.assertEqual(detached.get_bits(block), self.chain.get_bits(block))
+        self.chain.set_cur_chunk(None, None)
+        self.assertIsNone(detached.read_header(2100))
+
+        # chunk 1 is only connected after the header before it
+        chunk = data[2016 * 80:]
+        self.assertFalse(self.chain.connect_verified_chunk(1, chunk, data[:2015 * 80] + bytes(80)))
+        self.assertTrue(self.chain.connect_verified_chunk(1, chunk, data[:2016 * 80]))
+        self.assertEqual(self.chain.height(), 2099)
@@ -0,0 +1,85 @@
+import unittest
+
+from lib.address import Address
+from lib.bitcoin import TYPE_ADDRESS
+from lib.coinchooser import CoinChooserBnB, CoinChooserPrivacy
+from lib.util import NotEnoughFunds
+
+PUBKEY = '02' + '11' * 32
+
+
+def fee_estimator(size):
+    return size  # 1 sat/byte
+
+
+def make_coins(values):
+    coins = []
+    for i, value in enumerate(values):
+        coins.append({
+            'type': 'p2pkh',
+            'address': Address.from_P2PKH_hash(i.to_bytes(20, 'big')),
+            'prevout_hash': '%064x' % (i + 1),
+            'prevout_n': 0,
+            'value': value,
+            'x_pubkeys': [PUBKEY],
+            'pubkeys': [PUBKEY],
+            'signatures': [None],
+            'num_sig': 1,
+        })
+    return coins
+
+
+class TestCoinChooserBnB(unittest.TestCase):
+
+    def setUp(self):
+        self.dest = Address.from_P2PKH_hash(b'\xff' * 20)
+        self.change = Address.from_P2PKH_hash(b'\xfe' * 20)
+
+    def make_tx(self, chooser, values, amount):
+        outputs = [(TYPE_ADDRESS, self.dest, amount)]
+        return chooser.make_tx(make_coins(values), outputs, [self.change],
+                               fee_estimator, 546)
+
+    def test_branch_and_bound(self):
+        chooser = CoinChooserBnB()
+        values, fees = [50, 40, 30, 20], [1, 1, 1, 1]
+        self.assertEqual([1, 3], chooser.branch_and_bound(values, fees, 60, 60, 10))
+        self.assertEqual([0, 3], chooser.branch_and_bound(values, fees, 69, 72, 10))
+        # 50 + 20 costs 1 more than 40 + 30, but two fewer in fees
+        self.assertEqual([0, 3], chooser.branch_and_bound(values, [1, 2, 2, 1], 69, 72, 10))
+        self.assertIsNone(chooser.branch_and_bound(values, fees, 69, 72, 2))
+        self.assertIsNone(chooser.branch_and_bound([50, 40], [1, 1], 60, 80, 10))
+
+    def test_largest_first(self):
+        chooser = CoinChooserBnB()
+        self.assertEqual([1], chooser.largest_first([50, 40, 30, 20], 35))
+        self.assertEqual([0, 3], chooser.largest_first([50, 40, 30, 20], 70))
+        self.assertEqual([0, 1], chooser.largest_first([50, 40], 100))
+
+    def test_changeless(self):
+        # 100000 pays 99700 and the fee of its input; the rest is below
+        # dust_threshold and costs less than making and spending change
+        values = [500000, 100000, 70000, 30000, 12345]
+        tx = self.make_tx(CoinChooserBnB(), values, 99700)
+        self.assertEqual([100000], [txin['value'] for txin in tx.inputs()])
+        self.assertEqual(1, len(tx.outputs()))
+
+    def test_change(self):
+        # 100000 + 70000 + 30000 + 12345 would do without change, but
+        # needs three more inputs than change costs
+        values = [500000, 100000, 70000, 30000, 12345]
+        tx = self.make_tx(CoinChooserBnB(), values, 211000)
+        self.assertEqual([500000], [txin['value'] for txin in tx.inputs()])
+        self.assertEqual(2, len(tx.outputs()))
+        self.assertLess(tx.get_fee(), 500)
+
+    def test_not_enough_funds(self):
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx(CoinChooserBnB(), [1000, 2000], 3000)
+
+    def test_same_amounts_as_privacy(self):
+        values = [10000 * (i + 1) for i in range(20)]
+        for amount in (5000, 95000, 1000000):
+            for chooser in (CoinChooserBnB(), CoinChooserPrivacy()):
+                tx = self.make_tx(chooser, values, amount)
+                self.assertGreaterEqual(tx.get_fee(), tx.estimated_size())
@@ -1,3 +1,6 @@
+import asyncio
+import json
+import socket
 import unittest
 
 from lib import interface
@@ -24,3 +27,133 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class TestInterfaceBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.server = socket.socketpair()
+        self.iface = interface.Interface('localhost:50001:t', self.sock)
+        self.server.settimeout(5)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.close()
+
+    def _read_line(self):
+        data = b''
+        while not data.endswith(b'\n'):
+            data += self.server.recv(65536)
+        return data
+
+    def test_batch_round_trip(self):
+        for i in range(3):
+            self.iface.queue_request('blockchain.scripthash.get_history', ['%02d' % i], i)
+        self.assertTrue(self.iface.send_requests())
+        batch = json.loads(self._read_line().decode())
+        self.assertEqual([r['id'] for r in batch], [0, 1, 2])
+
+        # responses in any order, then a notification
+        reply = [{'id': i, 'result': []} for i in (2, 0, 1)]
+        notification = {'method': 'blockchain.headers.subscribe', 'params': [{}]}
+        self.server.sendall((json.dumps(reply) + '\n' + json.dumps(notification) + '\n').encode())
+        responses = []
+        while len(responses) < 4:
+            responses += self.iface.get_responses()
+        self.assertEqual([req[2] for req, resp in responses[:3]], [2, 0, 1])
+        self.assertEqual(responses[3], (None, notification))
+        self.assertEqual(self.iface.unanswered_requests, {})
+        self.assertEqual(self.iface.window, 103)
+
+    def test_batch_error_abandons_connection(self):
+        for i in range(3):
+            self.iface.queue_request('blockchain.scripthash.get_history', ['%02d' % i], i)
+        self.iface.send_requests()
+        self._read_line()
+        error = {'jsonrpc': '2.0', 'id': None,
+                 'error': {'code': -32600, 'message': 'invalid request'}}
+        self.server.sendall((json.dumps(error) + '\n').encode())
+        responses = []
+        while not responses:
+            responses += self.iface.get_responses()
+        self.assertEqual(responses, [(None, None)])
+
+    def test_single_request_is_not_batched(self):
+        self.iface.queue_request('server.version', [], 7)
+        self.iface.send_requests()
+        self.assertEqual(json.loads(self._read_line().decode())['id'], 7)
+
+    def test_window(self):
+        iface = self.iface
+        for i in range(250):
+            iface.queue_request('server.ping', [], i)
+        self.assertEqual(iface.num_requests(), 100)
+        iface.send_requests()
+        self.assertEqual(len(iface.unanswered_requests), 100)
+        self.assertEqual(len(json.loads(self._read_line().decode())), 100)
+
+        iface.update_window(30.0)
+        self.assertEqual(iface.window, 50)
+        # above the window nothing more is sent
+        self.assertEqual(iface.num_requests(), 0)
+        # a second slow response in the same round trip does not shrink it
+        iface.update_window(30.0)
+        self.assertEqual(iface.window, 50)
+        iface.last_window_decrease = 0
+        for i in range(10):
+            iface.update_window(30.0)
+            iface.last_window_decrease = 0
+        self.assertEqual(iface.window, iface.MIN_WINDOW)
+
+
+class TestInterfaceLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.server = socket.socketpair()
+        self.server.settimeout(5)
+        self.loop = asyncio.SelectorEventLoop()
+        self.iface = interface.Interface('localhost:50001:t', self.sock)
+        self.received = []
+        self.iface.start(self.loop, lambda iface, responses: self.received.extend(responses))
+
+    def tearDown(self):
+        self.iface.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        self.server.close()
+
+    def run_until(self, condition):
+        for i in range(1000):
+            if condition():
+                return
+            self.loop.run_until_complete(asyncio.sleep(0.001))
+        self.fail('timed out')
+
+    def test_round_trip(self):
+        # sent without polling send_requests()
+        self.iface.queue_request('server.version', [], 0)
+        self.iface.queue_request('server.banner', [], 1)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        data = b''
+        while not data.endswith(b'\n'):
+            data += self.server.recv(65536)
+        self.assertEqual([r['id'] for r in json.loads(data.decode())], [0, 1])
+
+        # a message split across reads, then a notification
+        reply = (json.dumps([{'id': 1, 'result': 'banner'}, {'id': 0, 'result': 'v'}]) + '\n').encode()
+        notification = {'method': 'blockchain.headers.subscribe', 'params': [{}]}
+        self.server.sendall(reply[:10])
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(self.received, [])
+        self.server.sendall(reply[10:] + (json.dumps(notification) + '\n').encode())
+        self.run_until(lambda: len(self.received) == 3)
+        self.assertEqual([req[2] for req, resp in self.received[:2]], [1, 0])
+        self.assertEqual(self.received[2], (None, notification))
+        self.assertEqual(self.iface.unanswered_requests, {})
+
+    def test_closed_remotely(self):
+        self.server.sendall(b'{"id": 5')
+        self.server.close()
+        self.run_until(lambda: self.received)
+        self.assertEqual(self.received, [(None, None)])
+        self.assertTrue(self.iface.closed_remotely)
@@ -0,0 +1,89 @@
+import base64
+import http.client
+import json
+import threading
+import unittest
+
+from lib.jsonrpc import ThreadedJSONRPCServer
+
+
+class TestThreadedJSONRPCServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadedJSONRPCServer(('127.0.0.1', 0), logRequests=False,
+                                            rpc_user='user', rpc_password='pass',
+                                            workers=4)
+        self.server.register_function(lambda x, y: x + y, 'add')
+        self.release = threading.Event()
+        self.server.register_function(lambda: self.release.wait(5), 'wait')
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.start()
+        self.host, self.port = self.server.socket.getsockname()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=5)
+
+    def call(self, conn, request, password='pass'):
+        auth = base64.b64encode(('user:' + password).encode()).decode()
+        conn.request('POST', '/', json.dumps(request),
+                     {'Authorization': 'Basic ' + auth,
+                      'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read().decode())
+
+    def test_keep_alive(self):
+        conn = self.connect()
+        for i in range(3):
+            status, reply = self.call(conn, {'jsonrpc': '2.0', 'id': i,
+                                             'method': 'add', 'params': [i, 1]})
+            self.assertEqual(200, status)
+            self.assertEqual(i + 1, reply['result'])
+            if i == 0:
+                sock = conn.sock
+            self.assertIs(sock, conn.sock)
+        conn.close()
+
+    def test_batch(self):
+        conn = self.connect()
+        status, reply = self.call(conn, [
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1, 2]},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'nonexistent', 'params': []},
+            {'jsonrpc': '2.0', 'id': 3, 'method': 'add', 'params': [3, 4]},
+        ])
+        self.assertEqual(200, status)
+        self.assertEqual([1, 2, 3], [r['id'] for r in reply])
+        self.assertEqual(3, reply[0]['result'])
+        self.assertIn('error', reply[1])
+        self.assertEqual(7, reply[2]['result'])
+        conn.close()
+
+    def test_bad_credentials(self):
+        conn = self.connect()
+        conn.request('POST', '/', '{}', {'Authorization': 'Basic ' +
+                                         base64.b64encode(b'user:x').decode()})
+        self.assertEqual(401, conn.getresponse().status)
+        conn.close()
+
+    def test_concurrent_calls(self):
+        # a call blocked in a worker doesn't hold up the other connections
+        blocked = self.connect()
+        auth = base64.b64encode(b'user:pass').decode()
+        blocked.request('POST', '/', json.dumps({'jsonrpc': '2.0', 'id': 1,
+                                                 'method': 'wait', 'params': []}),
+                        {'Authorization': 'Basic ' + auth})
+        conn = self.connect()
+        status, reply = self.call(conn, {'jsonrpc': '2.0', 'id': 2,
+                                         'method': 'add', 'params': [2, 2]})
+        self.assertEqual(4, reply['result'])
+        self.assertFalse(self.release.is_set())
+        self.release.set()
+        self.assertEqual(True, json.loads(blocked.getresponse().read().decode())['result'])
+        blocked.close()
+        conn.close()
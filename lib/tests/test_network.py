@@ -0,0 +1,259 @@
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent import futures
+from unittest import mock
+
+import lib.blockchain as bc
+from lib import network
+from lib.bitcoin import Hash
+
+from .test_blockchain import FakeConfig, daa_chain
+
+# 7 chunks and a bit; the first one and 100 headers are stored at start
+HEIGHT = 2016 * 7 + 499
+STORED = 2016 + 100
+
+
+def verify_linkage(index, data, prior, testnet):
+    '''Stands in for verify_detached_chunk(): the synthetic chain has no
+    proof of work, so only that each header follows the one before is
+    checked.'''
+    prev = Hash(prior[-80:]) if prior else bytes(32)
+    for offset in range(0, len(data), 80):
+        raw = data[offset:offset + 80]
+        if raw[4:36] != prev:
+            raise bc.VerifyError('prev hash mismatch')
+        prev = Hash(raw)
+
+
+class ImmediateExecutor(object):
+
+    def submit(self, func, *args):
+        future = futures.Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class FakeInterface(object):
+
+    def __init__(self, server, blockchain, tip):
+        self.server = server
+        self.blockchain = blockchain
+        self.tip = tip
+        self.mode = 'default'
+        self.request = None
+        self.req_time = None
+
+    def print_error(self, *msg):
+        pass
+
+
+class FakeNetwork(network.Network):
+    '''The chunk download of Network, with the requests recorded instead
+    of sent and the chunks verified at once.'''
+
+    def __init__(self, interfaces, window):
+        self.config = {'chunk_window': window}
+        self.interfaces = {i.server: i for i in interfaces}
+        self.chunk_downloads = []
+        self.banned_servers = set()
+        self.chunk_executor = None
+        self.loop = None
+        # (interface, index) of the chunks requested, unanswered and all
+        self.sent = []
+        self.all_sent = []
+
+    def get_chunk_executor(self):
+        return ImmediateExecutor()
+
+    def queue_request(self, method, params, interface):
+        assert method == 'blockchain.block.headers' and params[1] == 2016
+        self.sent.append((interface, params[0] // 2016))
+        self.all_sent.append((interface, params[0] // 2016))
+
+    def notify(self, event):
+        pass
+
+    def connection_down(self, server):
+        self.interfaces.pop(server, None)
+
+
+class TestChunkDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        blocks = daa_chain(HEIGHT + 1)
+        cls.data = b''.join(bytes.fromhex(bc.serialize_header(b)) for b in blocks)
+
+    def setUp(self):
+        self.headers_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.headers_dir, 'forks'))
+        self.saved_blockchains = dict(bc.blockchains)
+        bc.blockchains.clear()
+        self.chain = bc.Blockchain(FakeConfig(self.headers_dir), 0, None)
+        bc.blockchains[0] = self.chain
+        open(self.chain.path(), 'w+').close()
+        self.chain.write(self.data[:STORED * 80], 0)
+        patcher = mock.patch.object(bc, 'verify_detached_chunk', verify_linkage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.chain.store.close()
+        bc.blockchains.clear()
+        bc.blockchains.update(self.saved_blockchains)
+        shutil.rmtree(self.headers_dir)
+
+    def start(self, servers=4, tip=HEIGHT, window=16):
+        self.ifaces = [FakeInterface('s%d' % k, self.chain, tip) for k in range(servers)]
+        self.network = FakeNetwork(self.ifaces, window)
+        self.leader = self.ifaces[0]
+        self.leader.mode = 'catch_up'
+        self.chain.catch_up = self.leader.server
+        self.network.start_chunk_download(self.leader, STORED // 2016)
+        self.download = self.network.chunk_downloads[0]
+
+    def chunk(self, interface, index):
+        '''The headers of chunk index the server of interface has.'''
+        end = min((index + 1) * 2016, interface.tip + 1)
+        return self.data[index * 2016 * 80:end * 80]
+
+    def answer(self, interface, index, chunk=None):
+        if chunk is None:
+            chunk = self.chunk(interface, index)
+        self.network.on_block_headers(interface, {
+            'params': [index * 2016, 2016],
+            'result': {'hex': chunk.hex(), 'count': len(chunk) // 80, 'max': 2016}})
+
+    def round(self, order=None, tamper=None):
+        '''Answers the requests sent, then processes the verified chunks.
+        Returns the (interface, index) answered.'''
+        sent, self.network.sent = self.network.sent, []
+        if order:
+            sent = order(sent)
+        for interface, index in sent:
+            chunk = self.chunk(interface, index)
+            if tamper:
+                chunk = tamper(interface, index, chunk)
+            self.answer(interface, index, chunk)
+        self.network.process_chunks()
+        return sent
+
+    def finish(self, **kwargs):
+        for i in range(50):
+            if self.leader.mode == 'default':
+                return
+            self.round(**kwargs)
+        self.fail('catch up not done')
+
+    def assertCaughtUp(self, tip=HEIGHT):
+        self.assertEqual('default', self.leader.mode)
+        self.assertIsNone(self.chain.catch_up)
+        self.assertEqual([], self.network.chunk_downloads)
+        self.assertEqual(tip, self.chain.height())
+        self.assertEqual(self.data[:(tip + 1) * 80], self.chain.read_raw_headers(0, tip + 1))
+
+    def requested_from_others(self, index, interface):
+        return [i for i, idx in self.network.all_sent if idx == index and i is not interface]
+
+    def test_out_of_order_chunks_connected_in_order(self):
+        self.start()
+        connect = mock.patch.object(self.chain, 'connect_verified_chunk',
+                                    wraps=self.chain.connect_verified_chunk)
+        with connect as connected:
+            sent = self.network.sent
+            self.assertEqual([1, 2, 3, 4], sorted(index for i, index in sent))
+            self.network.sent = []
+            # the chunks after the first are held until it arrives
+            for interface, index in sorted(sent, key=lambda s: -s[1])[:-1]:
+                self.answer(interface, index)
+            self.network.process_chunks()
+            self.assertEqual(STORED - 1, self.chain.height())
+            self.assertEqual({2, 3, 4}, set(self.download.received))
+            self.assertFalse(connected.called)
+            interface, index = min(sent, key=lambda s: s[1])
+            self.answer(interface, index)
+            self.network.process_chunks()
+            self.assertEqual(5 * 2016 - 1, self.chain.height())
+            self.finish(order=lambda sent: sent[::-1])
+            self.assertEqual(list(range(1, 8)),
+                             [call[0][0] for call in connected.call_args_list])
+        self.assertCaughtUp()
+        self.assertFalse(self.network.banned_servers)
+
+    def test_short_chunk_bans_server(self):
+        self.start()
+        bad, bad_index = max(self.network.sent, key=lambda s: s[1])
+        self.assertIsNot(bad, self.leader)
+        def tamper(interface, index, chunk):
+            return chunk[:-80] if interface is bad else chunk
+        self.round(tamper=tamper)
+        self.assertEqual({bad.server}, self.network.banned_servers)
+        self.assertNotIn(bad.server, self.network.interfaces)
+        self.finish()
+        self.assertTrue(self.requested_from_others(bad_index, bad))
+        self.assertCaughtUp()
+
+    def test_corrupt_chunk_bans_server_and_keeps_connected_chunks(self):
+        self.start()
+        bad, bad_index = max(self.network.sent, key=lambda s: s[1])
+        self.assertIsNot(bad, self.leader)
+        def tamper(interface, index, chunk):
+            if interface is bad:
+                # a header in the middle no longer follows the one before
+                chunk = bytearray(chunk)
+                chunk[1000 * 80] ^= 1
+            return bytes(chunk)
+        self.round(tamper=tamper)
+        self.assertEqual({bad.server}, self.network.banned_servers)
+        self.assertNotIn(bad.server, self.network.interfaces)
+        # the chunks before the corrupt one stay connected
+        self.assertEqual(bad_index * 2016 - 1, self.chain.height())
+        banned_at = len(self.network.all_sent)
+        self.finish()
+        again = [index for i, index in self.network.all_sent[banned_at:]]
+        self.assertIn(bad_index, again)
+        self.assertTrue(all(index >= bad_index for index in again))
+        self.assertTrue(self.requested_from_others(bad_index, bad))
+        self.assertCaughtUp()
+
+    def test_disconnected_helper_reassigned(self):
+        self.start()
+        gone, gone_index = max(self.network.sent, key=lambda s: s[1])
+        self.assertIsNot(gone, self.leader)
+        # the helper disconnects before answering
+        self.network.connection_down(gone.server)
+        self.round(order=lambda sent: [s for s in sent if s[0] is not gone])
+        self.assertIsNot(gone, self.download.requested.get(gone_index, (None,))[0])
+        self.assertTrue(self.requested_from_others(gone_index, gone))
+        self.finish()
+        self.assertFalse(self.network.banned_servers)
+        self.assertCaughtUp()
+
+    def test_short_last_chunk_requested_again_when_tip_moves(self):
+        tip = HEIGHT - 300
+        self.start(tip=tip)
+        last = tip // 2016
+        for i in range(50):
+            answered = [index for interface, index in self.network.sent]
+            if last in answered:
+                break
+            self.round()
+        # the tip moves while the short last chunk is on its way
+        sent, self.network.sent = self.network.sent, []
+        for interface, index in sent:
+            self.answer(interface, index)
+        for interface in self.ifaces:
+            interface.tip = HEIGHT
+        self.network.process_chunks()
+        self.assertEqual(tip, self.chain.height())
+        self.assertEqual('catch_up', self.leader.mode)
+        self.finish()
+        self.assertEqual(2, [index for i, index in self.network.all_sent].count(last))
+        self.assertFalse(self.network.banned_servers)
+        self.assertCaughtUp()
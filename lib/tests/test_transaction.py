@@ -1,16 +1,20 @@
 import unittest
+from unittest import mock
 from pprint import pprint
 
-from lib import transaction
+from lib import transaction, util
 from lib.address import Address
 from lib.bitcoin import TYPE_ADDRESS
 
+from lib.keystore import Imported_KeyStore
+
 from lib.keystore import xpubkey_to_address
 
 from lib.util import bh2u
 
 unsigned_blob = '010000000149f35e43fefd22d8bb9e4b3ff294c6286154c25712baf6ab77b646e5074d6aed010000005701ff4c53ff0488b21e0000000000000000004f130d773e678a58366711837ec2e33ea601858262f8eaef246a7ebd19909c9a03c3b30e38ca7d797fee1223df1c9827b2a9f3379768f520910260220e0560014600002300feffffffd8e43201000000000118e43201000000001976a914e158fb15c888037fdc40fb9133b4c1c3c688706488ac5fbd0700'
 signed_blob = '010000000149f35e43fefd22d8bb9e4b3ff294c6286154c25712baf6ab77b646e5074d6aed010000006a473044022025bdc804c6fe30966f6822dc25086bc6bb0366016e68e880cf6efd2468921f3202200e665db0404f6d6d9f86f73838306ac55bb0d0f6040ac6047d4e820f24f46885412103b5bbebceeb33c1b61f649596b9c3611c6b2853a1f6b48bce05dd54f667fa2166feffffff0118e43201000000001976a914e158fb15c888037fdc40fb9133b4c1c3c688706488ac5fbd0700'
+signed_p2pkh_blob = '01000000020100000000000000000000000000000000000000000000000000000000000000000000006b483045022100a18d7601ddca78e95bb9cd50810e5669ad11859f023d7a79144cf4a3d746456902202cd8d7c6e65521b05ceb946334c1d0ae650bf61282c7a929d66b47f07a62a25741210344b1588589958b0bcab03435061539e9bcf54677c104904044e4f8901f4ebdf5feffffff0200000000000000000000000000000000000000000000000000000000000000010000006b483045022100f821dcfda0f76c7cf3db6ffe4657726d3d4be50c97632229b679e99df1ede6870220080d0f4b348e8bf1efb527723ea60eccaf3320f42439f718260c2cf6a86e413341210344b1588589958b0bcab03435061539e9bcf54677c104904044e4f8901f4ebdf5feffffff01384a0000000000001976a914000000000000000000000000000000000000000088ac00000000'
 v2_blob = "0200000001191601a44a81e061502b7bfbc6eaa1cef6d1e6af5308ef96c9342f71dbf4b9b5000000006b483045022100a6d44d0a651790a477e75334adfb8aae94d6612d01187b2c02526e340a7fd6c8022028bdf7a64a54906b13b145cd5dab21a26bd4b85d6044e9b97bceab5be44c2a9201210253e8e0254b0c95776786e40984c1aa32a7d03efa6bdacdea5f421b774917d346feffffff026b20fa04000000001976a914024db2e87dd7cfd0e5f266c5f212e21a31d805a588aca0860100000000001976a91421919b94ae5cefcdf0271191459157cdb41c4cbf88aca6240700"
 
 
@@ -55,6 +59,16 @@ class TestBCDataStream(unittest.TestCase):
         self.assertEqual(s.read_bytes(4), b'r')
         self.assertEqual(s.read_bytes(1), b'')
 
+    def test_read_view(self):
+        data = bytearray(b'\x03foobar')
+        s = transaction.BCDataStream(data)
+        self.assertEqual(s.read_compact_size(), 3)
+        # the stream reads the caller's buffer rather than a copy
+        data[1:4] = b'FOO'
+        self.assertEqual(s.read_bytes(3), b'FOO')
+        s.write(b'!')
+        self.assertEqual(s.read_bytes(4), b'bar!')
+
 class TestTransaction(unittest.TestCase):
 
     def test_tx_unsigned(self):
@@ -131,6 +145,95 @@ class TestTransaction(unittest.TestCase):
 
         self.assertEqual(tx.estimated_size(), 191)
 
+    def test_serialize_bytes(self):
+        for blob in (unsigned_blob, signed_blob, v2_blob):
+            tx = transaction.Transaction(blob)
+            self.assertEqual(tx.serialize_bytes(), bytes.fromhex(blob))
+            self.assertEqual(tx.serialize_bytes(True).hex(), tx.serialize(True))
+            for txin in tx.inputs():
+                script = tx.input_script(txin, True)
+                self.assertEqual(tx.estimated_input_size(txin),
+                                 len(tx.serialize_input(txin, script, True)) // 2)
+        tx = transaction.Transaction(unsigned_blob)
+        self.assertEqual(tx.serialize_preimage_bytes(0).hex(),
+                         tx.serialize_preimage(0))
+
+    def test_txid_cache(self):
+        tx = transaction.Transaction(signed_blob)
+        txid = tx.txid()
+        self.assertEqual(txid, transaction.Transaction(signed_blob).txid())
+        self.assertIs(tx.txid(), txid)
+        tx.raw = None
+        self.assertEqual(tx.txid(), txid)
+        self.assertIsNone(transaction.Transaction(unsigned_blob).txid())
+
+    def test_sighash_cache(self):
+        tx = transaction.Transaction(unsigned_blob)
+        preimage = tx.serialize_preimage(0)
+        self.assertEqual(tx.serialize_preimage(0, use_cache=True), preimage)
+        self.assertIs(tx._calc_common_sighash_bytes(use_cache=True),
+                      tx._calc_common_sighash_bytes(use_cache=True))
+        self.assertEqual(tx.calc_common_sighash(use_cache=True),
+                         tx.calc_common_sighash())
+
+        addr = Address.from_string('1CQj15y1N7LDHp7wTt28eoD1QhHgFgxECH')
+        tx.add_outputs([(TYPE_ADDRESS, addr, 1000)])
+        new_preimage = tx.serialize_preimage(0, use_cache=True)
+        self.assertNotEqual(new_preimage, preimage)
+        self.assertEqual(new_preimage, tx.serialize_preimage(0))
+
+        tx.BIP_LI01_sort()
+        self.assertNotEqual(tx.serialize_preimage(0, use_cache=True), new_preimage)
+
+    def _unsigned_p2pkh_tx(self, keystore):
+        pubkey = keystore.import_privkey('L2sED74axVXC4H8szBJ4rQJrkfem7UMc6usLCPUoEWxDCFGUaGUM', None)
+        inputs = [{
+            'type': 'p2pkh',
+            'address': pubkey.address,
+            'prevout_hash': '%064x' % (i + 1),
+            'prevout_n': i,
+            'value': 10000,
+            'sequence': 0xfffffffe,
+            'x_pubkeys': [pubkey.to_ui_string()],
+            'pubkeys': [pubkey.to_ui_string()],
+            'signatures': [None],
+            'num_sig': 1,
+        } for i in range(2)]
+        outputs = [(TYPE_ADDRESS, Address.from_P2PKH_hash(bytes(20)), 19000)]
+        return transaction.Transaction.from_io(inputs, outputs)
+
+    def test_sign(self):
+        keystore = Imported_KeyStore({})
+        tx = self._unsigned_p2pkh_tx(keystore)
+        keystore.sign_transaction(tx, None)
+        self.assertTrue(tx.is_complete())
+        self.assertEqual(tx.raw, signed_p2pkh_blob)
+
+    def test_sign_in_processes(self):
+        keystore = Imported_KeyStore({})
+        tx = self._unsigned_p2pkh_tx(keystore)
+        min_inputs = transaction.PARALLEL_SIGNING_MIN
+        transaction.PARALLEL_SIGNING_MIN = 1
+        util.set_worker_processes(2)
+        try:
+            keystore.sign_transaction(tx, None)
+        finally:
+            util.set_worker_processes(0)
+            transaction.PARALLEL_SIGNING_MIN = min_inputs
+        self.assertEqual(tx.raw, signed_p2pkh_blob)
+
+    def test_faulty_signature_rejected(self):
+        keystore = Imported_KeyStore({})
+        tx = self._unsigned_p2pkh_tx(keystore)
+        sign_digests = transaction.sign_digests
+        def faulty(sec, digests):
+            # signatures of other digests
+            return sign_digests(sec, [bytes(32)] * len(digests))
+        with mock.patch.object(transaction, 'sign_digests', faulty):
+            with self.assertRaises(Exception):
+                keystore.sign_transaction(tx, None)
+        self.assertFalse(tx.is_complete())
+
     def test_errors(self):
         with self.assertRaises(TypeError):
             transaction.Transaction.pay_script(output_type=None, addr='')
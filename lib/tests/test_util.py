@@ -1,5 +1,9 @@
+import json
+import socket
 import unittest
-from lib.util import format_satoshis
+from unittest import mock
+from lib import util
+from lib.util import format_satoshis, SocketPipe, timeout
 from lib.web import parse_URI
 
 class TestUtil(unittest.TestCase):
@@ -105,3 +109,72 @@ class TestUtil(unittest.TestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoincash:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
+
+
+class FakeSocket(object):
+    '''Returns the chunks of a stream from recv, then the end of it.'''
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def settimeout(self, t):
+        pass
+
+    def recv(self, size):
+        if not self.chunks:
+            return b''
+        chunk = self.chunks.pop(0)
+        if chunk is None:
+            raise socket.timeout
+        assert len(chunk) <= size
+        return chunk
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def read_all(self, chunks):
+        pipe = SocketPipe(FakeSocket(chunks))
+        messages = []
+        while True:
+            try:
+                message = pipe.get()
+            except timeout:
+                continue
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def test_messages_split_anywhere(self):
+        messages = [{'id': i, 'result': 'ab' * i * 100} for i in range(20)]
+        stream = b''.join(json.dumps(m).encode() + b'\n' for m in messages)
+        for size in (1, 7, 100, 4096, len(stream)):
+            chunks = [stream[i:i + size] for i in range(0, len(stream), size)]
+            self.assertEqual(self.read_all(chunks), messages)
+
+    def test_skips_junk_and_waits(self):
+        chunks = [b'{"id": 1}\nnot json\nnull\n\xff\n{"id"', None, b': 2}\n{"id": 3}']
+        # the last message is incomplete when the connection closes
+        self.assertEqual(self.read_all(chunks), [{'id': 1}, {'id': 2}])
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def tearDown(self):
+        util.set_worker_processes(0)
+
+    def test_no_pool_by_default(self):
+        self.assertIsNone(util.get_worker_pool())
+
+    def test_pool_before_python_3_7(self):
+        # ProcessPoolExecutor takes no mp_context before Python 3.7
+        util.set_worker_processes(2)
+        with mock.patch.object(util.sys, 'version_info', (3, 6, 15)), \
+                mock.patch('multiprocessing.get_start_method', return_value='fork'), \
+                mock.patch('concurrent.futures.ProcessPoolExecutor') as pool:
+            self.assertIsNone(util.get_worker_pool())
+            pool.assert_not_called()
+        with mock.patch.object(util.sys, 'version_info', (3, 6, 15)), \
+                mock.patch('multiprocessing.get_start_method', return_value='spawn'), \
+                mock.patch('concurrent.futures.ProcessPoolExecutor') as pool:
+            self.assertIs(pool.return_value, util.get_worker_pool())
+            pool.assert_called_once_with(2)
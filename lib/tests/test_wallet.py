@@ -4,9 +4,12 @@ import sys
 import unittest
 import os
 import json
+from unittest import mock
 
 from io import StringIO
+from lib.derivation_cache import DerivationCache
 from lib.storage import WalletStorage, FINAL_SEED_VERSION
+import lib.keystore as keystore
 import lib.wallet as wallet
 
 
@@ -68,3 +71,275 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_delete(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("c", "d")
+        storage.write()
+        open(storage.derivations_path(), 'wb').close()
+        self.assertTrue(os.path.exists(storage.journal_path()))
+        storage.delete()
+        self.assertEqual([], os.listdir(self.user_dir))
+
+
+class TestWalletStorageJournal(WalletTestCase):
+
+    def _new_storage(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('transactions', {'aa': '01', 'bb': '02'})
+        storage.put('labels', {})
+        # room for a few journal entries before compaction
+        storage.put('keystore', {'xpub': 'x' * 2000})
+        storage.write()
+        return storage
+
+    def _snapshot(self):
+        with open(self.wallet_path, "r") as f:
+            return json.loads(f.read())
+
+    def test_changes_are_journaled(self):
+        storage = self._new_storage()
+        snapshot = self._snapshot()
+        storage.put('transactions', {'aa': '01', 'cc': '03'})
+        storage.put('labels', None)
+        storage.put('stored_height', 100)
+        storage.write()
+        self.assertEqual(snapshot, self._snapshot())
+        self.assertTrue(os.path.exists(storage.journal_path()))
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertEqual(storage.data, storage2.data)
+        self.assertEqual({'aa': '01', 'cc': '03'}, storage2.get('transactions'))
+        self.assertIsNone(storage2.get('labels'))
+
+        # more entries go to the same journal
+        storage2.put('stored_height', 101)
+        storage2.write()
+        self.assertEqual(101, WalletStorage(self.wallet_path).get('stored_height'))
+
+    def test_compaction(self):
+        storage = self._new_storage()
+        for i in range(100):
+            storage.put('transactions', {'aa': '01', 'bb': '%064x' % i})
+            storage.write()
+        # the journal was folded into the snapshot when it grew too large
+        self.assertLess(storage.journal_size, 2 * len(storage.raw))
+        self.assertNotEqual(self._snapshot()['transactions']['bb'], '02')
+        self.assertEqual(storage.data, WalletStorage(self.wallet_path).data)
+
+    def test_torn_entry(self):
+        storage = self._new_storage()
+        storage.put('stored_height', 1)
+        storage.write()
+        size = os.path.getsize(storage.journal_path())
+        storage.put('stored_height', 2)
+        storage.write()
+        # simulate a crash in the middle of the second entry
+        with open(storage.journal_path(), 'r+b') as f:
+            f.truncate(os.path.getsize(storage.journal_path()) - 5)
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertEqual(1, storage2.get('stored_height'))
+        self.assertEqual(size, os.path.getsize(storage.journal_path()))
+        storage2.put('stored_height', 3)
+        storage2.write()
+        self.assertEqual(3, WalletStorage(self.wallet_path).get('stored_height'))
+
+    def test_stale_journal(self):
+        storage = self._new_storage()
+        storage.put('stored_height', 1)
+        storage.write()
+        with open(storage.journal_path(), 'rb') as f:
+            journal = f.read()
+        # simulate a crash between writing a snapshot and removing the
+        # journal of the previous one
+        storage.put('stored_height', 2)
+        storage.write_snapshot()
+        with open(storage.journal_path(), 'wb') as f:
+            f.write(journal)
+        self.assertEqual(2, WalletStorage(self.wallet_path).get('stored_height'))
+        self.assertFalse(os.path.exists(storage.journal_path()))
+
+    def test_encrypted_journal(self):
+        storage = self._new_storage()
+        storage.set_password('secret', True)
+        storage.write()
+        storage.put('stored_height', 5)
+        storage.write()
+        with open(storage.journal_path(), 'rb') as f:
+            self.assertNotIn(b'stored_height', f.read())
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertTrue(storage2.is_encrypted())
+        storage2.decrypt('secret')
+        self.assertEqual(storage.data, storage2.data)
+
+        # removing the password rewrites the snapshot in plain text
+        storage2.set_password(None, False)
+        storage2.write()
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        self.assertEqual(5, self._snapshot()['stored_height'])
+
+    def test_compact(self):
+        storage = self._new_storage()
+        storage.put('stored_height', 7)
+        storage.write()
+        storage.compact()
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        self.assertEqual(7, self._snapshot()['stored_height'])
+
+    def test_peek_and_owned_put(self):
+        storage = self._new_storage()
+        value = {'aa': ['01', 1]}
+        storage.put('txo', value, owned=True)
+        self.assertIs(value, storage.peek('txo'))
+        self.assertIsNot(value, storage.get('txo'))
+        self.assertEqual([], storage.peek('missing', []))
+
+        # an owned value is replaced, not changed in place
+        storage.put('txo', {'aa': ['01', 1], 'bb': ['02', 2]}, owned=True)
+        storage.write()
+        self.assertEqual(storage.data, WalletStorage(self.wallet_path).data)
+
+
+class TestDerivationCache(WalletTestCase):
+
+    xpub = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+
+    def _new_wallet(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('keystore', keystore.from_xpub(self.xpub).dump())
+        w = wallet.Standard_Wallet(storage)
+        w.synchronize()
+        storage.write()
+        w.stop_threads()
+        return w
+
+    def test_cache_file(self):
+        path = os.path.join(self.user_dir, 'cache')
+        cache = DerivationCache(path, b'\1' * 32, 2, 33)
+        pubkeys = ['02' + '11' * 32, '03' + '22' * 32]
+        cache.put(False, 0, b'\xaa' * 20, pubkeys)
+        cache.put(True, 5, b'\xbb' * 20, pubkeys[::-1])
+        cache.write()
+        cache.put(False, 0, b'\xcc' * 20, pubkeys)
+        cache.write()
+        cache.close()
+
+        cache = DerivationCache(path, b'\1' * 32, 2, 33)
+        self.assertEqual((b'\xcc' * 20, pubkeys), cache.get(False, 0))
+        self.assertEqual((b'\xbb' * 20, pubkeys[::-1]), cache.get(True, 5))
+        self.assertIsNone(cache.get(True, 0))
+        self.assertEqual(1, cache.dead)
+        cache.close()
+
+        # a torn record is ignored
+        with open(path, 'ab') as f:
+            f.write(b'\0' * 10)
+        cache = DerivationCache(path, b'\1' * 32, 2, 33)
+        self.assertEqual((b'\xcc' * 20, pubkeys), cache.get(False, 0))
+        cache.close()
+
+        # the file of other keys is discarded
+        cache = DerivationCache(path, b'\2' * 32, 2, 33)
+        self.assertIsNone(cache.get(False, 0))
+        self.assertFalse(os.path.exists(path))
+
+    def test_rewrite(self):
+        path = os.path.join(self.user_dir, 'cache')
+        cache = DerivationCache(path, b'\1' * 32, 1, 33)
+        for i in range(200):
+            cache.put(False, i, i.to_bytes(20, 'big'), ['02' + '%064x' % i])
+        cache.write()
+        size = os.path.getsize(path)
+        for i in range(100):
+            cache.put(False, i, i.to_bytes(20, 'big'), ['03' + '%064x' % i])
+        cache.write()
+        self.assertGreater(os.path.getsize(path), size)
+        for i in range(100, 200):
+            cache.put(False, i, i.to_bytes(20, 'big'), ['03' + '%064x' % i])
+        cache.write()
+        self.assertEqual(size, os.path.getsize(path))
+        cache.close()
+        cache = DerivationCache(path, b'\1' * 32, 1, 33)
+        self.assertEqual(0, cache.dead)
+        self.assertEqual(['03' + '%064x' % 199], cache.get(False, 199)[1])
+
+    def test_wallet_reopens_with_cache(self):
+        w = self._new_wallet()
+        self.assertTrue(os.path.exists(self.wallet_path + '.derivations'))
+        receiving = w.get_receiving_addresses()
+        pubkey = w.get_public_key(receiving[3])
+
+        w2 = wallet.Standard_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual(receiving, w2.get_receiving_addresses())
+        self.assertEqual([pubkey], w2.derivation_cache.get(False, 3)[1])
+        with mock.patch.object(keystore.BIP32_KeyStore, 'derive_pubkey') as derive:
+            self.assertEqual(pubkey, w2.get_public_key(receiving[3]))
+            derive.assert_not_called()
+
+    def test_wallet_discards_bad_cache(self):
+        w = self._new_wallet()
+        receiving = w.get_receiving_addresses()
+        pubkey = w.get_public_key(receiving[0])
+        cache = w.derivation_cache
+        for for_change, i in cache.keys():
+            hash160, pubkeys = cache.get(for_change, i)
+            cache.put(for_change, i, hash160, ['02' + '11' * 32])
+        cache.write()
+        cache.close()
+
+        w2 = wallet.Standard_Wallet(WalletStorage(self.wallet_path))
+        self.assertFalse(w2.derivation_cache.keys())
+        self.assertEqual(pubkey, w2.get_public_key(receiving[0]))
+
+    def test_wallet_checks_cache_hits(self):
+        w = self._new_wallet()
+        receiving = w.get_receiving_addresses()
+        pubkey = w.get_public_key(receiving[2])
+
+        w2 = wallet.Standard_Wallet(WalletStorage(self.wallet_path))
+        # a record whose public key doesn't hash to its address
+        hash160, pubkeys = w2.derivation_cache.get(False, 2)
+        w2.derivation_cache.put(False, 2, hash160, ['02' + '11' * 32])
+        self.assertEqual(pubkey, w2.get_public_key(receiving[2]))
+        self.assertEqual([pubkey], w2.derivation_cache.get(False, 2)[1])
+
+    def test_cache_file_has_wallet_mode(self):
+        w = self._new_wallet()
+        os.chmod(self.wallet_path, 0o600)
+        old_umask = os.umask(0o022)
+        try:
+            os.remove(self.wallet_path + '.derivations')
+            w.derivation_cache.close()
+            w2 = wallet.Standard_Wallet(WalletStorage(self.wallet_path))
+            w2.get_public_key(w2.get_receiving_addresses()[0])
+            w2.stop_threads()
+        finally:
+            os.umask(old_umask)
+        self.assertEqual(0o600, os.stat(self.wallet_path + '.derivations').st_mode & 0o777)
+
+    def test_encryption_moves_cache_out_of_file(self):
+        storage = WalletStorage(self.wallet_path)
+        seed_words = 'cycle rocket west magnet parrot shuffle foot correct salt library feed song'
+        storage.put('keystore', keystore.from_seed(seed_words, '', False).dump())
+        w = wallet.Standard_Wallet(storage)
+        w.synchronize()
+        storage.write()
+        w.stop_threads()
+        path = self.wallet_path + '.derivations'
+        self.assertTrue(os.path.exists(path))
+        records = len(w.derivation_cache.keys())
+
+        w.update_password(None, 'secret', encrypt=True)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(records, len(w.derivation_cache.keys()))
+        w.stop_threads()
+        self.assertFalse(os.path.exists(path))
+
+        w.update_password('secret', None)
+        w.get_public_key(w.get_receiving_addresses()[0])
+        w.stop_threads()
+        self.assertTrue(os.path.exists(path))
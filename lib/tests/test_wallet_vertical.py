@@ -5,6 +5,7 @@ from lib.address import Address
 import lib.bitcoin as bitcoin
 import lib.keystore as keystore
 import lib.storage as storage
+import lib.util as util
 import lib.wallet as wallet
 
 
@@ -137,3 +138,236 @@ class TestWalletKeystoreAddressIntegrity(unittest.TestCase):
                          Address.from_string('3H3iyACDTLJGD2RMjwKZcCwpdYZLwEZzKb'))
         self.assertEqual(w.get_change_addresses()[0],
                          Address.from_string('31hyfHrkhNjiPZp1t7oky5CGNYqSqDAVM9'))
+
+
+class TestWalletAddressIndex(unittest.TestCase):
+
+    xpub = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_deterministic_index(self, mock_write):
+        store = storage.WalletStorage('if_this_exists_mocking_failed_648151893')
+        store.put('keystore', keystore.from_xpub(self.xpub).dump())
+        store.put('gap_limit', 2)
+        w = wallet.Standard_Wallet(store)
+        w.synchronize()
+        for i, addr in enumerate(w.get_receiving_addresses()):
+            self.assertTrue(w.is_mine(addr))
+            self.assertFalse(w.is_change(addr))
+            self.assertEqual(w.get_address_index(addr), (False, i))
+        for i, addr in enumerate(w.get_change_addresses()):
+            self.assertTrue(w.is_change(addr))
+            self.assertEqual(w.get_address_index(addr), (True, i))
+
+        n = len(w.get_receiving_addresses())
+        addr = w.create_new_address(False)
+        self.assertEqual(w.get_address_index(addr), (False, n))
+
+        # the index survives a reload from storage
+        w2 = wallet.Standard_Wallet(store)
+        self.assertEqual(w2.get_address_index(addr), (False, n))
+
+        other = Address.from_string('1FJEEB8ihPMbzs2SkLmr37dHyRFzakqUmo')
+        self.assertFalse(w.is_mine(other))
+        self.assertFalse(w.is_change(other))
+        with self.assertRaises(Exception):
+            w.get_address_index(other)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_imported_address_index(self, mock_write):
+        store = storage.WalletStorage('if_this_exists_mocking_failed_648151893')
+        w = wallet.ImportedAddressWallet(store)
+        addr = Address.from_string('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf')
+        self.assertFalse(w.is_mine(addr))
+        self.assertTrue(w.import_address(addr))
+        self.assertTrue(w.is_mine(addr))
+        self.assertFalse(w.import_address(addr))
+        w.delete_address(addr)
+        self.assertFalse(w.is_mine(addr))
+
+
+class TestDerivePubkeysRange(unittest.TestCase):
+
+    xpub = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+    mpk = 'e9d4b7866dd1e91c862aebf62a49548c7dbf7bcc6e4b7b8c9da820c7737968df9c09d5a3e271dc814a29981f81b3faaf2737b551ef5dcc6189cf0f8252c442b3'
+
+    def check_range(self, ks):
+        for for_change in (False, True):
+            pubkeys = ks.derive_pubkeys_range(for_change, 3, 5)
+            self.assertEqual([ks.derive_pubkey(for_change, i) for i in range(3, 8)], pubkeys)
+
+    def test_bip32(self):
+        ks = keystore.from_xpub(self.xpub)
+        self.check_range(ks)
+        self.assertEqual(keystore.Xpub.get_pubkey_from_xpub(self.xpub, (1, 4)),
+                         ks.derive_pubkey(True, 4))
+
+    def test_old(self):
+        self.check_range(keystore.from_old_mpk(self.mpk))
+
+    def test_in_processes(self):
+        ks = keystore.from_xpub(self.xpub)
+        expected = ks.derive_pubkeys_range(False, 0, 20)
+        old_min = keystore.PARALLEL_DERIVATION_MIN
+        keystore.PARALLEL_DERIVATION_MIN = 1
+        util.set_worker_processes(2)
+        try:
+            self.assertEqual(expected, ks.derive_pubkeys_range(False, 0, 20))
+        finally:
+            keystore.PARALLEL_DERIVATION_MIN = old_min
+            util.set_worker_processes(0)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_synchronize(self, mock_write):
+        store = storage.WalletStorage('if_this_exists_mocking_failed_648151893')
+        store.put('keystore', keystore.from_xpub(self.xpub).dump())
+        w = wallet.Standard_Wallet(store)
+        w.synchronize()
+        self.assertEqual(20, len(w.get_receiving_addresses()))
+        self.assertEqual(6, len(w.get_change_addresses()))
+        ks = w.keystore
+        for i, addr in enumerate(w.get_receiving_addresses()):
+            self.assertEqual(Address.from_pubkey(ks.derive_pubkey(False, i)), addr)
+        addresses = w.create_new_addresses(True, 3)
+        self.assertEqual(addresses, w.get_change_addresses()[6:])
+        self.assertEqual(w.get_address_index(addresses[2]), (True, 8))
+
+
+class TestWalletCoinCache(unittest.TestCase):
+
+    addr = Address.from_string('1NNkttn1YvVGdqBW4PR6zvc3Zx3H5owKRf')
+    other = Address.from_string('1FJEEB8ihPMbzs2SkLmr37dHyRFzakqUmo')
+
+    def _make_tx(self, txid, prevout_hash, prevout_n, address, outputs):
+        from lib.transaction import Transaction
+        txin = {
+            'type': 'p2pkh',
+            'address': address,
+            'prevout_hash': prevout_hash,
+            'prevout_n': prevout_n,
+            'x_pubkeys': ['02' + '11' * 32],
+            'pubkeys': ['02' + '11' * 32],
+            'signatures': [None],
+            'num_sig': 1,
+        }
+        outputs = [(bitcoin.TYPE_ADDRESS, a, v) for a, v in outputs]
+        # unsigned, so the txid is made up
+        return txid, Transaction.from_io([txin], outputs)
+
+    def _check(self, w):
+        # Cached answers must match a recomputation from scratch
+        cached = (w.get_addr_balance(self.addr), w.get_addr_utxo(self.addr),
+                  w.get_balance(), w.get_utxos())
+        with w.transaction_lock:
+            w.invalidate_addr_cache()
+        fresh = (w.get_addr_balance(self.addr), w.get_addr_utxo(self.addr),
+                 w.get_balance(), w.get_utxos())
+        self.assertEqual(cached, fresh)
+        return fresh
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_coins_follow_history(self, mock_write):
+        store = storage.WalletStorage('if_this_exists_mocking_failed_648151893')
+        w = wallet.ImportedAddressWallet(store)
+        w.import_address(self.addr)
+        self.assertEqual(self._check(w)[0], (0, 0, 0))
+
+        txid1, tx1 = self._make_tx('%064x' % 2, '%064x' % 1, 0, self.other,
+                                   [(self.addr, 5000), (self.addr, 7000)])
+        changed = []
+        w.add_addr_listener(changed.append)
+        w.add_transaction(txid1, tx1)
+        self.assertEqual(set().union(*changed), {self.addr})
+        w.remove_addr_listener(changed.append)
+        w.receive_history_callback(self.addr, [(txid1, 0)], {})
+        self.assertEqual(len(changed), 2)
+        bal, utxo, _, _ = self._check(w)
+        self.assertEqual(bal, (0, 12000, 0))
+        self.assertEqual(set(utxo), {txid1 + ':0', txid1 + ':1'})
+
+        # confirmation
+        w.receive_history_callback(self.addr, [(txid1, 100)], {})
+        self.assertEqual(self._check(w)[0], (12000, 0, 0))
+
+        # spend one of the coins
+        txid2, tx2 = self._make_tx('%064x' % 3, txid1, 1, self.addr, [(self.other, 6000)])
+        w.add_transaction(txid2, tx2)
+        w.receive_history_callback(self.addr, [(txid1, 100), (txid2, 0)], {})
+        bal, utxo, _, coins = self._check(w)
+        self.assertEqual(bal, (12000, -7000, 0))
+        self.assertEqual(list(utxo), [txid1 + ':0'])
+        self.assertEqual([c['value'] for c in coins], [5000])
+
+        # returned coins are copies that callers may modify
+        coins[0]['value'] = 1
+        w.get_addr_utxo(self.addr)[txid1 + ':0']['value'] = 1
+        self.assertEqual(w.get_utxos()[0]['value'], 5000)
+
+        # the spend drops out of the history
+        w.receive_history_callback(self.addr, [(txid1, 100)], {})
+        self.assertNotIn(txid2, w.txi)
+        bal, utxo, _, _ = self._check(w)
+        self.assertEqual(bal, (12000, 0, 0))
+        self.assertEqual(len(utxo), 2)
+
+        # reload from what the wallet saved
+        w.save_transactions()
+        w2 = wallet.ImportedAddressWallet(store)
+        self.assertEqual(w2.get_addr_balance(self.addr), bal)
+        self.assertEqual(w2.get_utxos(), w.get_utxos())
+
+        w.delete_address(self.addr)
+        self.assertEqual(w.get_addr_balance(self.addr), (0, 0, 0))
+
+    def _check_history(self, w):
+        # The ledger must match the history computed from the addresses
+        ledger = w.get_history()
+        self.assertEqual(ledger, w.get_history(w.get_addresses()))
+        return [(row[0], row[4], row[5]) for row in ledger]
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_ledger(self, mock_write):
+        store = storage.WalletStorage('if_this_exists_mocking_failed_648151893')
+        w = wallet.ImportedAddressWallet(store)
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 105
+        w.import_address(self.addr)
+        self.assertEqual(self._check_history(w), [])
+
+        txid1, tx1 = self._make_tx('%064x' % 2, '%064x' % 1, 0, self.other,
+                                   [(self.addr, 5000), (self.addr, 7000)])
+        txid2, tx2 = self._make_tx('%064x' % 3, txid1, 1, self.addr, [(self.other, 6000)])
+        # the spend arrives first, so its input is pruned
+        w.receive_history_callback(self.addr, [(txid1, 0), (txid2, 0)], {})
+        w.receive_tx_callback(txid2, tx2, 0)
+        self.assertEqual(self._check_history(w),
+                         [(txid1, 0, None), (txid2, None, 0)])
+        w.receive_tx_callback(txid1, tx1, 0)
+        self.assertEqual(self._check_history(w),
+                         [(txid1, 12000, 12000), (txid2, -7000, 5000)])
+
+        # confirmation reorders
+        w.receive_history_callback(self.addr, [(txid1, 101), (txid2, 100)], {})
+        self.assertEqual(self._check_history(w),
+                         [(txid2, -7000, -7000), (txid1, 12000, 5000)])
+        w.add_verified_tx(txid2, (100, 1500000000, 1))
+        w.add_verified_tx(txid1, (100, 1500000000, 0))
+        self.assertEqual(self._check_history(w),
+                         [(txid1, 12000, 12000), (txid2, -7000, 5000)])
+        self.assertEqual(w.get_history()[0][2], 6)
+
+        # a new block changes the confirmations only
+        w.network.get_local_height.return_value = 106
+        self.assertEqual(w.get_history()[0][2], 7)
+        self._check_history(w)
+
+        # reorg
+        blockchain = mock.Mock()
+        blockchain.read_header.return_value = None
+        self.assertEqual(w.undo_verifications(blockchain, 100), {txid1, txid2})
+        w.receive_history_callback(self.addr, [(txid1, 0)], {})
+        self.assertEqual(self._check_history(w), [(txid1, 12000, 12000)])
+
+        # returned rows are copies
+        w.get_history().clear()
+        self.assertEqual(len(w.get_history()), 1)
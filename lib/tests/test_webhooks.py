@@ -0,0 +1,140 @@
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+from lib.webhooks import WebhookQueue, check_url
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            status = server.statuses.pop(0) if server.statuses else 200
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+            if status == 200:
+                server.received.append(json.loads(body.decode()))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class TestWebhookQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.received = []
+        self.server.connections = set()
+        self.server.statuses = []
+        self.server.delay = 0
+        self.server.active = self.server.max_active = 0
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/hook' % self.server.server_address[1]
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = None
+
+    def tearDown(self):
+        if self.queue:
+            self.queue.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_delivery_reuses_connection(self):
+        self.queue = WebhookQueue(workers=1)
+        for i in range(5):
+            self.assertTrue(self.queue.post(self.url, {'n': i}))
+        self.wait_for(lambda: self.queue.stats()['delivered'] == 5)
+        self.assertEqual([{'n': i} for i in range(5)], self.server.received)
+        self.assertEqual(1, len(self.server.connections))
+        self.assertIn('latency_median', self.queue.stats())
+
+    def test_retry(self):
+        self.server.statuses = [500, 503]
+        self.queue = WebhookQueue(workers=1, backoff=0.01)
+        self.queue.post(self.url, {'n': 1})
+        self.wait_for(lambda: self.queue.stats()['delivered'] == 1)
+        stats = self.queue.stats()
+        self.assertEqual(2, stats['retried'])
+        self.assertEqual(0, stats['failed'])
+
+    def test_client_error_not_retried(self):
+        self.server.statuses = [404]
+        self.queue = WebhookQueue(workers=1, backoff=0.01)
+        self.queue.post(self.url, {'n': 1})
+        self.wait_for(lambda: self.queue.stats()['failed'] == 1)
+        self.assertEqual(0, self.queue.stats()['retried'])
+        self.assertEqual([], self.server.received)
+
+    def test_per_url_limit(self):
+        self.server.delay = 0.05
+        self.queue = WebhookQueue(workers=4, per_url=2)
+        for i in range(8):
+            self.queue.post(self.url, {'n': i})
+        self.wait_for(lambda: self.queue.stats()['delivered'] == 8)
+        self.assertEqual(2, self.server.max_active)
+
+    def test_bounded_queue(self):
+        self.queue = WebhookQueue(workers=0, max_pending=2)
+        self.assertTrue(self.queue.post(self.url, 1))
+        self.assertTrue(self.queue.post(self.url, 2))
+        self.assertFalse(self.queue.post(self.url, 3))
+        self.assertEqual(1, self.queue.stats()['dropped'])
+
+    def test_persistence(self):
+        path = os.path.join(self.tmpdir, 'webhooks')
+        queue = WebhookQueue(path, workers=0)
+        queue.post(self.url, {'n': 1})
+        queue.post(self.url, {'n': 2})
+        queue.stop()
+        self.assertTrue(os.path.exists(path))
+        self.queue = WebhookQueue(path, workers=1)
+        self.wait_for(lambda: self.queue.stats()['delivered'] == 2)
+        self.assertEqual([{'n': 1}, {'n': 2}], self.server.received)
+        self.queue.stop()
+        self.queue = None
+        self.assertFalse(os.path.exists(path))
+
+    def test_bad_url_not_retried(self):
+        self.queue = WebhookQueue(workers=1, backoff=0.01)
+        for url in ('ftp://127.0.0.1/hook', 'http://127.0.0.1:port/hook'):
+            self.queue.post(url, {'n': 1})
+        self.wait_for(lambda: self.queue.stats()['failed'] == 2)
+        self.assertEqual(0, self.queue.stats()['retried'])
+
+    def test_check_url(self):
+        check_url(self.url)
+        check_url('https://example.com/hook?x=1')
+        for url in ('ftp://example.com/hook', 'example.com/hook', 'http:///hook'):
+            with self.assertRaises(ValueError):
+                check_url(url)
@@ -27,6 +27,7 @@
 
 # Note: The deserialization code originally comes from ABE.
 
+from . import util
 from .util import print_error, profiler
 
 from .bitcoin import *
@@ -49,8 +50,10 @@ class InputValueMissing(Exception):
     """ thrown when the value of an input is needed but not present """
 
 class BCDataStream(object):
-    def __init__(self):
-        self.input = None
+    def __init__(self, data=None):
+        # Streams made from data only read it, through a memoryview, so
+        # that the buffer is not copied
+        self.input = None if data is None else memoryview(data)
         self.read_cursor = 0
 
     def clear(self):
@@ -60,6 +63,8 @@ class BCDataStream(object):
     def write(self, _bytes):  # Initialize with string of _bytes
         if self.input is None:
             self.input = bytearray(_bytes)
+        elif isinstance(self.input, memoryview):
+            self.input = bytearray(self.input) + bytearray(_bytes)
         else:
             self.input += bytearray(_bytes)
 
@@ -86,7 +91,7 @@ class BCDataStream(object):
 
     def read_bytes(self, length):
         try:
-            result = self.input[self.read_cursor:self.read_cursor+length]
+            result = bytes(self.input[self.read_cursor:self.read_cursor+length])
             self.read_cursor += length
             return result
         except IndexError:
@@ -363,8 +368,7 @@ def parse_output(vds, i):
 
 
 def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(bfh(raw))
+    vds = BCDataStream(bfh(raw))
     d = {}
     start = vds.read_cursor
     d['version'] = vds.read_int32()
@@ -381,6 +385,23 @@ def deserialize(raw):
 
 
 
+# Transactions with at least this many signatures to make are signed by
+# the worker processes, if util.set_worker_processes() enabled them
+PARALLEL_SIGNING_MIN = 100
+
+def sign_digests(sec, digests):
+    '''Returns the DER encoded low-S signatures of digests by the secret
+    key sec.  This runs in the signing processes.'''
+    return ec_backend.sign_der(sec, digests)
+
+
+def verify_der(pubkey, sig, digest):
+    '''Checks the DER encoded signature sig of digest by the public key
+    pubkey, in bytes.'''
+    r, s = ecdsa.util.sigdecode_der(sig, SECP256k1.order)
+    return ec_backend.verify(pubkey, r.to_bytes(32, 'big') + s.to_bytes(32, 'big'), digest)
+
+
 def multisig_script(public_keys, m):
     n = len(public_keys)
     assert n <= 15
@@ -416,10 +437,15 @@ class Transaction:
         self._outputs = None
         self.locktime = 0
         self.version = 1
+        # (hashPrevouts, hashSequence, hashOutputs), see calc_common_sighash
+        self._cached_sighash_tup = None
+        # (raw, txid) of the last txid() computed from raw
+        self._cached_txid = None
 
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self.invalidate_common_sighash_cache()
         self.deserialize()
 
     def inputs(self):
@@ -447,6 +473,7 @@ class Transaction:
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        self.invalidate_common_sighash_cache()
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sigs1 = txin.get('signatures')
@@ -454,17 +481,20 @@ class Transaction:
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                pre_hash = Hash(bfh(self.serialize_preimage(i)))
+                pre_hash = Hash(self.serialize_preimage_bytes(i, use_cache=True))
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(bfh(sig[:-2]), order)
                 sig_string = ecdsa.util.sigencode_string(r, s, order)
                 compressed = True
                 for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, pre_hash, curve = SECP256k1)
-                    pubkey = bh2u(point_to_ser(public_key.pubkey.point, compressed))
+                    try:
+                        pubkey = bh2u(ec_backend.recover(sig_string, recid, pre_hash, compressed))
+                    except Exception:
+                        continue
                     if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, pre_hash, sigdecode = ecdsa.util.sigdecode_string)
+                        if not ec_backend.verify(bfh(pubkey), sig_string, pre_hash):
+                            raise Exception("Bad signature")
                         j = pubkeys.index(pubkey)
                         print_error("adding sig", i, j, pubkey, sig)
                         self._inputs[i]['signatures'][j] = sig
@@ -592,70 +622,117 @@ class Transaction:
 
     @classmethod
     def serialize_outpoint(self, txin):
-        return bh2u(bfh(txin['prevout_hash'])[::-1]) + int_to_hex(txin['prevout_n'], 4)
+        return self.serialize_outpoint_bytes(txin).hex()
+
+    @classmethod
+    def serialize_outpoint_bytes(self, txin):
+        return bfh(txin['prevout_hash'])[::-1] + struct.pack('<I', txin['prevout_n'])
 
     @classmethod
     def serialize_input(self, txin, script, estimate_size=False):
-        # Prev hash and index
-        s = self.serialize_outpoint(txin)
-        # Script length, script, sequence
-        s += var_int(len(script)//2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
+        return self.serialize_input_bytes(txin, bfh(script), estimate_size).hex()
+
+    @classmethod
+    def serialize_input_bytes(self, txin, script, estimate_size=False):
+        '''As serialize_input, but script and the result are bytes.'''
+        parts = [
+            # Prev hash and index
+            self.serialize_outpoint_bytes(txin),
+            # Script length, script, sequence
+            var_int_bytes(len(script)),
+            script,
+            struct.pack('<I', txin.get('sequence', 0xffffffff - 1)),
+        ]
         # offline signing needs to know the input value
         if ('value' in txin   # Legacy txs
             and not (estimate_size or self.is_txin_complete(txin))):
-            s += int_to_hex(txin['value'], 8)
-        return s
+            parts.append(struct.pack('<Q', txin['value']))
+        return b''.join(parts)
 
     def BIP_LI01_sort(self):
         # See https://github.com/kristovatlas/rfc/blob/master/bips/bip-li01.mediawiki
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[1])))
+        self.invalidate_common_sighash_cache()
 
     def serialize_output(self, output):
+        return self.serialize_output_bytes(output).hex()
+
+    @classmethod
+    def serialize_output_bytes(self, output):
         output_type, addr, amount = output
-        s = int_to_hex(amount, 8)
-        script = self.pay_script(addr)
-        s += var_int(len(script)//2)
-        s += script
-        return s
+        script = addr.to_script()
+        return struct.pack('<Q', amount) + var_int_bytes(len(script)) + script
 
     @classmethod
     def nHashType(cls):
         '''Hash type in hex.'''
         return 0x01 | (cls.SIGHASH_FORKID + (cls.FORKID << 8))
 
-    def serialize_preimage(self, i):
-        nVersion = int_to_hex(self.version, 4)
-        nHashType = int_to_hex(self.nHashType(), 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+    def invalidate_common_sighash_cache(self):
+        '''Call this whenever inputs or outputs are added, removed or
+        reordered.'''
+        self._cached_sighash_tup = None
+
+    def calc_common_sighash(self, use_cache=False):
+        '''Return the (hashPrevouts, hashSequence, hashOutputs) digests, as
+        hex, that the BIP143 preimages of all inputs share.  Computing them
+        once per transaction rather than once per input keeps signing an
+        n-input transaction O(n).'''
+        return tuple(h.hex() for h in self._calc_common_sighash_bytes(use_cache))
+
+    def _calc_common_sighash_bytes(self, use_cache=False):
+        if use_cache and self._cached_sighash_tup is not None:
+            return self._cached_sighash_tup
         inputs = self.inputs()
         outputs = self.outputs()
-        txin = inputs[i]
-
-        hashPrevouts = bh2u(Hash(bfh(''.join(self.serialize_outpoint(txin) for txin in inputs))))
-        hashSequence = bh2u(Hash(bfh(''.join(int_to_hex(txin.get('sequence', 0xffffffff - 1), 4) for txin in inputs))))
-        hashOutputs = bh2u(Hash(bfh(''.join(self.serialize_output(o) for o in outputs))))
-        outpoint = self.serialize_outpoint(txin)
-        preimage_script = self.get_preimage_script(txin)
-        scriptCode = var_int(len(preimage_script) // 2) + preimage_script
+        hashPrevouts = Hash(b''.join(self.serialize_outpoint_bytes(txin) for txin in inputs))
+        hashSequence = Hash(b''.join(struct.pack('<I', txin.get('sequence', 0xffffffff - 1)) for txin in inputs))
+        hashOutputs = Hash(b''.join(self.serialize_output_bytes(o) for o in outputs))
+        self._cached_sighash_tup = hashPrevouts, hashSequence, hashOutputs
+        return self._cached_sighash_tup
+
+    def serialize_preimage(self, i, use_cache=False):
+        '''See calc_common_sighash for use_cache.'''
+        return self.serialize_preimage_bytes(i, use_cache=use_cache).hex()
+
+    def serialize_preimage_bytes(self, i, use_cache=False):
+        # deserializes if needed, which sets version and locktime
+        txin = self.inputs()[i]
+        hashPrevouts, hashSequence, hashOutputs = self._calc_common_sighash_bytes(use_cache=use_cache)
+        preimage_script = bfh(self.get_preimage_script(txin))
         try:
-            amount = int_to_hex(txin['value'], 8)
+            amount = struct.pack('<Q', txin['value'])
         except KeyError:
             raise InputValueMissing
-        nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
-        preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
-        return preimage
+        return b''.join((
+            struct.pack('<i', self.version),
+            hashPrevouts,
+            hashSequence,
+            self.serialize_outpoint_bytes(txin),
+            var_int_bytes(len(preimage_script)),
+            preimage_script,
+            amount,
+            struct.pack('<I', txin.get('sequence', 0xffffffff - 1)),
+            hashOutputs,
+            struct.pack('<I', self.locktime),
+            struct.pack('<I', self.nHashType()),
+        ))
 
     def serialize(self, estimate_size=False):
-        nVersion = int_to_hex(self.version, 4)
-        nLocktime = int_to_hex(self.locktime, 4)
+        return self.serialize_bytes(estimate_size).hex()
+
+    def serialize_bytes(self, estimate_size=False):
         inputs = self.inputs()
         outputs = self.outputs()
-        txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.input_script(txin, estimate_size), estimate_size) for txin in inputs)
-        txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-        return nVersion + txins + txouts + nLocktime
+        parts = [struct.pack('<i', self.version), var_int_bytes(len(inputs))]
+        for txin in inputs:
+            script = bfh(self.input_script(txin, estimate_size))
+            parts.append(self.serialize_input_bytes(txin, script, estimate_size))
+        parts.append(var_int_bytes(len(outputs)))
+        parts.extend(self.serialize_output_bytes(o) for o in outputs)
+        parts.append(struct.pack('<I', self.locktime))
+        return b''.join(parts)
 
     def hash(self):
         print("warning: deprecated tx.hash()")
@@ -664,18 +741,25 @@ class Transaction:
     def txid(self):
         if not self.is_complete():
             return None
-        ser = self.serialize()
-        return bh2u(Hash(bfh(ser))[::-1])
+        raw = self.raw
+        if raw is None:
+            return Hash(self.serialize_bytes())[::-1].hex()
+        # A complete transaction's raw form is its serialization
+        if self._cached_txid is None or self._cached_txid[0] is not raw:
+            self._cached_txid = raw, Hash(bfh(raw))[::-1].hex()
+        return self._cached_txid[1]
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
         self.raw = None
+        self.invalidate_common_sighash_cache()
 
     def add_outputs(self, outputs):
         assert all(isinstance(output[1], (PublicKey, Address, ScriptOutput))
                    for output in outputs)
         self._outputs.extend(outputs)
         self.raw = None
+        self.invalidate_common_sighash_cache()
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -689,13 +773,15 @@ class Transaction:
     @profiler
     def estimated_size(self):
         '''Return an estimated tx size in bytes.'''
-        return len(self.serialize(True)) / 2 if not self.is_complete() or self.raw is None else len(self.raw) / 2 # ASCII hex string
+        if not self.is_complete() or self.raw is None:
+            return len(self.serialize_bytes(True))
+        return len(self.raw) // 2 # ASCII hex string
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        script = self.input_script(txin, True)
-        return len(self.serialize_input(txin, script, True)) / 2
+        script = bfh(self.input_script(txin, True))
+        return len(self.serialize_input_bytes(txin, script, True))
 
     def signature_count(self):
         r = 0
@@ -713,33 +799,73 @@ class Transaction:
         return r == s
 
     def sign(self, keypairs):
+        # The inputs and outputs cannot change while we sign, so compute
+        # the shared sighash digests afresh once and reuse them below.
+        self.invalidate_common_sighash_cache()
+        # (input, index of the key, x_pubkey, digest) of each signature
+        jobs = []
         for i, txin in enumerate(self.inputs()):
             num = txin['num_sig']
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            count = len(list(filter(None, txin['signatures'])))
             for j, x_pubkey in enumerate(x_pubkeys):
-                signatures = list(filter(None, txin['signatures']))
-                if len(signatures) == num:
+                if count == num:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
-                    print_error("adding signature for", x_pubkey)
-                    sec, compressed = keypairs.get(x_pubkey)
-                    pubkey = public_key_from_private_key(sec, compressed)
-                    # add signature
-                    pre_hash = Hash(bfh(self.serialize_preimage(i)))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-                    assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
-                    txin['signatures'][j] = bh2u(sig) + int_to_hex(self.nHashType() & 255, 1)
-                    txin['x_pubkeys'][j] = pubkey
-                    txin['pubkeys'][j] = pubkey # needed for fd keys
-                    self._inputs[i] = txin
+                if x_pubkey in keypairs:
+                    pre_hash = Hash(self.serialize_preimage_bytes(i, use_cache=True))
+                    jobs.append((i, j, x_pubkey, pre_hash))
+                    count += 1
+        signatures = self.sign_jobs(jobs, keypairs)
+        nHashType = int_to_hex(self.nHashType() & 255, 1)
+        pubkeys = {}
+        for (i, j, x_pubkey, pre_hash), sig in zip(jobs, signatures):
+            print_error("adding signature for", x_pubkey)
+            pubkey = pubkeys.get(x_pubkey)
+            if pubkey is None:
+                sec, compressed = keypairs.get(x_pubkey)
+                pubkey = pubkeys[x_pubkey] = public_key_from_private_key(sec, compressed)
+            # A faulty signature can leak the private key: never let one
+            # out, wherever it was made
+            if not verify_der(bfh(pubkey), sig, pre_hash):
+                raise Exception('bad signature of input {:d}'.format(i))
+            txin = self._inputs[i]
+            txin['signatures'][j] = bh2u(sig) + nHashType
+            txin['x_pubkeys'][j] = pubkey
+            txin['pubkeys'][j] = pubkey # needed for fd keys
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
+    @staticmethod
+    def sign_jobs(jobs, keypairs):
+        '''Returns the signatures of the (input, index, x_pubkey, digest)
+        jobs, in order.  The digests of each key are signed together, in
+        the signing processes if there are enough of them.'''
+        by_key = {}
+        for n, (i, j, x_pubkey, pre_hash) in enumerate(jobs):
+            by_key.setdefault(x_pubkey, []).append(n)
+        pool = util.get_worker_pool() if len(jobs) >= PARALLEL_SIGNING_MIN else None
+        batches = []
+        for x_pubkey, numbers in by_key.items():
+            sec, compressed = keypairs.get(x_pubkey)
+            # Split the work of each key evenly between the processes
+            size = -(-len(numbers) // (4 * util.worker_processes)) if pool else len(numbers)
+            for k in range(0, len(numbers), size):
+                batch = numbers[k:k+size]
+                digests = [jobs[n][3] for n in batch]
+                if pool:
+                    result = pool.submit(sign_digests, sec, digests)
+                else:
+                    result = sign_digests(sec, digests)
+                batches.append((batch, result))
+        signatures = [None] * len(jobs)
+        for batch, result in batches:
+            if pool:
+                result = result.result()
+            for n, sig in zip(batch, result):
+                signatures[n] = sig
+        return signatures
+
     def get_outputs(self):
         """convert pubkeys to addresses"""
         o = []
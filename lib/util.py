@@ -23,7 +23,7 @@
 
 import binascii
 import os, sys, re, json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -180,6 +180,39 @@ class DaemonThread(threading.Thread, PrintError):
         self.print_error("stopped")
 
 
+# Processes for CPU bound work, such as signing large transactions;
+# see set_worker_processes()
+worker_processes = 0
+_worker_pool = None
+
+def set_worker_processes(n):
+    '''Let n processes share CPU bound work; with 0 it is done in the
+    calling thread.'''
+    global worker_processes, _worker_pool
+    n = max(0, int(n or 0))
+    if n != worker_processes and _worker_pool:
+        _worker_pool.shutdown(wait=False)
+        _worker_pool = None
+    worker_processes = n
+
+def get_worker_pool():
+    '''Returns the ProcessPoolExecutor of the worker processes, or None
+    if there are none.'''
+    global _worker_pool
+    if worker_processes and _worker_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        # Forking a process running other threads is not safe.  Before
+        # Python 3.7 the pool can only spawn where that is the default;
+        # elsewhere the work stays in the calling thread.
+        if sys.version_info >= (3, 7):
+            context = multiprocessing.get_context('spawn')
+            _worker_pool = ProcessPoolExecutor(worker_processes, mp_context=context)
+        elif multiprocessing.get_start_method() == 'spawn':
+            _worker_pool = ProcessPoolExecutor(worker_processes)
+    return _worker_pool
+
+
 # TODO: disable
 is_verbose = True
 def set_verbosity(b):
@@ -200,6 +233,48 @@ class cachedproperty(object):
         setattr(obj, self.f.__name__, value)
         return value
 
+
+class LRUCache(object):
+    '''A thread-safe mapping holding at most max_size items.  The least
+    recently used item is discarded when a new item would exceed it.'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def discard_if(self, predicate):
+        '''Remove all items whose key satisfies predicate.'''
+        with self.lock:
+            for key in [k for k in self.items if predicate(k)]:
+                del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
 def print_error(*args):
     if not is_verbose: return
     print_stderr(*args)
@@ -503,18 +578,6 @@ builtin_raw_input = builtins.input
 builtins.input = raw_input
 
 
-def parse_json(message):
-    # TODO: check \r\n pattern
-    n = message.find(b'\n')
-    if n==-1:
-        return None, message
-    try:
-        j = json.loads(message[0:n].decode('utf8'))
-    except:
-        j = None
-    return j, message[n+1:]
-
-
 class timeout(Exception):
     pass
 
@@ -525,9 +588,24 @@ import time
 
 
 class SocketPipe:
+    '''Newline delimited JSON messages over a socket.
+
+    Received data is appended to a buffer and messages are decoded from
+    it in place.  The search for the end of a message resumes where the
+    previous one stopped, and the consumed data is only dropped from the
+    front of the buffer once it has no complete message left, which a
+    bytearray does without moving the rest.  Large messages therefore
+    cost time linear in their size.'''
+
+    RECV_SIZE = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        self.buffer = bytearray()
+        # the next message starts at self.start; there is no newline
+        # between it and self.scan
+        self.start = 0
+        self.scan = 0
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -538,12 +616,24 @@ class SocketPipe:
         return time.time() - self.recv_time
 
     def get(self):
+        buffer = self.buffer
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
-                return response
+            n = buffer.find(b'\n', self.scan)
+            if n != -1:
+                line = buffer[self.start:n]
+                self.start = self.scan = n + 1
+                try:
+                    response = json.loads(line.decode('utf8'))
+                except ValueError:
+                    response = None
+                if response is not None:
+                    return response
+                continue
+            del buffer[:self.start]
+            self.start = 0
+            self.scan = len(buffer)
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(self.RECV_SIZE)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
@@ -564,7 +654,7 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            buffer += data
             self.recv_time = time.time()
 
     def send(self, request):
@@ -28,6 +28,7 @@
 #   - Multisig_Wallet: several keystores, P2SH
 
 
+import bisect
 import os
 import threading
 import random
@@ -45,7 +46,7 @@ from .util import NotEnoughFunds, ExcessiveFee, PrintError, UserCancelled, profi
 from .address import Address, Script, ScriptOutput, PublicKey
 from .bitcoin import *
 from .version import *
-from .keystore import load_keystore, Hardware_KeyStore, Imported_KeyStore, BIP32_KeyStore, xpubkey_to_address
+from .keystore import load_keystore, Hardware_KeyStore, Imported_KeyStore, BIP32_KeyStore, Old_KeyStore, xpubkey_to_address
 from .networks import NetworkConstants
 from .storage import multisig_type
 
@@ -54,6 +55,7 @@ from .transaction import Transaction
 from .plugins import run_hook
 from . import bitcoin
 from . import coinchooser
+from .derivation_cache import DerivationCache
 from .synchronizer import Synchronizer
 from .verifier import SPV
 
@@ -176,9 +178,31 @@ class Abstract_Wallet(PrintError):
         self.frozen_addresses = set(Address.from_string(addr)
                                     for addr in frozen_addresses)
         # address -> list(txid, height)
-        history = storage.get('addr_history',{})
+        history = storage.peek('addr_history',{})
         self._history = self.to_Address_dict(history)
 
+        # Per-address coins and balances, derived from _history, txi and
+        # txo.  Entries are dropped by invalidate_addr_cache() whenever
+        # those change for an address and recomputed on the next query.
+        # Access with self.transaction_lock.
+        self._addr_io_cache = {}    # address -> (received, sent)
+        self._addr_utxo_cache = {}  # address -> {txo: coin}
+        self._addr_bal_cache = {}   # address -> (local_height, (c, u, x))
+        # Called with the addresses passed to invalidate_addr_cache()
+        self.addr_listeners = []
+
+        # The history of the whole wallet in get_txpos() order, kept up
+        # to date by invalidate_history_ledger() and _refresh_ledger().
+        # Access with self.lock and self.transaction_lock.
+        self._ledger_keys = []     # sorted (txpos, tx_hash)
+        self._ledger_deltas = {}   # tx_hash -> (txpos, delta or None)
+        self._ledger_rows = []     # get_history() rows of the keys
+        self._ledger_height = None # local height the rows were made at
+        self._ledger_pruned = 0    # number of None deltas
+        self._ledger_total = None  # wallet balance, c + u + x
+        # tx hashes to re-sort and recompute, or None to rebuild
+        self._ledger_dirty = None
+
         self.load_keystore()
         self.load_addresses()
         self.load_transactions()
@@ -196,7 +220,7 @@ class Abstract_Wallet(PrintError):
         self.unverified_tx = defaultdict(int)
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx = storage.get('verified_tx3', {})
+        self.verified_tx = dict(storage.peek('verified_tx3', {}))
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -227,6 +251,20 @@ class Abstract_Wallet(PrintError):
         return {addr.to_string(Address.FMT_LEGACY): value
                 for addr, value in d.items()}
 
+    @classmethod
+    def to_Address_rows(cls, d):
+        '''As to_Address_dict, for values that are lists of rows.  The
+        lists are copied.'''
+        return {Address.from_string(text): list(rows)
+                for text, rows in d.items()}
+
+    @classmethod
+    def from_Address_rows(cls, d):
+        '''As from_Address_dict, for values that are lists of rows.  The
+        lists and rows are copied to lists, as storage reads them back.'''
+        return {addr.to_string(Address.FMT_LEGACY): [list(row) for row in rows]
+                for addr, rows in d.items()}
+
     def diagnostic_name(self):
         return self.basename()
 
@@ -238,22 +276,27 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        txi = self.storage.get('txi', {})
-        self.txi = {tx_hash: self.to_Address_dict(value)
+        # These are the largest items in storage, so they are read in
+        # place rather than copied, and only the containers the wallet
+        # modifies are copied here.  save_transactions hands the storage
+        # fresh containers in return.
+        txi = self.storage.peek('txi', {})
+        self.txi = {tx_hash: self.to_Address_rows(value)
                     for tx_hash, value in txi.items()}
-        txo = self.storage.get('txo', {})
-        self.txo = {tx_hash: self.to_Address_dict(value)
+        txo = self.storage.peek('txo', {})
+        self.txo = {tx_hash: self.to_Address_rows(value)
                     for tx_hash, value in txo.items()}
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
+        self.tx_fees = dict(self.storage.peek('tx_fees', {}))
+        self.pruned_txo = dict(self.storage.peek('pruned_txo', {}))
+        tx_list = self.storage.peek('transactions', {})
         self.transactions = {}
+        # Transactions are only deserialized when first used
+        pruned_spenders = set(self.pruned_txo.values())
         for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in pruned_spenders):
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                continue
+            self.transactions[tx_hash] = Transaction(raw)
 
     @profiler
     def save_transactions(self, write=False):
@@ -261,30 +304,78 @@ class Abstract_Wallet(PrintError):
             tx = {}
             for k,v in self.transactions.items():
                 tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            txi = {tx_hash: self.from_Address_dict(value)
+            self.storage.put('transactions', tx, owned=True)
+            txi = {tx_hash: self.from_Address_rows(value)
                    for tx_hash, value in self.txi.items()}
-            txo = {tx_hash: self.from_Address_dict(value)
+            txo = {tx_hash: self.from_Address_rows(value)
                    for tx_hash, value in self.txo.items()}
-            self.storage.put('txi', txi)
-            self.storage.put('txo', txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            history = self.from_Address_dict(self._history)
-            self.storage.put('addr_history', history)
+            self.storage.put('txi', txi, owned=True)
+            self.storage.put('txo', txo, owned=True)
+            self.storage.put('tx_fees', dict(self.tx_fees), owned=True)
+            self.storage.put('pruned_txo', dict(self.pruned_txo), owned=True)
+            history = self.from_Address_rows(self._history)
+            self.storage.put('addr_history', history, owned=True)
             if write:
                 self.storage.write()
 
+    def save_verified_tx(self):
+        verified_tx = {tx_hash: list(info)
+                       for tx_hash, info in self.verified_tx.items()}
+        self.storage.put('verified_tx3', verified_tx, owned=True)
+
     def clear_history(self):
         with self.transaction_lock:
             self.txi = {}
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
+            self.invalidate_addr_cache()
         self.save_transactions()
         with self.lock:
             self._history = {}
             self.tx_addr_hist = {}
+            with self.transaction_lock:
+                self.invalidate_addr_cache()
+                self.invalidate_history_ledger()
+
+    def invalidate_addr_cache(self, addresses=None):
+        '''Forget the cached coins and balances of addresses, or of all
+        addresses if None.  Call with self.transaction_lock held, after
+        changing the history, txi or txo of the addresses.'''
+        self._ledger_total = None
+        for callback in self.addr_listeners:
+            callback(addresses)
+        if addresses is None:
+            self._addr_io_cache.clear()
+            self._addr_utxo_cache.clear()
+            self._addr_bal_cache.clear()
+            return
+        for addr in addresses:
+            self._addr_io_cache.pop(addr, None)
+            self._addr_utxo_cache.pop(addr, None)
+            self._addr_bal_cache.pop(addr, None)
+
+    def add_addr_listener(self, callback):
+        '''Have callback(addresses) called when the coins or history of
+        addresses change, or of all addresses if None.  It is called
+        with self.transaction_lock held, from the thread making the
+        change, and must only take note of the addresses.'''
+        with self.transaction_lock:
+            self.addr_listeners.append(callback)
+
+    def remove_addr_listener(self, callback):
+        with self.transaction_lock:
+            if callback in self.addr_listeners:
+                self.addr_listeners.remove(callback)
+
+    def invalidate_history_ledger(self, tx_hashes=None):
+        '''Have get_history() recompute the delta and position of
+        tx_hashes, or rebuild the whole ledger if None.  Call with
+        self.transaction_lock held.'''
+        if tx_hashes is None:
+            self._ledger_dirty = None
+        elif self._ledger_dirty is not None:
+            self._ledger_dirty.update(tx_hashes)
 
     @profiler
     def build_reverse_history(self):
@@ -302,19 +393,25 @@ class Abstract_Wallet(PrintError):
 
         for addr in set(self._history) - set(my_addrs):
             self._history.pop(addr)
+            with self.transaction_lock:
+                self.invalidate_addr_cache([addr])
             save = True
 
+        pruned_spenders = set(self.pruned_txo.values())
         for addr in my_addrs:
             hist = self._history[addr]
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in pruned_spenders or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
                     self.add_transaction(tx_hash, tx)
+                    pruned_spenders = set(self.pruned_txo.values())
                     save = True
         if save:
+            with self.transaction_lock:
+                self.invalidate_history_ledger()
             self.save_transactions()
 
     def basename(self):
@@ -335,6 +432,16 @@ class Abstract_Wallet(PrintError):
             d = {}
         self.receiving_addresses = Address.from_strings(d.get('receiving', []))
         self.change_addresses = Address.from_strings(d.get('change', []))
+        self.build_address_index()
+
+    def build_address_index(self):
+        '''Rebuild the address -> (is_change, index) map used by is_mine()
+        and get_address_index() from the receiving and change lists.'''
+        self._addr_to_addr_index = {}
+        for i, addr in enumerate(self.receiving_addresses):
+            self._addr_to_addr_index[addr] = (False, i)
+        for i, addr in enumerate(self.change_addresses):
+            self._addr_to_addr_index[addr] = (True, i)
 
     def synchronize(self):
         pass
@@ -374,23 +481,19 @@ class Abstract_Wallet(PrintError):
 
     def is_mine(self, address):
         assert not isinstance(address, str)
-        return address in self.get_addresses()
+        return address in self._addr_to_addr_index
 
     def is_change(self, address):
         assert not isinstance(address, str)
-        return address in self.change_addresses
+        index = self._addr_to_addr_index.get(address)
+        return index is not None and index[0]
 
     def get_address_index(self, address):
-        try:
-            return False, self.receiving_addresses.index(address)
-        except ValueError:
-            pass
-        try:
-            return True, self.change_addresses.index(address)
-        except ValueError:
-            pass
         assert not isinstance(address, str)
-        raise Exception("Address {} not found".format(address))
+        try:
+            return self._addr_to_addr_index[address]
+        except KeyError:
+            raise Exception("Address {} not found".format(address))
 
     def export_private_key(self, address, password):
         """ extended WIF format """
@@ -405,20 +508,28 @@ class Abstract_Wallet(PrintError):
         return self.get_pubkeys(*sequence)
 
     def add_unverified_tx(self, tx_hash, tx_height):
+        moved = False
         if tx_height == 0 and tx_hash in self.verified_tx:
             self.verified_tx.pop(tx_hash)
+            moved = True
             if self.verifier:
                 self.verifier.merkle_roots.pop(tx_hash, None)
 
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
+            moved = moved or self.unverified_tx.get(tx_hash) != tx_height
             self.unverified_tx[tx_hash] = tx_height
+        if moved:
+            with self.transaction_lock:
+                self.invalidate_history_ledger([tx_hash])
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            with self.transaction_lock:
+                self.invalidate_history_ledger([tx_hash])
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -438,6 +549,8 @@ class Abstract_Wallet(PrintError):
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
+            with self.transaction_lock:
+                self.invalidate_history_ledger(txs)
         return txs
 
     def get_local_height(self):
@@ -493,7 +606,6 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.get_addresses()
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -501,7 +613,7 @@ class Abstract_Wallet(PrintError):
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
             addr = item['address']
-            if addr in addresses:
+            if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -521,7 +633,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -589,6 +701,15 @@ class Abstract_Wallet(PrintError):
         return tx_hash, status, label, can_broadcast, amount, fee, height, conf, timestamp, exp_n
 
     def get_addr_io(self, address):
+        '''Returns (received, sent) for address.  The dicts are shared with
+        the cache and must not be modified.'''
+        with self.transaction_lock:
+            io = self._addr_io_cache.get(address)
+            if io is None:
+                io = self._addr_io_cache[address] = self._compute_addr_io(address)
+            return io
+
+    def _compute_addr_io(self, address):
         h = self.get_address_history(address)
         received = {}
         sent = {}
@@ -602,24 +723,35 @@ class Abstract_Wallet(PrintError):
                 sent[txi] = height
         return received, sent
 
+    def _get_addr_utxo(self, address):
+        '''Like get_addr_utxo but returns the cached coin dicts.'''
+        with self.transaction_lock:
+            out = self._addr_utxo_cache.get(address)
+            if out is not None:
+                return out
+            received, spent = self.get_addr_io(address)
+            out = {}
+            for txo, v in received.items():
+                if txo in spent:
+                    continue
+                tx_height, value, is_cb = v
+                prevout_hash, prevout_n = txo.split(':')
+                x = {
+                    'address':address,
+                    'value':value,
+                    'prevout_n':int(prevout_n),
+                    'prevout_hash':prevout_hash,
+                    'height':tx_height,
+                    'coinbase':is_cb
+                }
+                out[txo] = x
+            self._addr_utxo_cache[address] = out
+            return out
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
-        return out
+        # Coins are copied as callers add signing information to them
+        return {txo: dict(x)
+                for txo, x in self._get_addr_utxo(address).items()}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
@@ -629,21 +761,32 @@ class Abstract_Wallet(PrintError):
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
         assert isinstance(address, Address)
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        local_height = self.get_local_height()
+        with self.transaction_lock:
+            cached = self._addr_bal_cache.get(address)
+            # Only balances with coinbase outputs depend on the height
+            if cached and cached[0] in (None, local_height):
+                return cached[1]
+            received, sent = self.get_addr_io(address)
+            c = u = x = 0
+            height_dependent = False
+            for txo, (tx_height, v, is_cb) in received.items():
+                if is_cb:
+                    height_dependent = True
+                if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                    x += v
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
-        return c, u, x
+                    u += v
+                if txo in sent:
+                    if sent[txo] > 0:
+                        c -= v
+                    else:
+                        u -= v
+            key = local_height if height_dependent else None
+            self._addr_bal_cache[address] = (key, (c, u, x))
+            return c, u, x
 
     def get_spendable_coins(self, domain, config, isInvoice = False):
         confirmed_only = config.get('confirmed_only', False)
@@ -657,15 +800,15 @@ class Abstract_Wallet(PrintError):
             domain = self.get_addresses()
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
+        local_height = self.get_local_height()
         for addr in domain:
-            utxos = self.get_addr_utxo(addr)
+            utxos = self._get_addr_utxo(addr)
             for x in utxos.values():
                 if confirmed_only and x['height'] <= 0:
                     continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
                     continue
-                coins.append(x)
-                continue
+                coins.append(dict(x))
         return coins
 
     def dummy_address(self):
@@ -732,12 +875,19 @@ class Abstract_Wallet(PrintError):
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.invalidate_addr_cache([addr])
+                    self.invalidate_history_ledger([next_tx])
+            self.invalidate_addr_cache(self.txi[tx_hash])
+            self.invalidate_addr_cache(self.txo[tx_hash])
+            self.invalidate_history_ledger([tx_hash])
             # save
             self.transactions[tx_hash] = tx
 
     def remove_transaction(self, tx_hash):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
+            self.invalidate_addr_cache(self.txi.get(tx_hash, {}))
+            self.invalidate_addr_cache(self.txo.get(tx_hash, {}))
             #tx = self.transactions.pop(tx_hash)
             for ser, hh in list(self.pruned_txo.items()):
                 if hh == tx_hash:
@@ -752,6 +902,8 @@ class Abstract_Wallet(PrintError):
                         if prev_hash == tx_hash:
                             l.remove(item)
                             self.pruned_txo[ser] = next_tx
+                            self.invalidate_addr_cache([addr])
+                            self.invalidate_history_ledger([next_tx])
                     if l == []:
                         dd.pop(addr)
                     else:
@@ -761,6 +913,7 @@ class Abstract_Wallet(PrintError):
                 self.txo.pop(tx_hash)
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+            self.invalidate_history_ledger([tx_hash])
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_transaction(tx_hash, tx)
@@ -776,6 +929,8 @@ class Abstract_Wallet(PrintError):
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
             self._history[addr] = hist
+            with self.transaction_lock:
+                self.invalidate_addr_cache([addr])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -789,13 +944,20 @@ class Abstract_Wallet(PrintError):
             if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
                 self.add_transaction(tx_hash, tx)
 
+        with self.transaction_lock:
+            changed = ({tuple(item) for item in old_hist}
+                       ^ {tuple(item) for item in hist})
+            self.invalidate_history_ledger(tx_hash for tx_hash, height in changed)
+
         # Store fees
         self.tx_fees.update(tx_fees)
 
     def get_history(self, domain=None):
-        # get domain
+        '''Returns (tx_hash, height, conf, timestamp, delta, balance) rows,
+        oldest first.  The history of the whole wallet, domain None, is
+        kept up to date incrementally and is cheap to ask for again.'''
         if domain is None:
-            domain = self.get_addresses()
+            return self.get_wallet_history()
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -836,6 +998,108 @@ class Abstract_Wallet(PrintError):
 
         return h2
 
+    def get_wallet_history(self):
+        local_height = self.get_local_height()
+        with self.lock, self.transaction_lock:
+            self._refresh_ledger(local_height)
+            if self._ledger_total is None:
+                c, u, x = self.get_balance()
+                self._ledger_total = c + u + x
+            total = self._ledger_total
+            rows = self._ledger_rows
+            if not self._ledger_pruned:
+                # the rows carry running sums from the first transaction
+                if (rows[-1][5] if rows else 0) != total:
+                    self.print_error("Error: history not synchronized")
+                    return []
+                return list(rows)
+            # Balances before the last pruned transaction are unknown
+            # and later ones are counted back from the wallet balance.
+            offset = total - rows[-1][5]
+            h = []
+            known = True
+            for row in reversed(rows):
+                h.append(row[:5] + (row[5] + offset if known else None,))
+                if row[4] is None:
+                    known = False
+            h.reverse()
+            return h
+
+    def _refresh_ledger(self, local_height):
+        '''Re-sort the transactions invalidated since the last call and
+        recompute the rows from the first one changed onwards.'''
+        keys = self._ledger_keys
+        deltas = self._ledger_deltas
+        if self._ledger_dirty is None:
+            dirty = set(self.tx_addr_hist)
+            keys.clear()
+            deltas.clear()
+            self._ledger_pruned = 0
+        else:
+            dirty = self._ledger_dirty
+        self._ledger_dirty = set()
+        first = 0 if local_height != self._ledger_height else len(keys)
+        if dirty:
+            pruned_spenders = set(self.pruned_txo.values())
+        added = []
+        for tx_hash in dirty:
+            addrs = self.tx_addr_hist.get(tx_hash)
+            txpos = self.get_txpos(tx_hash) if addrs else None
+            old = deltas.pop(tx_hash, None)
+            if old is not None:
+                i = bisect.bisect_left(keys, (old[0], tx_hash))
+                first = min(first, i)
+                if old[1] is None:
+                    self._ledger_pruned -= 1
+                if old[0] != txpos:
+                    del keys[i]
+                elif addrs:
+                    # stays in place
+                    txpos = None
+            if not addrs:
+                continue
+            if tx_hash in pruned_spenders:
+                delta = None
+                self._ledger_pruned += 1
+            else:
+                delta = 0
+                txi = self.txi.get(tx_hash, {})
+                txo = self.txo.get(tx_hash, {})
+                for addr in addrs:
+                    for n, v in txi.get(addr, ()):
+                        delta -= v
+                    for n, v, cb in txo.get(addr, ()):
+                        delta += v
+            if txpos is None:
+                deltas[tx_hash] = (old[0], delta)
+            else:
+                deltas[tx_hash] = (txpos, delta)
+                added.append((txpos, tx_hash))
+        if len(added) == 1:
+            bisect.insort(keys, added[0])
+        elif added:
+            keys.extend(added)
+            keys.sort()
+        if added:
+            first = min(first, bisect.bisect_left(keys, min(added)))
+
+        rows = self._ledger_rows
+        del rows[first:]
+        balance = rows[-1][5] if rows else 0
+        verified_tx = self.verified_tx
+        unverified_tx = self.unverified_tx
+        for txpos, tx_hash in keys[first:]:
+            delta = deltas[tx_hash][1]
+            if delta is not None:
+                balance += delta
+            if tx_hash in verified_tx:
+                height, timestamp, pos = verified_tx[tx_hash]
+                conf = max(local_height - height + 1, 0)
+            else:
+                height, conf, timestamp = unverified_tx.get(tx_hash, 0), 0, False
+            rows.append((tx_hash, height, conf, timestamp, delta, balance))
+        self._ledger_height = local_height
+
     def export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None, show_addresses=False):
         from .util import format_time, format_satoshis, timestamp_to_datetime
         h = self.get_history(domain)
@@ -977,7 +1241,7 @@ class Abstract_Wallet(PrintError):
         if i_max is None:
             # Let the coin chooser select the coins to spend
             max_change = self.max_change_outputs if self.multiple_change else 1
-            coin_chooser = coinchooser.CoinChooserPrivacy()
+            coin_chooser = coinchooser.get_coin_chooser(config)
             tx = coin_chooser.make_tx(inputs, outputs, change_addrs[:max_change],
                                       fee_estimator, self.dust_threshold())
         else:
@@ -1067,8 +1331,8 @@ class Abstract_Wallet(PrintError):
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
         self.save_transactions()
-        self.storage.put('verified_tx3', self.verified_tx)
-        self.storage.write()
+        self.save_verified_tx()
+        self.storage.compact()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1512,7 +1776,7 @@ class ImportedWalletBase(Simple_Wallet):
 
     def delete_address(self, address):
         assert isinstance(address, Address)
-        if address not in self.get_addresses():
+        if not self.is_mine(address):
             return
 
         transactions_to_remove = set()  # only referred to by this address
@@ -1527,6 +1791,10 @@ class ImportedWalletBase(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self._history.pop(address, None)
+            self.build_reverse_history()
+            with self.transaction_lock:
+                self.invalidate_addr_cache([address])
+                self.invalidate_history_ledger()
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
@@ -1536,7 +1804,7 @@ class ImportedWalletBase(Simple_Wallet):
                 self.transactions.pop(tx_hash, None)
                 # FIXME: what about pruned_txo?
 
-        self.storage.put('verified_tx3', self.verified_tx)
+        self.save_verified_tx()
         self.save_transactions()
 
         self.set_label(address.to_storage_string(), None)
@@ -1581,6 +1849,11 @@ class ImportedAddressWallet(ImportedWalletBase):
     def load_addresses(self):
         addresses = self.storage.get('addresses', [])
         self.addresses = [Address.from_string(addr) for addr in addresses]
+        self.build_address_index()
+
+    def build_address_index(self):
+        # Imported addresses have no derivation index
+        self._addr_to_addr_index = dict.fromkeys(self.addresses)
 
     def save_addresses(self):
         self.storage.put('addresses', [addr.to_storage_string()
@@ -1601,9 +1874,10 @@ class ImportedAddressWallet(ImportedWalletBase):
 
     def import_address(self, address):
         assert isinstance(address, Address)
-        if address in self.addresses:
+        if self.is_mine(address):
             return False
         self.addresses.append(address)
+        self._addr_to_addr_index[address] = None
         self.save_addresses()
         self.storage.write()
         self.add_address(address)
@@ -1612,7 +1886,9 @@ class ImportedAddressWallet(ImportedWalletBase):
 
     def delete_address_derived(self, address):
         self.addresses.remove(address)
-        self._sorted.remove(address)
+        if self._sorted:
+            self._sorted.remove(address)
+        self._addr_to_addr_index.pop(address, None)
 
     def add_input_sig_info(self, txin, address):
         x_pubkey = 'fd' + address.to_script_hex()
@@ -1655,7 +1931,12 @@ class ImportedPrivkeyWallet(ImportedWalletBase):
         self.storage.put('keystore', self.keystore.dump())
 
     def load_addresses(self):
-        pass
+        self.build_address_index()
+
+    def build_address_index(self):
+        # The "index" of an imported key is its public key
+        self._addr_to_addr_index = {pubkey.address: pubkey
+                                    for pubkey in self.keystore.keypairs}
 
     def save_addresses(self):
         pass
@@ -1671,28 +1952,30 @@ class ImportedPrivkeyWallet(ImportedWalletBase):
 
     def delete_address_derived(self, address):
         self.keystore.remove_address(address)
+        self._addr_to_addr_index.pop(address, None)
         self.save_keystore()
 
     def get_address_index(self, address):
         return self.get_public_key(address)
 
     def get_public_key(self, address):
-        return self.keystore.address_to_pubkey(address)
+        return self._addr_to_addr_index.get(address)
 
     def import_private_key(self, sec, pw):
         pubkey = self.keystore.import_privkey(sec, pw)
+        self._addr_to_addr_index[pubkey.address] = pubkey
         self.save_keystore()
         self.storage.write()
         return pubkey.address.to_ui_string()
 
     def export_private_key(self, address, password):
         '''Returned in WIF format.'''
-        pubkey = self.keystore.address_to_pubkey(address)
+        pubkey = self.get_public_key(address)
         return self.keystore.export_private_key(pubkey, password)
 
     def add_input_sig_info(self, txin, address):
         assert txin['type'] == 'p2pkh'
-        pubkey = self.keystore.address_to_pubkey(address)
+        pubkey = self.get_public_key(address)
         txin['num_sig'] = 1
         txin['x_pubkeys'] = [pubkey.to_ui_string()]
         txin['signatures'] = [None]
@@ -1712,6 +1995,76 @@ class Deterministic_Wallet(Abstract_Wallet):
     def has_seed(self):
         return self.keystore.has_seed()
 
+    def load_addresses(self):
+        Abstract_Wallet.load_addresses(self)
+        self.derivation_cache = self.open_derivation_cache()
+        self.check_derivation_cache()
+
+    def open_derivation_cache(self):
+        # The cache is not encrypted, so encrypted wallets keep it in memory
+        path = None
+        if self.storage.path and not self.storage.pubkey:
+            path = self.storage.derivations_path()
+        mpks = ''.join(self.get_master_public_keys()).encode('ascii')
+        pubkey_size = 65 if isinstance(self.keystore, Old_KeyStore) else 33
+        return DerivationCache(path, bitcoin.sha256(mpks),
+                               len(self.get_keystores()), pubkey_size,
+                               wallet_path=self.storage.path)
+
+    def check_derivation_cache(self, samples=2):
+        '''Derives the public keys of a few cached addresses again, and
+        clears the cache if any of them differs.'''
+        cache = self.derivation_cache
+        keys = list(cache.keys())
+        for for_change, i in random.sample(keys, min(samples, len(keys))):
+            hash160, pubkeys = cache.get(for_change, i)
+            x = self.derive_pubkeys(for_change, i)
+            if (pubkeys != self.keystore_pubkeys(x)
+                    or self.pubkeys_to_address(x).hash160 != hash160):
+                self.print_error("derivation cache failed a spot check")
+                cache.clear()
+                return
+
+    def write_derivation_cache(self):
+        if self.storage.pubkey:
+            self.derivation_cache.clear()
+        else:
+            self.derivation_cache.write()
+
+    def reopen_derivation_cache(self):
+        '''Moves the cache in or out of its file after the wallet file was
+        encrypted or decrypted.'''
+        old = self.derivation_cache
+        records = {key: old.get(*key) for key in old.keys()}
+        old.clear()
+        self.derivation_cache = self.open_derivation_cache()
+        for (for_change, i), (hash160, pubkeys) in records.items():
+            self.derivation_cache.put(for_change, i, hash160, pubkeys)
+
+    def stop_threads(self):
+        Abstract_Wallet.stop_threads(self)
+        self.write_derivation_cache()
+
+    def get_derived_pubkeys(self, c, i):
+        '''The public keys of the keystores for address (c, i), in hex.'''
+        addr_list = self.change_addresses if c else self.receiving_addresses
+        address = addr_list[i] if i < len(addr_list) else None
+        record = self.derivation_cache.get(c, i)
+        if record and address:
+            # the file isn't authenticated: check the public keys hash
+            # to the address before using them
+            try:
+                valid = self.cached_pubkeys_to_address(record[1]) == address
+            except Exception:
+                valid = False
+            if valid:
+                return record[1]
+            self.print_error("dropping bad derivation cache record", c, i)
+        pubkeys = [k.derive_pubkey(c, i) for k in self.get_keystores()]
+        if address:
+            self.derivation_cache.put(bool(c), i, address.hash160, pubkeys)
+        return pubkeys
+
     def get_receiving_addresses(self):
         return self.receiving_addresses
 
@@ -1734,6 +2087,8 @@ class Deterministic_Wallet(Abstract_Wallet):
             addresses = self.get_receiving_addresses()
             k = self.num_unused_trailing_addresses(addresses)
             n = len(addresses) - k + value
+            for addr in self.receiving_addresses[n:]:
+                self._addr_to_addr_index.pop(addr, None)
             self.receiving_addresses = self.receiving_addresses[0:n]
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
@@ -1765,28 +2120,41 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
+        '''Appends count addresses to the receiving or change addresses,
+        deriving their public keys in one batch.'''
         assert type(for_change) is bool
         with self.lock:
             addr_list = self.change_addresses if for_change else self.receiving_addresses
             n = len(addr_list)
-            x = self.derive_pubkeys(for_change, n)
-            address = self.pubkeys_to_address(x)
-            addr_list.append(address)
+            pubkeys = self.derive_pubkeys_range(for_change, n, count)
+            addresses = [self.pubkeys_to_address(x) for x in pubkeys]
+            for i, (x, address) in enumerate(zip(pubkeys, addresses), n):
+                self._addr_to_addr_index[address] = (for_change, i)
+                self.derivation_cache.put(for_change, i, address.hash160,
+                                          self.keystore_pubkeys(x))
+            addr_list.extend(addresses)
             self.save_addresses()
-            self.add_address(address)
-            return address
+            for address in addresses:
+                self.add_address(address)
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if list(map(lambda a: self.address_is_old(a), addresses[-limit:] )) == limit*[False]:
+            # New addresses have no history, so after adding the missing
+            # ones the last limit addresses are unused
+            unused = 0
+            for addr in reversed(addresses[-limit:]):
+                if self.address_is_old(addr):
+                    break
+                unused += 1
+            if unused == limit:
                 break
-            else:
-                self.create_new_address(for_change)
+            self.create_new_addresses(for_change, limit - unused)
 
     def synchronize(self):
         with self.lock:
@@ -1800,7 +2168,7 @@ class Deterministic_Wallet(Abstract_Wallet):
         else:
             addr_list = self.get_receiving_addresses()
             limit = self.gap_limit
-        idx = addr_list.index(address)
+        idx = self.get_address_index(address)[1]
         if idx < limit:
             return False
         for addr in addr_list[-limit:]:
@@ -1838,8 +2206,12 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
             xtype = 'standard'
         self.txin_type = 'p2pkh' if xtype == 'standard' else xtype
 
+    def update_password(self, old_pw, new_pw, encrypt=False):
+        Simple_Wallet.update_password(self, old_pw, new_pw, encrypt)
+        self.reopen_derivation_cache()
+
     def get_pubkey(self, c, i):
-        return self.derive_pubkeys(c, i)
+        return self.get_derived_pubkeys(c, i)[0]
 
     def get_public_keys(self, address):
         return [self.get_public_key(address)]
@@ -1848,6 +2220,7 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
         derivation = self.get_address_index(address)
         x_pubkey = self.keystore.get_xpubkey(*derivation)
         txin['x_pubkeys'] = [x_pubkey]
+        txin['pubkeys'] = [self.get_pubkey(*derivation)]
         txin['signatures'] = [None]
         txin['num_sig'] = 1
 
@@ -1857,6 +2230,17 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_range(self, c, start, count):
+        return self.keystore.derive_pubkeys_range(c, start, count)
+
+    def keystore_pubkeys(self, x):
+        '''The list of keystore public keys of x, a result of
+        derive_pubkeys().'''
+        return [x]
+
+    def cached_pubkeys_to_address(self, pubkeys):
+        return self.pubkeys_to_address(pubkeys[0])
+
 
 
 
@@ -1879,7 +2263,7 @@ class Multisig_Wallet(Deterministic_Wallet):
         Deterministic_Wallet.__init__(self, storage)
 
     def get_pubkeys(self, c, i):
-        return self.derive_pubkeys(c, i)
+        return self.get_derived_pubkeys(c, i)
 
     def pubkeys_to_address(self, pubkeys):
         pubkeys = [bytes.fromhex(pubkey) for pubkey in pubkeys]
@@ -1892,6 +2276,16 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_range(self, c, start, count):
+        ranges = [k.derive_pubkeys_range(c, start, count) for k in self.get_keystores()]
+        return [list(pubkeys) for pubkeys in zip(*ranges)]
+
+    def keystore_pubkeys(self, x):
+        return x
+
+    def cached_pubkeys_to_address(self, pubkeys):
+        return self.pubkeys_to_address(pubkeys)
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -1920,6 +2314,7 @@ class Multisig_Wallet(Deterministic_Wallet):
                 self.storage.put(name, keystore.dump())
         self.storage.set_password(new_pw, encrypt)
         self.storage.write()
+        self.reopen_derivation_cache()
 
     def has_seed(self):
         return self.keystore.has_seed()
@@ -1940,11 +2335,14 @@ class Multisig_Wallet(Deterministic_Wallet):
         return ''.join(sorted(self.get_master_public_keys()))
 
     def add_input_sig_info(self, txin, address):
-        # x_pubkeys are not sorted here because it would be too slow
-        # they are sorted in transaction.get_sorted_pubkeys
+        # x_pubkeys are sorted in the order of the pubkeys, like
+        # transaction.get_sorted_pubkeys does
         derivation = self.get_address_index(address)
-        txin['x_pubkeys'] = [k.get_xpubkey(*derivation) for k in self.get_keystores()]
-        txin['pubkeys'] = None
+        x_pubkeys = [k.get_xpubkey(*derivation) for k in self.get_keystores()]
+        pubkeys = self.get_pubkeys(*derivation)
+        pubkeys, x_pubkeys = zip(*sorted(zip(pubkeys, x_pubkeys)))
+        txin['x_pubkeys'] = list(x_pubkeys)
+        txin['pubkeys'] = list(pubkeys)
         # we need n place holders
         txin['signatures'] = [None] * self.n
         txin['num_sig'] = self.m
@@ -0,0 +1,263 @@
+# Electron Cash - lightweight Bitcoin client
+# Copyright (C) 2018 The Electron Cash Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''Delivery of the HTTP POST notifications of the notify command.
+
+Notifications are queued and sent by a few worker threads, so that a
+slow endpoint doesn't hold up the caller.  The workers keep their
+connections open between deliveries; failed deliveries are retried
+with exponential backoff.  Deliveries still queued when the queue is
+stopped are saved, and resumed when it is started again.'''
+
+import collections
+import heapq
+import http.client
+import itertools
+import json
+import os
+import ssl
+import threading
+import time
+import urllib.parse
+
+from .util import PrintError
+
+
+def check_url(url):
+    '''Raises ValueError if url can't be POSTed to.'''
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise ValueError('unsupported URL scheme: %r' % parts.scheme)
+    if not parts.netloc:
+        raise ValueError('no host in URL: %r' % url)
+
+
+class Delivery(object):
+
+    def __init__(self, url, payload, created=None, attempts=0):
+        self.url = url
+        self.payload = payload
+        # when the delivery was queued, for the latency
+        self.created = created or time.time()
+        self.attempts = attempts
+
+    def to_json(self):
+        return {'url': self.url, 'payload': self.payload,
+                'created': self.created, 'attempts': self.attempts}
+
+
+class WebhookQueue(PrintError):
+    '''POSTs JSON payloads to URLs from `workers` threads, at most
+    `per_url` at a time to the same URL.  At most `max_pending`
+    deliveries wait in the queue; more are dropped.  A delivery is
+    tried `retries` times, after waiting `backoff` seconds, then twice
+    as long each time.  The queue is saved to `path`, if not None, when
+    stopped.'''
+
+    def __init__(self, path=None, workers=4, max_pending=1000, per_url=2,
+                 retries=5, backoff=1.0, timeout=5):
+        self.path = path
+        self.max_pending = max_pending
+        self.per_url = per_url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        # (time due, sequence number, delivery) of deliveries to retry
+        self.retrying = []
+        self.sequence = itertools.count()
+        # url -> number of deliveries in progress
+        self.active = collections.defaultdict(int)
+        self.running = True
+        # latencies of the latest deliveries, from queued to delivered
+        self.latencies = collections.deque(maxlen=1000)
+        self.counts = {'delivered': 0, 'failed': 0, 'dropped': 0, 'retried': 0}
+        # (scheme, host) -> open connection, per worker thread
+        self.local = threading.local()
+        self.load()
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.work, name='webhook-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __len__(self):
+        return len(self.pending) + len(self.retrying)
+
+    def post(self, url, payload):
+        '''Queues a delivery of payload, serialized to JSON.  Returns
+        False if it was dropped because the queue is full.'''
+        with self.cond:
+            if len(self) >= self.max_pending:
+                self.counts['dropped'] += 1
+                self.print_error("queue full, dropping notification to", url)
+                return False
+            self.pending.append(Delivery(url, payload))
+            self.cond.notify()
+        return True
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            stats = dict(self.counts)
+            stats['pending'] = len(self)
+            stats['in_progress'] = sum(self.active.values())
+        if latencies:
+            stats['latency_median'] = latencies[len(latencies) // 2]
+            stats['latency_max'] = latencies[-1]
+        return stats
+
+    def stop(self):
+        '''Waits for the deliveries in progress, then saves the queue.'''
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+        self.save()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                deliveries = json.loads(f.read())
+            for d in deliveries:
+                self.pending.append(Delivery(d['url'], d['payload'],
+                                             d['created'], d['attempts']))
+        except Exception as e:
+            self.print_error("cannot read", self.path, e)
+        self.print_error("resuming", len(self.pending), "deliveries")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.cond:
+            deliveries = list(self.pending) + [d for _, _, d in sorted(self.retrying)]
+        if not deliveries:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temp_path = "%s.tmp.%s" % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps([d.to_json() for d in deliveries]))
+        os.replace(temp_path, self.path)
+        self.print_error("saved", len(deliveries), "deliveries")
+
+    def next_delivery(self):
+        '''Waits for a delivery that can be started, with self.cond held.
+        Returns None once stopped.'''
+        while self.running:
+            now = time.time()
+            while self.retrying and self.retrying[0][0] <= now:
+                self.pending.append(heapq.heappop(self.retrying)[2])
+            for delivery in self.pending:
+                if self.active.get(delivery.url, 0) < self.per_url:
+                    self.pending.remove(delivery)
+                    self.active[delivery.url] += 1
+                    return delivery
+            timeout = self.retrying[0][0] - now if self.retrying else None
+            self.cond.wait(timeout)
+        return None
+
+    def work(self):
+        self.local.connections = {}
+        while True:
+            with self.cond:
+                delivery = self.next_delivery()
+            if delivery is None:
+                break
+            delivery.attempts += 1
+            try:
+                status = self.send(delivery)
+                error = None if 200 <= status < 300 else 'HTTP status %d' % status
+                # other client errors won't go away
+                retry = status >= 500 or status in (408, 429)
+            except (ValueError, http.client.InvalidURL) as e:
+                # a bad URL stays bad
+                error, retry = e, False
+            except Exception as e:
+                error, retry = e, True
+            with self.cond:
+                self.active[delivery.url] -= 1
+                if not self.active[delivery.url]:
+                    del self.active[delivery.url]
+                if error is None:
+                    self.counts['delivered'] += 1
+                    self.latencies.append(time.time() - delivery.created)
+                elif retry and delivery.attempts < self.retries:
+                    self.counts['retried'] += 1
+                    due = time.time() + self.backoff * 2 ** (delivery.attempts - 1)
+                    heapq.heappush(self.retrying, (due, next(self.sequence), delivery))
+                else:
+                    self.counts['failed'] += 1
+                # a slot for the URL was freed, or the next retry changed
+                self.cond.notify_all()
+            if error is not None:
+                self.print_error(delivery.url, "attempt", delivery.attempts,
+                                 "failed:", error)
+        for conn in self.local.connections.values():
+            conn.close()
+
+    def connect(self, parts):
+        if parts.scheme == 'https':
+            return http.client.HTTPSConnection(parts.netloc, timeout=self.timeout,
+                                               context=ssl.create_default_context())
+        return http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+
+    def send(self, delivery):
+        '''POSTs the payload and returns the HTTP status.  An open
+        connection to the host is reused; if the server closed it in the
+        meantime, the request is sent again on a new one.'''
+        check_url(delivery.url)
+        parts = urllib.parse.urlsplit(delivery.url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        body = json.dumps(delivery.payload).encode('utf8')
+        headers = {'Content-Type': 'application/json'}
+        key = (parts.scheme, parts.netloc)
+        conn = self.local.connections.pop(key, None)
+        if conn is not None:
+            try:
+                return self.request(key, conn, path, body, headers)
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                conn.close()
+        return self.request(key, self.connect(parts), path, body, headers)
+
+    def request(self, key, conn, path, body, headers):
+        try:
+            conn.request('POST', path, body, headers)
+            response = conn.getresponse()
+            response.read()
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.local.connections[key] = conn
+        return response.status
@@ -493,6 +493,7 @@ class DigitalBitbox_KeyStore(Hardware_KeyStore):
             pubkeyarray = []
 
             # Build hasharray from inputs
+            tx.invalidate_common_sighash_cache()
             for i, txin in enumerate(tx.inputs()):
                 if txin['type'] == 'coinbase':
                     self.give_error("Coinbase not supported") # should never happen
@@ -504,7 +505,7 @@ class DigitalBitbox_KeyStore(Hardware_KeyStore):
                     if x_pubkey in derivations:
                         index = derivations.get(x_pubkey)
                         inputPath = "%s/%d/%d" % (self.get_derivation(), index[0], index[1])
-                        inputHash = Hash(binascii.unhexlify(tx.serialize_preimage(i)))
+                        inputHash = Hash(tx.serialize_preimage_bytes(i, use_cache=True))
                         hasharray_i = {'hash': to_hexstr(inputHash), 'keypath': inputPath}
                         hasharray.append(hasharray_i)
                         inputhasharray.append(inputHash)